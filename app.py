@@ -1,7 +1,7 @@
 import os
 from flask import Flask, render_template, request, send_file, jsonify, abort
 from markupsafe import Markup
-import requests
+from moysklad_client import MoySkladClient
 from openpyxl import Workbook
 from openpyxl.worksheet.table import Table, TableStyleInfo
 from openpyxl.styles import Font, PatternFill, Alignment  # Добавим импорт в начало файла
@@ -10,17 +10,32 @@ from datetime import datetime, timedelta
 import json
 import threading
 import math
+from worker_pool import run_ordered
+from catalog_cache import CatalogCache, KeyedCache
+from group_index import build_group_index, get_group_path, get_names_by_uuid, inherit_max_values
+from sheet_outline import OutlineTracker
+from report_records import Operation, ProductRow, SkuMetrics
+from sales_speed import SPEED_STRATEGIES, OperationColumns, datetime_to_us
 
 app = Flask(__name__)
 
 print(os.getcwd())
 
+# Настройки по умолчанию (могут быть переопределены в config.py)
+CATALOG_CACHE_TTL = 600  # Время жизни кэша групп товаров и складов в секундах
+SALES_SPEED_WORKERS = 5  # Количество параллельных запросов при расчете скорости продаж
+REPORT_METRICS_CACHE_TTL = 1800  # Сколько секунд хранить рассчитанные показатели позиций отчета
+REPORT_METRICS_CACHE_SIZE = 8  # Сколько наборов показателей (склад, период, группы) хранить одновременно
+
 # Загрузка токена из файла конфигурации
 with open('config.py', 'r') as config_file:
     exec(config_file.read())
 
 BASE_URL = 'https://api.moysklad.ru/api/remap/1.2'
 
+# Общий клиент API с пулом соединений и повторами запросов
+api_client = MoySkladClient(MOYSKLAD_TOKEN, BASE_URL)
+
 # Добавим глобальную переменную для отслеживания состояния
 processing_cancelled = False
 processing_lock = threading.Lock()
@@ -56,13 +71,29 @@ def index():
         print(f"Final product groups being sent to get_report_data: {product_groups}")  # Отладка
         print(f"Manual stock settings being sent: {manual_stock_settings}")  # Отладка
         
+        # Настройки разбираем и проверяем до запросов к API
         try:
-            report_data = get_report_data(start_date, end_date, store_id, product_groups)
-            
-            if not report_data or 'rows' not in report_data or not report_data['rows']:
-                return "Нет данных для формирования отчета для выбранных параметров", 404
+            manual_stock_by_group = parse_manual_stock_settings(manual_stock_settings)
+        except ValueError as e:
+            return f"Некорректные настройки минимальных остатков: {str(e)}", 400
+        
+        try:
+            # Скорость продаж не зависит от периода планирования и минимальных остатков:
+            # при их изменении отчет строится по запомненным показателям без запросов к API
+            metrics_key = (store_id, start_date, end_date, tuple(product_groups))
+            sku_metrics = report_metrics_cache.get(metrics_key)
+            if sku_metrics is None:
+                report_data = get_report_data(start_date, end_date, store_id, product_groups)
+                
+                if not report_data or 'rows' not in report_data or not report_data['rows']:
+                    return "Нет данных для формирования отчета для выбранных параметров", 404
+                
+                sku_metrics = calculate_sku_metrics(report_data, store_id, end_date)
+                report_metrics_cache.set(metrics_key, sku_metrics)
+            else:
+                print(f"Показатели {len(sku_metrics)} позиций взяты из кэша")
             
-            excel_file = create_excel_report(report_data, store_id, start_date, end_date, planning_days, manual_stock_settings)
+            excel_file = create_excel_report(sku_metrics, store_id, start_date, end_date, planning_days, manual_stock_by_group)
             
             return send_file(excel_file, as_attachment=True, download_name=excel_file)
         except Exception as e:
@@ -78,6 +109,13 @@ def get_subgroups(group_id):
     subgroups = get_subgroups_for_group(group_id)
     return jsonify(subgroups)
 
+@app.route('/cache/invalidate', methods=['POST'])
+def invalidate_cache():
+    stores_cache.invalidate()
+    product_groups_cache.invalidate()
+    report_metrics_cache.invalidate()
+    return jsonify({'status': 'invalidated'})
+
 @app.route('/stop_processing', methods=['POST'])
 def stop_processing():
     global processing_cancelled
@@ -91,6 +129,31 @@ def check_if_cancelled():
         if processing_cancelled:
             raise Exception("Processing cancelled by user")
 
+def parse_manual_stock_settings(manual_stock_settings):
+    """
+    Разбирает JSON ручных минимальных остатков ([{"group_id": ..., "min_stock": ...}, ...]).
+
+    Returns:
+        dict: UUID группы -> минимальный остаток (наибольший, если группа указана несколько раз)
+
+    Raises:
+        ValueError: Если настройки не являются списком таких объектов
+    """
+    if not manual_stock_settings:
+        return {}
+    try:
+        settings = json.loads(manual_stock_settings)
+        min_stock_by_group = {}
+        for setting in settings:
+            group_id = setting['group_id']
+            min_stock = int(setting['min_stock'])
+            if group_id not in min_stock_by_group or min_stock > min_stock_by_group[group_id]:
+                min_stock_by_group[group_id] = min_stock
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f"{type(e).__name__}: {str(e)}") from e
+    print(f"Разобранные настройки минимальных остатков: {min_stock_by_group}")
+    return min_stock_by_group
+
 def get_report_data(start_date, end_date, store_id, product_groups):
     print(f"\nStarting get_report_data with product_groups: {product_groups}")  # Начало функции
     
@@ -100,11 +163,6 @@ def get_report_data(start_date, end_date, store_id, product_groups):
     
     try:
         url = f"{BASE_URL}/report/profit/byvariant"
-        headers = {
-            'Authorization': f'Bearer {MOYSKLAD_TOKEN}',
-            'Accept': 'application/json;charset=utf-8',
-            'Content-Type': 'application/json'
-        }
         
         start_datetime = datetime.strptime(start_date, '%Y-%m-%d')
         end_datetime = datetime.strptime(end_date, '%Y-%m-%d')
@@ -162,9 +220,9 @@ def get_report_data(start_date, end_date, store_id, product_groups):
             query_string = '&'.join(query_params)
             
             full_url = f"{url}?{query_string}"
-            print(f"Отправляем запрос: URL={full_url}, Headers={headers}")
+            print(f"Отправляем запрос: URL={full_url}")
             
-            response = requests.get(full_url, headers=headers)
+            response = api_client.get(full_url)
             
             if response.status_code != 200:
                 error_message = f"Ошибка при получении данных: {response.status_code}. Ответ сервера: {response.text}"
@@ -191,16 +249,12 @@ def get_report_data(start_date, end_date, store_id, product_groups):
             abort(499, description="Processing cancelled by user")
         raise e
 
-def get_stores():
+def fetch_stores():
     url = f"{BASE_URL}/entity/store"
-    headers = {
-        'Authorization': f'Bearer {MOYSKLAD_TOKEN}',
-        'Accept': 'application/json;charset=utf-8'
-    }
     
-    print(f"Отправляем запрос для полуения списка складов: URL={url}, Headers={headers}")  # Для отладки
+    print(f"Отправляем запрос для полуения списка складов: URL={url}")  # Для отладки
     
-    response = requests.get(url, headers=headers)
+    response = api_client.get(url)
     if response.status_code == 200:
         stores = response.json()['rows']
         return [{'id': store['id'], 'name': store['name']} for store in stores]
@@ -211,15 +265,11 @@ def get_stores():
     
 def get_subgroups_for_group(group_id):
     url = f"{BASE_URL}/entity/productfolder"
-    headers = {
-        'Authorization': f'Bearer {MOYSKLAD_TOKEN}',
-        'Accept': 'application/json;charset=utf-8'
-    }
     params = {
         'filter': f'productFolder={group_id}'
     }
     
-    response = requests.get(url, headers=headers, params=params)
+    response = api_client.get(url, params=params)
     if response.status_code == 200:
         subgroups = response.json()['rows']
         return [{'id': group['id'], 'name': group['name'], 'children': []} for group in subgroups]
@@ -228,12 +278,8 @@ def get_subgroups_for_group(group_id):
         print(error_message)
         return []
 
-def get_product_groups():
+def fetch_product_groups():
     url = f"{BASE_URL}/entity/productfolder"
-    headers = {
-        'Authorization': f'Bearer {MOYSKLAD_TOKEN}',
-        'Accept': 'application/json;charset=utf-8'
-    }
     
     all_groups = []
     offset = 0
@@ -245,7 +291,7 @@ def get_product_groups():
             'limit': limit
         }
         
-        response = requests.get(url, headers=headers, params=params)
+        response = api_client.get(url, params=params)
         if response.status_code == 200:
             data = response.json()
             all_groups.extend(data['rows'])
@@ -259,6 +305,26 @@ def get_product_groups():
 
     return build_group_hierarchy(all_groups)
 
+def fetch_product_catalog():
+    """Дерево групп вместе с плоским индексом для быстрого поиска путей"""
+    product_groups = fetch_product_groups()
+    return product_groups, build_group_index(product_groups)
+
+# Справочники кэшируются на уровне процесса и обновляются в фоне после истечения TTL
+stores_cache = CatalogCache('stores', fetch_stores, CATALOG_CACHE_TTL)
+product_groups_cache = CatalogCache('product_groups', fetch_product_catalog, CATALOG_CACHE_TTL)
+# Показатели позиций отчета по (склад, период, группы)
+report_metrics_cache = KeyedCache('report_metrics', REPORT_METRICS_CACHE_TTL, REPORT_METRICS_CACHE_SIZE)
+
+def get_stores():
+    return stores_cache.get()
+
+def get_product_groups():
+    return product_groups_cache.get()[0]
+
+def get_group_index():
+    return product_groups_cache.get()[1]
+
 def build_group_hierarchy(groups):
     group_dict = {}
     root_groups = []
@@ -300,10 +366,6 @@ def print_group_hierarchy(groups, level=0):
 
 def get_sales_speed(variant_id, store_id, end_date, is_variant):
     url = f"{BASE_URL}/report/turnover/byoperations"
-    headers = {
-        'Authorization': f'Bearer {MOYSKLAD_TOKEN}',
-        'Accept': 'application/json;charset=utf-8'
-    }
     
     start_date = "2024-01-01 00:00:00"
     end_date_formatted = datetime.strptime(end_date, '%Y-%m-%d').strftime('%Y-%m-%d 23:59:59')
@@ -325,19 +387,16 @@ def get_sales_speed(variant_id, store_id, end_date, is_variant):
     
     print(f"Запрос для получения данных о родажах: URL={full_url}")
     
-    response = requests.get(full_url, headers=headers)
+    # Операции разбираются по мере загрузки ответа сразу в записи Operation
+    response, data = api_client.get_rows(full_url, Operation.from_api_row)
     if response.status_code != 200:
         print(f"Ошибка пи получении данных о проажах: {response.status_code}. Ответ ервера: {response.text}")
         return 0, '', '', '', ''  # Возвращаем 0 для скоости и пустую строку для UUID
 
-    data = response.json()
     rows = data.get('rows', [])
 
     # Фильтрация по UUID модификации
-    filtered_rows = [
-        row for row in rows
-        if row.get('assortment', {}).get('meta', {}).get('href', '').split('/')[-1] == variant_id
-    ]
+    filtered_rows = [row for row in rows if row.assortment_id == variant_id]
 
     # Получаем UUID группы и название группы из отфильтрованных данных
     group_uuid = ''
@@ -346,88 +405,34 @@ def get_sales_speed(variant_id, store_id, end_date, is_variant):
     product_href = ''
     
     if filtered_rows:
-        assortment = filtered_rows[0].get('assortment', {})
-        product_folder = assortment.get('productFolder', {})
-        group_href = product_folder.get('meta', {}).get('href', '')
-        group_uuid = group_href.split('/')[-1] if group_href else ''
-        group_name = product_folder.get('name', '')
+        operation = filtered_rows[0]
+        group_uuid = operation.group_uuid
+        group_name = operation.folder_name
         
         # Получаем UUID сылку на товар из отфильтрованной строки
-        product_meta = assortment.get('meta', {})
-        product_href = product_meta.get('uuidHref', '')
+        product_href = operation.uuid_href
         if product_href:
-            product_uuid = product_meta.get('href', '').split('/')[-1]
+            product_uuid = operation.assortment_id
         
         print(f"Found group UUID: {group_uuid}, name: {group_name}")
 
-    # Сортировка оперций по дате
-    filtered_rows.sort(key=lambda x: datetime.fromisoformat(x['operation']['moment'].replace('Z', '+00:00')))
-
-    retail_demand_counter = 0
-    current_stock = 0
-    last_operation_time = None
-    on_stock_time = timedelta()
-
+    # Скорость по времени наличия товара: операции в столбцах, без datetime в цикле
+    start_datetime = datetime.strptime(start_date, '%Y-%m-%d %H:%M:%S')
     end_datetime = datetime.strptime(end_date_formatted, '%Y-%m-%d %H:%M:%S')
-
-    for row in filtered_rows:
-        quantity = row['quantity']
-        operation_time = datetime.fromisoformat(row['operation']['moment'].replace('Z', '+00:00'))
-        operation_type = row['operation']['meta']['type']
-
-        if last_operation_time and current_stock > 0:
-            on_stock_time += operation_time - last_operation_time
-
-        if quantity > 0:  # Приход товара
-            current_stock += quantity
-        else:  # Уход товара
-            quantity = abs(quantity)
-            current_stock = max(0, current_stock - quantity)
-            if operation_type == 'retaildemand':
-                retail_demand_counter += quantity
-
-        last_operation_time = operation_time
-
-    # Учитываем время от последней операции до конца периода
-    if last_operation_time and current_stock > 0:
-        on_stock_time += end_datetime - last_operation_time
-
-    days_on_stock = on_stock_time.total_seconds() / (24 * 60 * 60)
-
-    if days_on_stock > 0:
-        sales_speed = round(retail_demand_counter / days_on_stock, 2)
-    else:
-        sales_speed = 0
+    columns = OperationColumns.from_groups([(variant_id, filtered_rows)])
+    sales_speed = SPEED_STRATEGIES['on_stock'].compute(
+        columns, datetime_to_us(start_datetime), datetime_to_us(end_datetime)
+    )[0]
 
     print(f"sales_speed: {sales_speed}, group_uuid: {group_uuid}, product_href: {product_href}")
 
     return sales_speed, group_uuid, group_name, product_uuid, product_href
 
-def get_group_path(group_uuid, product_groups, get_uuid=False):
-    def find_group_path(groups, target_uuid, current_path=[], current_uuid_path=[]):
-        for group in groups:
-            if group['id'] == target_uuid:
-                return (current_path + [group['name']], current_uuid_path + [group['id']])
-            if group.get('children'):
-                path = find_group_path(group['children'], target_uuid, 
-                                     current_path + [group['name']], 
-                                     current_uuid_path + [group['id']])
-                if path:
-                    return path
-        return None
-
-    path = find_group_path(product_groups, group_uuid)
-    if not path:
-        return '', []  # Возвращаем пустую строку и пустой список UUID
-    
-    names_path, uuid_path = path
-    return ('/'.join(names_path), uuid_path) if not get_uuid else ('/'.join(uuid_path), uuid_path)
-
 def get_sheet_name(products_data):
     # Получаем уникальные названи второго уровня
     level2_names = set()
     for product in products_data:
-        names_by_level = product['names_by_level']
+        names_by_level = product.names_by_level
         if len(names_by_level) > 1:  # Есл есь второй уровень
             level2_names.add(names_by_level[1])
     
@@ -447,19 +452,14 @@ def get_sheet_name(products_data):
     # Если название пустое, используем значение по умолчанию 
     return sheet_name if sheet_name else "Отчет прибльности"
 
-def create_excel_report(data, store_id, start_date, end_date, planning_days, manual_stock_settings=None):
+def calculate_sku_metrics(data, store_id, end_date):
+    """
+    Рассчитывает скорость продаж позиций отчета прибыльности.
+    Возвращает показатели (SkuMetrics) позиций с ненулевой скоростью в исходном порядке.
+    """
     try:
-        print("Начало создания Excel отчета")
-        print(f"Полученные настройки минимальных остатков: {manual_stock_settings}")  # Для отладки
-        
-        wb = Workbook()
-        ws = wb.active
-        
-        product_groups = get_product_groups()
-        products_data = []
-        max_depth = 0
-        
-        # Сначала собираем все данные и определяем максимальную глубину
+        # Сначала отбираем позиции, для которых нужно рассчитать скорость продаж
+        sales_items = []
         for item in data['rows']:
             check_if_cancelled()
             assortment = item.get('assortment', {})
@@ -470,29 +470,80 @@ def create_excel_report(data, store_id, start_date, end_date, planning_days, man
             variant_id = assortment_href.split('/variant/')[-1] if is_variant else assortment_href.split('/product/')[-1]
             
             if variant_id:
-                sales_speed, group_uuid, group_name, product_uuid, product_href = get_sales_speed(variant_id, store_id, end_date, is_variant)
-                if sales_speed != 0:
-                    full_path, uuid_path = get_group_path(group_uuid, product_groups)
-                    max_depth = max(max_depth, len(uuid_path))  # Используем длину списа UUID
-                    
-                    products_data.append({
-                        'name': assortment.get('name', ''),
-                        'quantity': item.get('sellQuantity', 0),
-                        'profit': round(item.get('profit', 0) / 100, 2),
-                        'sales_speed': sales_speed,
-                        'forecast': sales_speed * planning_days,
-                        'group_uuid': group_uuid,
-                        'group_path': full_path,
-                        'uuid_path': uuid_path,  # Сохраняем список UUID для правильного определения уровней
-                        'names_by_level': get_names_by_uuid(uuid_path, product_groups),
-                        'product_uuid': product_uuid,
-                        'product_href': product_href
-                    })
+                sales_items.append((item, variant_id, is_variant))
+        
+        # Запрашиваем скорость продаж параллельно, результаты приходят в исходном порядке
+        sales_results = run_ordered(
+            lambda sales_item: get_sales_speed(sales_item[1], store_id, end_date, sales_item[2]),
+            sales_items,
+            max_workers=SALES_SPEED_WORKERS,
+            is_cancelled=lambda: processing_cancelled
+        )
+        if sales_results is None:
+            raise Exception("Processing cancelled by user")
+        
+        sku_metrics = []
+        for (item, variant_id, is_variant), result in zip(sales_items, sales_results):
+            assortment = item.get('assortment', {})
+            sales_speed, group_uuid, group_name, product_uuid, product_href = result
+            if sales_speed != 0:
+                sku_metrics.append(SkuMetrics(
+                    name=assortment.get('name', ''),
+                    quantity=item.get('sellQuantity', 0),
+                    profit=round(item.get('profit', 0) / 100, 2),
+                    sales_speed=sales_speed,
+                    group_uuid=group_uuid,
+                    product_uuid=product_uuid,
+                    product_href=product_href
+                ))
+        return sku_metrics
+        
+    except Exception as e:
+        if str(e) == "Processing cancelled by user":
+            abort(499, description="Processing cancelled by user")
+        raise e
+
+def create_excel_report(sku_metrics, store_id, start_date, end_date, planning_days, manual_stock_by_group=None):
+    """
+    manual_stock_by_group - ручные минимальные остатки групп (parse_manual_stock_settings);
+    значение группы действует и на все ее подгруппы.
+    """
+    try:
+        print("Начало создания Excel отчета")
+        print(f"Полученные настройки минимальных остатков: {manual_stock_by_group}")  # Для отладки
+        
+        wb = Workbook()
+        ws = wb.active
+        
+        group_index = get_group_index()
+        # Минимальный остаток для каждой группы с учетом настроек ее предков, один раз на отчет
+        manual_min_stock = inherit_max_values(manual_stock_by_group, group_index)
+        products_data = []
+        max_depth = 0
+        
+        # Собираем все данные и определяем максимальную глубину; прогноз зависит от периода планирования
+        for metrics in sku_metrics:
+            full_path, uuid_path = get_group_path(metrics.group_uuid, group_index)
+            max_depth = max(max_depth, len(uuid_path))  # Используем длину списа UUID
+            
+            products_data.append(ProductRow(
+                name=metrics.name,
+                quantity=metrics.quantity,
+                profit=metrics.profit,
+                sales_speed=metrics.sales_speed,
+                forecast=metrics.sales_speed * planning_days,
+                group_uuid=metrics.group_uuid,
+                group_path=full_path,
+                uuid_path=uuid_path,  # Сохраняем список UUID для правильного определения уровней
+                names_by_level=get_names_by_uuid(uuid_path, group_index),
+                product_uuid=metrics.product_uuid,
+                product_href=metrics.product_href
+            ))
 
         print(f"Максимальная глубина групп: {max_depth}")
 
         # Сортируем данные по полному пути групп по возрастанию
-        products_data.sort(key=lambda x: x['group_path'])
+        products_data.sort(key=lambda x: x.group_path)
 
         # Формируем заголовк с учетом реальной глубины, начиная со вворого уровня
         group_level_headers = [f'Уровень {i+2}' for i in range(max_depth-1)] if max_depth > 1 else []
@@ -511,67 +562,46 @@ def create_excel_report(data, store_id, start_date, end_date, planning_days, man
         # Записываем данные с группами
         current_row = 2
         current_uuid_path = []
+        outline = OutlineTracker()  # Уровни группировки строк вычисляем сразу при записи
         
-        def get_manual_stock_value(uuid_path):
-            if not manual_stock_settings:
-                return None
-                
-            try:
-                manual_settings = json.loads(manual_stock_settings)
-                print(f"Разобранные настройки: {manual_settings}")  # Для отладки
-                max_stock = None
-                
-                # Проверяем каждую группу в пути товара
-                for group_uuid in uuid_path:
-                    for setting in manual_settings:
-                        if setting['group_id'] == group_uuid:
-                            setting_value = int(setting['min_stock'])
-                            print(f"Найдено значение {setting_value} для гуппы {group_uuid}")  # Для отладки
-                            # Сохраняем максимальное значение из всех подходящих групп
-                            if max_stock is None or setting_value > max_stock:
-                                max_stock = setting_value
-                
-                return max_stock
-            except Exception as e:
-                print(f"Ошибка при обработке настроек минимальных остатков: {str(e)}")
-                return None
-
         # При записи данных продукта
         for product in products_data:
-            uuid_path = product['uuid_path']
-            names_by_level = product['names_by_level']
+            uuid_path = product.uuid_path
+            names_by_level = product.names_by_level
             
             # Записываем строки групп, если путь изменился
             for i, uuid in enumerate(uuid_path):
                 if i >= len(current_uuid_path) or uuid != current_uuid_path[i]:
                     if i > 0:
+                        outline.add_group_row(current_row, i)
                         ws.cell(row=current_row, column=i, value=names_by_level[i])
+                    else:
+                        outline.add_row(current_row)
                     # Записываем UUID группы полностью
                     uuid_cell = ws.cell(row=current_row, column=max_depth, value=uuid)
                     uuid_cell.alignment = Alignment(horizontal='left', shrink_to_fit=False)
                     current_row += 1
             
             # При запис UUID товара
+            outline.add_row(current_row, has_uuid=bool(product.product_href))
             uuid_cell = ws.cell(row=current_row, column=max_depth)
-            if product['product_href']:
-                uuid_cell.value = product['product_uuid']  # Записываем полный UUID
-                uuid_cell.hyperlink = product['product_href']
+            if product.product_href:
+                uuid_cell.value = product.product_uuid  # Записываем полный UUID
+                uuid_cell.hyperlink = product.product_href
                 uuid_cell.font = Font(color="0000FF", underline="single")
                 uuid_cell.alignment = Alignment(horizontal='left', shrink_to_fit=False)
             
-            ws.cell(row=current_row, column=max_depth+1, value=product['name'])
-            ws.cell(row=current_row, column=max_depth+2, value=product['quantity'])
-            ws.cell(row=current_row, column=max_depth+3, value=product['profit'])
-            ws.cell(row=current_row, column=max_depth+4, value=product['sales_speed'])
-            ws.cell(row=current_row, column=max_depth+5, value=product['forecast'])
+            ws.cell(row=current_row, column=max_depth+1, value=product.name)
+            ws.cell(row=current_row, column=max_depth+2, value=product.quantity)
+            ws.cell(row=current_row, column=max_depth+3, value=product.profit)
+            ws.cell(row=current_row, column=max_depth+4, value=product.sales_speed)
+            ws.cell(row=current_row, column=max_depth+5, value=product.forecast)
             
             # Вычисляем автоматический минимальный остаток (округление вверх прогноза)
-            auto_min_stock = math.ceil(product['forecast'])
+            auto_min_stock = math.ceil(product.forecast)
             
-            # Получаем ручное значение минимального остатка для всей иерархии групп товара
-            manual_stock = get_manual_stock_value(product['uuid_path'])
-            # print(f"manual_stock: {manual_stock}")
-            # print(f"manual_stock_settings: {manual_stock_settings}")
+            # Ручное значение минимального остатка для всей иерархии групп товара
+            manual_stock = manual_min_stock.get(product.group_uuid)
             
             # Если есть ручное значение, сравниваем его с автоматическим и берем большее
             min_stock_value = auto_min_stock  # По умолчанию используем автоматическое значение
@@ -601,49 +631,8 @@ def create_excel_report(data, store_id, start_date, end_date, planning_days, man
         # После записи всех данных и перед форматированием добавляем группировку
         ws.sheet_properties.outlinePr.summaryBelow = False  # Устанавливаем кнопку группировки сверху
 
-        # Функция для определения диапазонов групп
-        def find_groups(ws, start_row, end_row, max_depth):
-            groups = []  # [(start_row, end_row, level, group_name)]
-            
-            # Проходим по каждой строке
-            for row in range(start_row, end_row + 1):
-                # Проверяем каждый уровень
-                for level in range(1, max_depth + 1):
-                    value = ws.cell(row=row, column=level).value
-                    if value is not None:
-                        # Находим конец группы (последнюю строку перед следующей группой того же или более высокого уровня)
-                        end_group_row = row
-                        for next_row in range(row + 1, end_row + 1):
-                            # Проверяем, не началась ли новая группа того же или более высокого уровня
-                            found_higher_level = False
-                            for check_level in range(1, level + 1):
-                                if ws.cell(row=next_row, column=check_level).value is not None:
-                                    found_higher_level = True
-                                    break
-                            if found_higher_level:
-                                end_group_row = next_row - 1
-                                break
-                            end_group_row = next_row
-                        
-                        groups.append((row, end_group_row, level, value))
-            
-            return groups
-
-        # Находим все группы
-        groups = find_groups(ws, 2, current_row - 1, max_depth)
-
-        # Сортируем групп по уровню (от большего к меньшему)
-        # и по позиции (сверху низ)
-        groups.sort(key=lambda x: (-x[2], x[0]))
-
-        # Применяем группировку
-        for start_row, end_row, level, group_name in groups:
-            if start_row < end_row:  # Группируем если есть что группировать
-                # Группируем все строки под группой
-                for row in range(start_row + 1, end_row + 1):
-                    current_level = ws.row_dimensions[row].outline_level
-                    ws.row_dimensions[row].outline_level = current_level + 1 if current_level is not None else 1
-                    ws.row_dimensions[row].hidden = False
+        # Применяем группировку, вычисленную при записи строк
+        outline.apply(ws)
 
         # Отключаем группировку для заголовка
         ws.row_dimensions[1].outline_level = 0
@@ -705,19 +694,6 @@ def create_excel_report(data, store_id, start_date, end_date, planning_days, man
         except:
             pass
 
-def get_names_by_uuid(uuid_path, product_groups):
-    def find_name_by_uuid(groups, target_uuid):
-        for group in groups:
-            if group['id'] == target_uuid:
-                return group['name']
-            if group.get('children'):
-                name = find_name_by_uuid(group['children'], target_uuid)
-                if name:
-                    return name
-        return None
-
-    return [find_name_by_uuid(product_groups, uuid) or '' for uuid in uuid_path]
-
 @app.route('/download/<filename>')
 def download_file(filename):
     try:
@@ -727,4 +703,6 @@ def download_file(filename):
 
 if __name__ == '__main__':
     print("Starting Flask app...")
+    stores_cache.warm()
+    product_groups_cache.warm()
     app.run(debug=True, port=5000)
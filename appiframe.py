@@ -2,40 +2,72 @@ import os
 from flask import Flask, render_template, request, send_file, jsonify, abort, Response
 from markupsafe import Markup
 import requests
-from openpyxl import Workbook
+from moysklad_client import MoySkladClient, RequestCancelled
 from openpyxl.worksheet.table import Table, TableStyleInfo
-from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
-from openpyxl.utils import get_column_letter
 from openpyxl.worksheet.hyperlink import Hyperlink
 from datetime import datetime, timedelta
 import json
-import threading
+import shutil
+import tempfile
+import zipfile
 import math
-from time import sleep, time
-from openpyxl.styles.colors import Color
-from copy import copy
+from time import time
+from worker_pool import run_ordered
+from catalog_cache import CatalogCache, KeyedCache
+from group_index import build_group_index, get_group_path, get_names_by_uuid
+from group_aggregation import DEFAULT_METRICS, aggregate_groups
+from report_sheets import (
+    create_report_workbook, build_report_rows, make_sheet_title,
+    write_analysis_sheet, write_groups_sheet, write_info_sheet
+)
+from turnover_cache import TurnoverCache, get_assortment_key
+from report_jobs import JobQueue, JobContext, JOB_DONE
+from report_records import Operation, ProductRow, SkuMetrics, project_profit_row
+from sales_speed import (
+    SPEED_STRATEGIES, LAST_SALE_LOOKBACK_DAYS, OperationColumns, compute_strategy_speeds, datetime_to_us,
+    get_speed_strategies, get_window_start_us, last_sale_interval_speeds, us_to_datetime
+)
 
 app = Flask(__name__)
 
+# Настройки по умолчанию (могут быть переопределены в config.py)
+TURNOVER_BATCH_MODE = True  # Загружать обороты по всему складу постранично вместо запроса на каждую позицию
+TURNOVER_CACHE_PATH = 'turnover_cache.sqlite3'  # Локальный кэш операций склада (None - отключить); относительный путь - от каталога приложения
+TURNOVER_CACHE_REFRESH_DAYS = 14  # Сколько последних дней кэша операций перечитывать при каждом отчете
+TURNOVER_CACHE_MAX_AGE = 7 * 24 * 3600  # Через сколько секунд кэш операций склада загружается заново
+TURNOVER_CACHE_MAX_STORES = 50  # Операции скольких складов хранить в кэше
+CATALOG_CACHE_TTL = 600  # Время жизни кэша групп товаров и складов в секундах
+BUNDLE_CACHE_TTL = 3600  # Время жизни кэша состава комплектов в секундах
+REPORT_METRICS_CACHE_TTL = 1800  # Сколько секунд хранить рассчитанные показатели позиций отчета
+REPORT_METRICS_CACHE_SIZE = 8  # Сколько наборов показателей (склад, период, группы) хранить одновременно
+SALES_SPEED_WORKERS = 5  # Количество параллельных запросов при расчете скорости продаж по позициям
+SALES_SPEED_STRATEGIES = ()  # Дополнительные столбцы скорости продаж ('on_stock', 'fifo', 'v2'); форма - поле speed_strategies
+EXCEL_WRITE_ONLY = False  # Потоковая запись отчета (write_only): память не растет с числом строк
+REPORT_JOB_WORKERS = 2  # Количество отчетов, формируемых одновременно в фоне
+REPORT_JOB_TTL = 3600  # Сколько секунд хранить завершенные задачи отчетов
+BATCH_STORE_WORKERS = 3  # Сколько складов пакетного отчета обрабатывается одновременно
+STATUS_HEARTBEAT_INTERVAL = 15  # Интервал heartbeat в /status-stream, если прогресс не меняется, сек
+
 # Загрузка конфигурации так же, как в основном приложении
 with open('config.py', 'r') as config_file:
     exec(config_file.read())
 
 BASE_URL = 'https://api.moysklad.ru/api/remap/1.2'
 
-processing_cancelled = False
-processing_lock = threading.Lock()
-
-# Добавим глобальную переменную для хранения статуса
-current_status = {'total': 0, 'processed': 0}
+# Общий клиент API с пулом соединений и повторами запросов
+api_client = MoySkladClient(MOYSKLAD_TOKEN, BASE_URL)
 
-# Добавляем глобальную переменную для хранения времени запросов
-api_request_times = []
+# Кэш операций склада для пакетного расчета скорости продаж
+turnover_cache = TurnoverCache(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), TURNOVER_CACHE_PATH),
+    refresh_days=TURNOVER_CACHE_REFRESH_DAYS,
+    max_age=TURNOVER_CACHE_MAX_AGE,
+    max_stores=TURNOVER_CACHE_MAX_STORES
+) if TURNOVER_CACHE_PATH else None
 
-def check_if_cancelled():
+def check_if_cancelled(context):
     """Проверяет, не была ли отменена обработка отчета"""
-    global processing_cancelled
-    if processing_cancelled:
+    if context.is_cancelled():
         return True
     return False
 
@@ -69,80 +101,236 @@ def iframe():
         render_group_options=render_group_options
     )
 
-# Маршрут для обработки формы через AJAX
-@app.route('/process', methods=['POST'])
-def process():
+def run_report_job(job):
+    """
+    Формирует отчет по параметрам формы задачи в фоновом потоке.
+
+    Returns:
+        str: Имя файла отчета или None, если обработка отменена
+    """
+    form = job.params
+    context = job.context  # Прогресс, отмена и время запросов этой задачи
+    start_date = form['start_date']
+    end_date = form['end_date']
+    store_id = form['store_id']
+    planning_days = int(form['planning_days'])
+    product_groups = get_form_product_groups(form)
+    
+    # Показатели позиций зависят только от склада, периода, групп и алгоритмов скорости;
+    # если они уже рассчитаны, отчет с новыми параметрами планирования только записывается заново
+    strategies = get_speed_strategies(form.get('speed_strategies') or SALES_SPEED_STRATEGIES)
+    metrics_key = get_metrics_key(store_id, start_date, end_date, product_groups, strategies)
+    sku_metrics = report_metrics_cache.get(metrics_key)
+    if sku_metrics is not None:
+        print(f"Показатели {len(sku_metrics)} позиций взяты из кэша, данные не загружаются")
+        return create_excel_report(None, store_id, start_date, end_date, planning_days,
+                                   form=form, context=context, sku_metrics=sku_metrics)
+    
+    # Проверяем отмену перед получением данных
+    if check_if_cancelled(context):
+        return None
+        
     try:
-        global processing_cancelled, current_status, api_request_times
-        with processing_lock:
-            processing_cancelled = False
-            current_status = {'total': 0, 'processed': 0}
-            api_request_times = []  # Сбрасываем список времени запросов
+        report_data = get_report_data(start_date, end_date, store_id, product_groups, context)
+        print("Получены данные отчета:", report_data is not None)
+        if report_data:
+            print(f"Количество строк в отчете: {len(report_data.get('rows', []))}")
+    except Exception as e:
+        print(f"Ошибка при получении данных отчета: {str(e)}")
+        raise
+    
+    # Проверяем отмену после получения данных (при отмене get_report_data возвращает None)
+    if check_if_cancelled(context):
+        return None
+    
+    if not report_data or 'rows' not in report_data or not report_data['rows']:
+        raise Exception('Нет данных для формирования отчета')
         
-        start_date = request.form['start_date']
-        end_date = request.form['end_date']
-        store_id = request.form['store_id']
-        planning_days = int(request.form['planning_days'])
+    total_items = count_sales_items(report_data)
+    print(f"Всего позиций для обработки: {total_items}")
+    
+    context.start_progress(total_items)
+    
+    sku_metrics = calculate_sku_metrics(report_data, store_id, start_date, end_date, strategies, context)
+    if sku_metrics is None:
+        return None
+    report_metrics_cache.set(metrics_key, sku_metrics)
+    
+    return create_excel_report(report_data, store_id, start_date, end_date, planning_days,
+                               form=form, context=context, sku_metrics=sku_metrics)
+
+def run_batch_report_job(job):
+    """
+    Формирует отчеты по нескольким складам (поле store_ids) одной задачей.
+    
+    Справочники, состав комплектов, кэш оборотов и показатели позиций общие для
+    всех складов, склады обрабатываются параллельно (BATCH_STORE_WORKERS), а их
+    запросы проходят через общий ограничитель темпа api_client.
+    
+    Returns:
+        str: zip-архив с книгой на каждый склад (batch_output=files) или книга
+            с листом анализа на каждый склад (batch_output=sheets); None, если обработка отменена
+    """
+    form = job.params
+    context = job.context
+    start_date = form['start_date']
+    end_date = form['end_date']
+    planning_days = int(form['planning_days'])
+    store_ids = get_batch_store_ids(form)
+    product_groups = get_form_product_groups(form)
+    strategies = get_speed_strategies(form.get('speed_strategies') or SALES_SPEED_STRATEGIES)
+    print(f"Пакетный отчет по {len(store_ids)} складам")
+    
+    # Рассчитанные ранее показатели берем из кэша, для остальных складов загружаем данные
+    metrics_by_store = {}
+    for store_id in store_ids:
+        sku_metrics = report_metrics_cache.get(
+            get_metrics_key(store_id, start_date, end_date, product_groups, strategies)
+        )
+        if sku_metrics is not None:
+            metrics_by_store[store_id] = sku_metrics
+    missing_store_ids = [store_id for store_id in store_ids if store_id not in metrics_by_store]
+    print(f"Показатели из кэша: {len(metrics_by_store)} складов, рассчитываются: {len(missing_store_ids)}")
+    
+    if missing_store_ids:
+        reports = run_ordered(
+            lambda store_id: get_report_data(start_date, end_date, store_id, product_groups, context),
+            missing_store_ids,
+            max_workers=BATCH_STORE_WORKERS,
+            is_cancelled=context.is_cancelled
+        )
+        if reports is None or check_if_cancelled(context):
+            return None
         
-        product_groups = []
-        if 'final_product_groups' in request.form:
-            raw_groups = request.form.get('final_product_groups', '')
-            if raw_groups:
-                product_groups = [group.strip() for group in raw_groups.split(',') if group.strip()]
-            print(f"Обработанные группы: {product_groups}")
+        # Прогресс считается по позициям всех складов
+        context.start_progress(sum(count_sales_items(report_data) for report_data in reports if report_data))
         
-        # Проверяем отмену перед получением данных
-        if check_if_cancelled():
-            return jsonify({'cancelled': True}), 200
-            
-        try:
-            report_data = get_report_data(start_date, end_date, store_id, product_groups)
-            print("Получены данные отчета:", report_data is not None)
-            if report_data:
-                print(f"Количество строк в отчете: {len(report_data.get('rows', []))}")
-        except Exception as e:
-            print(f"Ошибка при получении данных отчета: {str(e)}")
-            import traceback
-            print("Полный стек ошибки:")
-            print(traceback.format_exc())
-            return jsonify({'error': str(e)}), 500
-        
-        if not report_data or 'rows' not in report_data or not report_data['rows']:
-            return jsonify({'error': 'Нет данных для формирования отчета'}), 404
+        def calculate_store_metrics(store_report):
+            store_id, report_data = store_report
+            if not report_data or not report_data.get('rows'):
+                print(f"Нет данных для склада {store_id}")
+                return []
+            return calculate_sku_metrics(report_data, store_id, start_date, end_date, strategies, context)
         
-        # Проверяем отмену после получения данных
-        if check_if_cancelled():
-            return jsonify({'cancelled': True}), 200
-            
+        store_metrics = run_ordered(
+            calculate_store_metrics, list(zip(missing_store_ids, reports)),
+            max_workers=BATCH_STORE_WORKERS,
+            is_cancelled=context.is_cancelled
+        )
+        if store_metrics is None or any(sku_metrics is None for sku_metrics in store_metrics):
+            return None
+        
+        for store_id, report_data, sku_metrics in zip(missing_store_ids, reports, store_metrics):
+            metrics_by_store[store_id] = sku_metrics
+            if report_data and report_data.get('rows'):
+                report_metrics_cache.set(
+                    get_metrics_key(store_id, start_date, end_date, product_groups, strategies), sku_metrics
+                )
+    
+    if check_if_cancelled(context):
+        return None
+    
+    if form.get('batch_output', BATCH_OUTPUT_FILES) == BATCH_OUTPUT_SHEETS:
+        return create_multi_store_report(store_ids, metrics_by_store, start_date, end_date, planning_days,
+                                         form, context)
+    
+    # Книга на каждый склад; книги упаковываются в один архив для скачивания.
+    # Книги и архив собираются в отдельном каталоге задачи: имена книг совпадают
+    # с именами одиночных отчетов, которые другая задача может еще отдавать
+    selected_groups, group_name_for_file = get_selected_group_paths(form)
+    archive_name = truncate_filename(
+        f"{format_period(start_date, end_date)} - {len(store_ids)} складов - {group_name_for_file}.zip"
+    )
+    work_dir = tempfile.mkdtemp(prefix=f'batch-{job.id}-')
+    try:
+        archive_path = os.path.join(work_dir, archive_name)
+        with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive_names = set()
+            for store_id in store_ids:
+                filename = create_excel_report(None, store_id, start_date, end_date, planning_days,
+                                               form=form, context=context, sku_metrics=metrics_by_store[store_id],
+                                               output_dir=work_dir)
+                if filename is None:
+                    return None
+                # Склады с одинаковыми названиями дают одинаковые имена файлов
+                name, extension = os.path.splitext(filename)
+                archive_filename = filename
+                number = 2
+                while archive_filename in archive_names:
+                    archive_filename = f"{name} ({number}){extension}"
+                    number += 1
+                archive_names.add(archive_filename)
+                archive.write(os.path.join(work_dir, filename), archive_filename)
+                os.remove(os.path.join(work_dir, filename))
+        
+        if check_if_cancelled(context):
+            return None
+        # Готовый архив переносится в каталог отчетов целиком, недописанный файл не будет отдан
+        shutil.move(archive_path, archive_name)
+        return archive_name
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def get_form_product_groups(form):
+    """UUID выбранных групп товаров из поля final_product_groups"""
+    product_groups = []
+    if 'final_product_groups' in form:
+        raw_groups = form.get('final_product_groups', '')
+        if raw_groups:
+            product_groups = [group.strip() for group in raw_groups.split(',') if group.strip()]
+        print(f"Обработанные группы: {product_groups}")
+    return product_groups
+
+def get_batch_store_ids(form):
+    """UUID складов пакетного отчета: поля store_ids (несколько значений или через запятую) без повторов"""
+    store_ids = []
+    for value in form.getlist('store_ids'):
+        for store_id in value.split(','):
+            store_id = store_id.strip()
+            if store_id and store_id not in store_ids:
+                store_ids.append(store_id)
+    return store_ids
+
+def get_metrics_key(store_id, start_date, end_date, product_groups, strategies):
+    """Ключ показателей позиций в report_metrics_cache"""
+    return (store_id, start_date, end_date, tuple(product_groups),
+            tuple(strategy.name for strategy in strategies))
+
+def count_sales_items(report_data):
+    """Количество позиций отчета прибыльности с продажами (товары и модификации)"""
+    return sum(1 for item in report_data['rows']
+               if item.get('sellQuantity', 0) > 0
+               and ('/variant/' in item.get('assortment', {}).get('meta', {}).get('href', '')
+                    or '/product/' in item.get('assortment', {}).get('meta', {}).get('href', '')))
+
+# Очередь фоновых задач формирования отчетов
+job_queue = JobQueue(run_report_job, max_workers=REPORT_JOB_WORKERS, ttl=REPORT_JOB_TTL)
+
+# Варианты результата пакетного отчета по нескольким складам
+BATCH_OUTPUT_FILES = 'files'  # zip-архив с книгой на каждый склад
+BATCH_OUTPUT_SHEETS = 'sheets'  # Одна книга с листом анализа на каждый склад
+BATCH_OUTPUTS = (BATCH_OUTPUT_FILES, BATCH_OUTPUT_SHEETS)
+
+# Маршрут для обработки формы через AJAX: ставит отчет в очередь и сразу возвращает id задачи
+@app.route('/process', methods=['POST'])
+def process():
+    try:
+        for field in ('start_date', 'end_date', 'store_id', 'planning_days'):
+            if not request.form.get(field):
+                return jsonify({'error': f'Не заполнено поле {field}'}), 400
         try:
-            # Считаем только позиции с продажами и вариантами
-            total_items = sum(1 for item in report_data['rows'] 
-                            if item.get('sellQuantity', 0) > 0 
-                            and ('/variant/' in item.get('assortment', {}).get('meta', {}).get('href', '') 
-                                or '/product/' in item.get('assortment', {}).get('meta', {}).get('href', '')))
-            
-            print(f"Всего позиций для обработки: {total_items}")
-            
-            with processing_lock:
-                current_status['total'] = total_items
-                current_status['processed'] = 0
-            
-            excel_file = create_excel_report(report_data, store_id, start_date, end_date, planning_days)
-            
-            if excel_file is None:
-                return jsonify({'cancelled': True}), 200
-                
-            return jsonify({
-                'success': True,
-                'file_url': f'/download/{excel_file}'
-            })
-            
-        except Exception as e:
-            print(f"Ошибка при обработке данных: {str(e)}")
-            import traceback
-            print("Полный стек ошибки:")
-            print(traceback.format_exc())
-            return jsonify({'error': str(e)}), 500
+            get_speed_strategies(request.form.get('speed_strategies') or SALES_SPEED_STRATEGIES)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        # Копия формы нужна задаче после завершения запроса
+        job = job_queue.submit(request.form.copy())
+        print(f"Задача {job.id} поставлена в очередь")
+        return jsonify({
+            'job_id': job.id,
+            'status': job.status,
+            'status_url': f'/jobs/{job.id}'
+        }), 202
             
     except Exception as e:
         print(f"Общая ошибка в process: {str(e)}")
@@ -151,6 +339,53 @@ def process():
         print(traceback.format_exc())
         return jsonify({'error': str(e)}), 500
 
+# Пакетный отчет по нескольким складам: одна задача в той же очереди, статус и отмена - как у /process
+@app.route('/process_batch', methods=['POST'])
+def process_batch():
+    try:
+        for field in ('start_date', 'end_date', 'planning_days'):
+            if not request.form.get(field):
+                return jsonify({'error': f'Не заполнено поле {field}'}), 400
+        if not get_batch_store_ids(request.form):
+            return jsonify({'error': 'Не выбраны склады (поле store_ids)'}), 400
+        batch_output = request.form.get('batch_output', BATCH_OUTPUT_FILES)
+        if batch_output not in BATCH_OUTPUTS:
+            return jsonify({'error': f"Неизвестный вид результата batch_output: {batch_output}"}), 400
+        try:
+            get_speed_strategies(request.form.get('speed_strategies') or SALES_SPEED_STRATEGIES)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        job = job_queue.submit(request.form.copy(), runner=run_batch_report_job)
+        print(f"Пакетная задача {job.id} поставлена в очередь")
+        return jsonify({
+            'job_id': job.id,
+            'status': job.status,
+            'status_url': f'/jobs/{job.id}'
+        }), 202
+            
+    except Exception as e:
+        print(f"Общая ошибка в process_batch: {str(e)}")
+        import traceback
+        print("Полный стек ошибки:")
+        print(traceback.format_exc())
+        return jsonify({'error': str(e)}), 500
+
+# Состояние задачи формирования отчета и ссылка на файл после завершения
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Задача не найдена'}), 404
+    return jsonify(get_job_status(job))
+
+def get_job_status(job):
+    """Состояние задачи для клиента, со ссылкой на файл после успешного завершения"""
+    status = job.to_dict()
+    if job.status == JOB_DONE:
+        status['file_url'] = f'/download/{job.result}'
+    return status
+
 # Добавляем новый маршрут для создания Excel-файла
 @app.route('/create_excel', methods=['POST'])
 def create_excel():
@@ -165,7 +400,7 @@ def create_excel():
         if not report_data or 'rows' not in report_data:
             return jsonify({'error': 'Нет данных для формирования отчета'}), 404
             
-        excel_file = create_excel_report(report_data, store_id, start_date, end_date, planning_days)
+        excel_file = create_excel_report(report_data, store_id, start_date, end_date, planning_days, form=request.form)
         
         if excel_file is None:
             return jsonify({'cancelled': True}), 200
@@ -182,6 +417,33 @@ def create_excel():
         print(traceback.format_exc())
         return jsonify({'error': str(e)}), 500
 
+# Сброс кэша справочников (группы товаров и склады обновятся в фоне)
+@app.route('/cache/invalidate', methods=['POST'])
+def invalidate_cache():
+    stores_cache.invalidate()
+    product_groups_cache.invalidate()
+    report_metrics_cache.invalidate()
+    if turnover_cache is not None:
+        turnover_cache.clear()
+    return jsonify({'status': 'invalidated'})
+
+# Статистика запросов к API: по задаче job_id или общая за время работы процесса
+@app.route('/api-stats')
+def api_stats():
+    job_id = request.args.get('job_id')
+    if job_id:
+        job = job_queue.get(job_id)
+        if job is None:
+            return jsonify({'error': 'Задача не найдена'}), 404
+        return jsonify({
+            'endpoints': job.context.api_stats.get(),
+            'rate_limiter': job.context.api_stats.get_throttling()
+        })
+    return jsonify({
+        'endpoints': api_client.get_stats(),
+        'rate_limiter': api_client.rate_limiter.get_stats()
+    })
+
 # Маршрут для скачивания файла
 @app.route('/download/<filename>')
 def download_file(filename):
@@ -194,7 +456,8 @@ def download_file(filename):
 # Здесь идут все остальные функции из app.py без изменений:
 # get_stores(), get_product_groups(), get_report_data() и т.д.
 
-# Создадим новый маршрут для встраивания iframe
+# Создадим новый маршрут для встраивания iframe.
+# Прогресс, остановку и скачивание отчета показывает сама страница /iframe по job_id задачи
 @app.route('/embed')
 def embed():
     return """
@@ -214,222 +477,10 @@ def embed():
                 height: 100%;
                 border: none;
             }
-            .overlay {
-                display: none;
-                position: fixed;
-                top: 0;
-                left: 0;
-                width: 100%;
-                height: 100%;
-                background: rgba(255, 255, 255, 0.4);
-                z-index: 999;
-            }
-            .status-box {
-                position: fixed;
-                top: 50%;
-                left: 50%;
-                transform: translate(-50%, -50%);
-                background: white;
-                padding: 20px 30px;
-                border-radius: 8px;
-                box-shadow: 0 2px 10px rgba(0, 0, 0, 0.1);
-                z-index: 1000;
-                text-align: center;
-                min-width: 300px;
-            }
-            .status-box h3 {
-                margin: 0 0 15px 0;
-                font-size: 18px;
-                color: #333;
-            }
-            .status-box.hidden {
-                display: none;
-            }
-            .stop-button {
-                margin-top: 20px;
-                padding: 8px 20px;
-                background-color: #dc3545;
-                color: white;
-                border: none;
-                border-radius: 4px;
-                cursor: pointer;
-                font-size: 14px;
-                transition: background-color 0.2s;
-            }
-            .stop-button:hover {
-                background-color: #c82333;
-            }
-            .confirm-modal {
-                display: none;
-                position: fixed;
-                top: 50%;
-                left: 50%;
-                transform: translate(-50%, -50%);
-                background: white;
-                padding: 25px;
-                border-radius: 8px;
-                box-shadow: 0 2px 15px rgba(0, 0, 0, 0.2);
-                z-index: 1001;
-                text-align: center;
-                min-width: 300px;
-            }
-            .confirm-modal p {
-                margin: 0 0 20px 0;
-                font-size: 16px;
-                color: #333;
-            }
-            .confirm-modal-buttons {
-                display: flex;
-                justify-content: center;
-                gap: 15px;
-            }
-            .confirm-yes {
-                padding: 8px 20px;
-                background-color: #dc3545;
-                color: white;
-                border: none;
-                border-radius: 4px;
-                cursor: pointer;
-                font-size: 14px;
-                transition: background-color 0.2s;
-            }
-            .confirm-no {
-                padding: 8px 20px;
-                background-color: #6c757d;
-                color: white;
-                border: none;
-                border-radius: 4px;
-                cursor: pointer;
-                font-size: 14px;
-                transition: background-color 0.2s;
-            }
-            .confirm-yes:hover {
-                background-color: #c82333;
-            }
-            .confirm-no:hover {
-                background-color: #5a6268;
-            }
         </style>
     </head>
     <body>
-        <div id="overlay" class="overlay"></div>
-        <div id="statusBox" class="status-box hidden">
-            <h3>Формирование отчета</h3>
-            <div>Осталось обработать позиций: <span id="remainingItems">...</span></div>
-            <div style="margin-top: 10px;">Осталось менее: <span id="remainingTime">...</span></div>
-            <button class="stop-button" onclick="showConfirmModal()">Остановить</button>
-        </div>
-        <div id="confirmModal" class="confirm-modal">
-            <p>Точно остановить формирование отчета?</p>
-            <div class="confirm-modal-buttons">
-                <button class="confirm-yes" onclick="confirmStop()">Да, остановить</button>
-                <button class="confirm-no" onclick="hideConfirmModal()">Нет, продолжить формирование отчета</button>
-            </div>
-        </div>
         <iframe src="/iframe" allowfullscreen></iframe>
-        <script>
-            const overlay = document.getElementById('overlay');
-            const statusBox = document.getElementById('statusBox');
-            const confirmModal = document.getElementById('confirmModal');
-            const remainingItems = document.getElementById('remainingItems');
-            const remainingTime = document.getElementById('remainingTime');
-            let currentEventSource = null;
-            
-            function showConfirmModal() {
-                confirmModal.style.display = 'block';
-            }
-            
-            function hideConfirmModal() {
-                confirmModal.style.display = 'none';
-            }
-            
-            function confirmStop() {
-                hideConfirmModal();
-                stopProcessing();
-            }
-            
-            function stopProcessing() {
-                fetch('/cancel', { method: 'POST' })
-                    .then(() => {
-                        if (currentEventSource) {
-                            currentEventSource.close();
-                        }
-                        overlay.style.display = 'none';
-                        statusBox.classList.add('hidden');
-                    });
-            }
-            
-            // Слушаем сообщения от основного окна
-            window.addEventListener('message', function(event) {
-                if (event.data === 'startProcessing') {
-                    // Показываем оверлей и статус-бокс
-                    overlay.style.display = 'block';
-                    statusBox.classList.remove('hidden');
-                    startEventSource();
-                }
-            });
-
-            function startEventSource() {
-                if (currentEventSource) {
-                    currentEventSource.close();
-                }
-                currentEventSource = new EventSource('/status-stream');
-                currentEventSource.onmessage = function(event) {
-                    const remaining = event.data;
-                    if (remaining === '...') {
-                        remainingItems.textContent = '...';
-                        remainingTime.textContent = '...';
-                    } else {
-                        const remainingNum = parseInt(remaining);
-                        if (remainingNum > 0) {
-                            remainingItems.textContent = remainingNum;
-                            
-                            // Получаем значение search_days из iframe
-                            const iframe = document.querySelector('iframe');
-                            const searchDays = parseInt(iframe.contentWindow.document.getElementById('search_days').value) || 300;
-                            
-                            // Рассчитываем время на одну позицию в зависимости от количества дней
-                            let timePerItem;
-                            if (searchDays <= 300) {
-                                timePerItem = 1.4; // базовое время для 300 дней
-                            } else if (searchDays <= 365) {
-                                // Для диапазона 300-365 дней: ~0.0062 сек/день
-                                timePerItem = 1.4 + ((searchDays - 300) * 0.0062);
-                            } else {
-                                // Для диапазона более 365 дней: первые 65 дней по 0.0062 сек/день, остальные по 0.0025 сек/день
-                                timePerItem = 1.4 + (65 * 0.0062) + ((searchDays - 365) * 0.0025);
-                            }
-                            
-                            // Для меньшего количества дней пропорционально уменьшаем время
-                            if (searchDays < 300) {
-                                timePerItem = (timePerItem * searchDays) / 300;
-                            }
-                            
-                            const totalSeconds = Math.ceil(remainingNum * timePerItem);
-                            
-                            if (totalSeconds <= 0) {
-                                remainingTime.textContent = '0 сек';
-                            } else {
-                                const hours = Math.floor(totalSeconds / 3600);
-                                const minutes = Math.floor((totalSeconds % 3600) / 60);
-                                const seconds = totalSeconds % 60;
-                                
-                                let timeString = '';
-                                if (hours > 0) timeString += hours + ' ч ';
-                                if (minutes > 0) timeString += minutes + ' мин ';
-                                if (seconds > 0 || timeString === '') timeString += seconds + ' сек';
-                                
-                                remainingTime.textContent = timeString.trim();
-                            }
-                        } else {
-                            overlay.style.display = 'none';
-                            statusBox.classList.add('hidden');
-                            currentEventSource.close();
-                        }
-                    }
-                };
-            }
-        </script>
     </body>
     </html>
     """
@@ -469,14 +520,10 @@ def render_group_options(groups, level=0):
     return '\n'.join(result)
 
 # Добавляем функцию get_stores из app.py
-def get_stores():
+def fetch_stores():
     url = f"{BASE_URL}/entity/store"
-    headers = {
-        'Authorization': f'Bearer {MOYSKLAD_TOKEN}',
-        'Accept': 'application/json;charset=utf-8'
-    }
     
-    response = requests.get(url, headers=headers)
+    response = api_client.get(url)
     if response.status_code == 200:
         stores = response.json()['rows']
         return [{'id': store['id'], 'name': store['name']} for store in stores]
@@ -486,12 +533,8 @@ def get_stores():
         raise Exception(error_message)
 
 # Добавляем функцию get_product_groups из app.py
-def get_product_groups():
+def fetch_product_groups():
     url = f"{BASE_URL}/entity/productfolder"
-    headers = {
-        'Authorization': f'Bearer {MOYSKLAD_TOKEN}',
-        'Accept': 'application/json;charset=utf-8'
-    }
     
     all_groups = []
     offset = 0
@@ -505,7 +548,7 @@ def get_product_groups():
             'expand': 'productFolder'  # Добавляем expand для получения полной информации о родительской группе
         }
         
-        response = requests.get(url, headers=headers, params=params)
+        response = api_client.get(url, params=params)
         if response.status_code == 200:
             data = response.json()
             all_groups.extend(data['rows'])
@@ -520,6 +563,29 @@ def get_product_groups():
     # Строим иерархию
     return build_group_hierarchy(all_groups)
 
+def fetch_product_catalog():
+    """Дерево групп вместе с плоским индексом для быстрого поиска путей"""
+    product_groups = fetch_product_groups()
+    return product_groups, build_group_index(product_groups)
+
+# Справочники кэшируются на уровне процесса и обновляются в фоне после истечения TTL
+stores_cache = CatalogCache('stores', fetch_stores, CATALOG_CACHE_TTL)
+product_groups_cache = CatalogCache('product_groups', fetch_product_catalog, CATALOG_CACHE_TTL)
+# Состав комплектов по href комплекта, общий для всех отчетов
+bundle_components_cache = KeyedCache('bundle_components', BUNDLE_CACHE_TTL)
+# Показатели позиций по (склад, период, группы, алгоритмы скорости): отчет с другим
+# периодом планирования строится по ним без повторной загрузки данных
+report_metrics_cache = KeyedCache('report_metrics', REPORT_METRICS_CACHE_TTL, REPORT_METRICS_CACHE_SIZE)
+
+def get_stores():
+    return stores_cache.get()
+
+def get_product_groups():
+    return product_groups_cache.get()[0]
+
+def get_group_index():
+    return product_groups_cache.get()[1]
+
 # Добавляем функцию build_group_hierarchy из app.py
 def build_group_hierarchy(groups):
     # print("\nStarting build_group_hierarchy")
@@ -606,20 +672,14 @@ def index():
     return embed()
 
 # Добавьте все остальные функции из app.py:
-def get_report_data(start_date, end_date, store_id, product_groups):
+def get_report_data(start_date, end_date, store_id, product_groups, context=None):
     print(f"\nStarting get_report_data with product_groups: {product_groups}")
     
-    global processing_cancelled
-    with processing_lock:
-        processing_cancelled = False
+    if context is None:
+        context = JobContext()
     
     try:
         url = f"{BASE_URL}/report/profit/byvariant"
-        headers = {
-            'Authorization': f'Bearer {MOYSKLAD_TOKEN}',
-            'Accept': 'application/json;charset=utf-8',
-            'Content-Type': 'application/json'
-        }
         
         start_datetime = datetime.strptime(start_date, '%Y-%m-%d')
         end_datetime = datetime.strptime(end_date, '%Y-%m-%d')
@@ -658,17 +718,15 @@ def get_report_data(start_date, end_date, store_id, product_groups):
             print(f"Final filter parameter: {params['filter']}")
         
         all_rows = []
-        total_count = None
         
         # Создаем словарь для кэширования результатов анализа компонентов
         component_cache = {}
         
-        while True:
-            check_if_cancelled()
-            
-            query_params = [f"{k}={v}" for k, v in params.items() if k != 'filter']
-            if 'filter' in params:
-                query_params.append(f"filter={params['filter']}")
+        def fetch_page(offset):
+            page_params = dict(params, offset=offset)
+            query_params = [f"{k}={v}" for k, v in page_params.items() if k != 'filter']
+            if 'filter' in page_params:
+                query_params.append(f"filter={page_params['filter']}")
             query_string = '&'.join(query_params)
             
             full_url = f"{url}?{query_string}"
@@ -676,7 +734,9 @@ def get_report_data(start_date, end_date, store_id, product_groups):
             print(full_url)
             
             try:
-                response = requests.get(full_url, headers=headers, timeout=30)
+                # Строки разбираются по мере загрузки, от каждой остаются только нужные отчету поля
+                response, data = api_client.get_rows(full_url, project_profit_row, cancel_event=context.cancelled,
+                                                     stats=context.api_stats)
             except requests.exceptions.Timeout:
                 print("Timeout при получении данных отчета")
                 raise Exception("Timeout при получении данных отчета")
@@ -689,11 +749,34 @@ def get_report_data(start_date, end_date, store_id, product_groups):
                 print(error_message)
                 raise Exception(error_message)
             
-            data = response.json()
+            return data
+        
+        # Первая страница сообщает общее число записей, остальные страницы загружаем параллельно
+        pages = [fetch_page(params['offset'])]
+        total_count = pages[0].get('meta', {}).get('size', 0)
+        print(f"Всего записей: {total_count}")
+        
+        offsets = list(range(params['offset'] + params['limit'], total_count, params['limit']))
+        if offsets:
+            print(f"Параллельная загрузка страниц отчета: {len(offsets)}")
+            next_pages = run_ordered(fetch_page, offsets, is_cancelled=context.is_cancelled)
+            if next_pages is None:
+                return None
+            pages.extend(next_pages)
+        
+        # Страницы обрабатываем в порядке смещений, как при последовательной загрузке
+        for data in pages:
+            if check_if_cancelled(context):
+                return None
             
-            if total_count is None:
-                total_count = data.get('meta', {}).get('size', 0)
-                print(f"Всего записей: {total_count}")
+            # Составы всех комплектов страницы загружаем заранее: из кэша или параллельными запросами
+            bundle_hrefs = [
+                item.get('assortment', {}).get('meta', {}).get('href', '') for item in data.get('rows', [])
+                if item.get('assortment', {}).get('meta', {}).get('type', '') == 'bundle'
+            ]
+            components_by_bundle = get_bundles_components(bundle_hrefs, context)
+            if components_by_bundle is None:
+                return None
             
             # Обрабатываем каждую строку из ответа
             for item in data.get('rows', []):
@@ -705,8 +788,7 @@ def get_report_data(start_date, end_date, store_id, product_groups):
                 # Если это комплект
                 if assortment_type == 'bundle':
                     print(f"\nОбработка комплекта: {assortment.get('name', '')}")
-                    # Получаем компоненты комплекта
-                    components = get_bundle_components(assortment_href)
+                    components = components_by_bundle[assortment_href]
                     
                     # Считаем общее количество компонентов для распределения прибыли
                     total_components_quantity = sum(c['quantity'] for c in components)
@@ -741,11 +823,6 @@ def get_report_data(start_date, end_date, store_id, product_groups):
                 else:
                     # Если это не комплект, добавляем как есть
                     all_rows.append(item)
-            
-            if len(data.get('rows', [])) < params['limit']:
-                break
-            
-            params['offset'] += params['limit']
         
         # Добавляем накопленные данные компонентов в общий список
         for cached_item in component_cache.values():
@@ -753,300 +830,23 @@ def get_report_data(start_date, end_date, store_id, product_groups):
         
         return {'meta': data.get('meta', {}), 'rows': all_rows}
         
+    except RequestCancelled:
+        print("Получение данных отчета прервано отменой")
+        return None
     except Exception as e:
         if str(e) == "Processing cancelled by user":
             abort(499, description="Processing cancelled by user")
         raise e
 
-def get_sales_speed(variant_id, store_id, start_date, end_date, is_variant):
-    print(f"\nНачало расчета скорости продаж для варианта {variant_id}")
-    total_start_time = time()
-    
-    url = f"{BASE_URL}/report/turnover/byoperations"
-    headers = {
-        'Authorization': f'Bearer {MOYSKLAD_TOKEN}',
-        'Accept': 'application/json;charset=utf-8'
-    }
-    
-    # Преобразуем даты в datetime объекты
-    date_conversion_start = time()
-    end_datetime = datetime.strptime(end_date, '%Y-%m-%d').replace(hour=23, minute=59, second=59)
-    original_start = datetime.strptime(start_date, '%Y-%m-%d').replace(hour=0, minute=0, second=0)
-    # Используем значение из параметра search_days
-    search_days = int(request.form.get('search_days', 300))
-    extended_start = original_start - timedelta(days=search_days)
-    start_date_formatted = extended_start.strftime('%Y-%m-%d %H:%M:%S')
-    end_date_formatted = end_datetime.strftime('%Y-%m-%d %H:%M:%S')
-    print(f"Время на конвертацию дат: {(time() - date_conversion_start):.3f} сек")
-    
-    params = {
-        'momentFrom': start_date_formatted,
-        'momentTo': end_date_formatted,
-        'limit': 1000,
-        'order': 'moment,asc'
-    }
-    
-    assortment_type = 'variant' if is_variant else 'product'
-    filter_params = [
-        f"filter=store={BASE_URL}/entity/store/{store_id}",
-        f"filter={assortment_type}={BASE_URL}/entity/{assortment_type}/{variant_id}"
-    ]
-    
-    query_string = '&'.join([f"{k}={v}" for k, v in params.items()] + filter_params)
-    full_url = f"{url}?{query_string}"
-    
-    print(f"Запрос для получения операций: URL={full_url}")
-    
-    # Замер времени API запроса
-    api_request_start = time()
-    try:
-        response = requests.get(full_url, headers=headers, timeout=30)
-    except requests.exceptions.Timeout:
-        print(f"Timeout при запросе операций для варианта {variant_id}")
-        return 0, '', '', '', ''
-    except requests.exceptions.RequestException as e:
-        print(f"Ошибка при запросе операций для варианта {variant_id}: {str(e)}")
-        return 0, '', '', '', ''
-    
-    api_request_time = time() - api_request_start
-    print(f"Время выполнения API запроса: {api_request_time:.3f} сек")
-        
-    if response.status_code != 200:
-        print(f"Ошибка при получении данных: {response.status_code}. Ответ сервера: {response.text}")
-        return 0, '', '', '', ''
-
-    # Замер времени парсинга JSON
-    json_parse_start = time()
-    data = response.json()
-    json_parse_time = time() - json_parse_start
-    print(f"Время парсинга JSON: {json_parse_time:.3f} сек")
-    
-    if not data or 'rows' not in data:
-        print(f"Получен пустой ответ для варианта {variant_id}")
-        return 0, '', '', '', ''
-    
-    # Замер времени фильтрации строк
-    filter_start = time()
-    rows = [
-        row for row in data.get('rows', [])
-        if row['assortment']['meta']['href'].split('/')[-1] == variant_id
-    ]
-    filter_time = time() - filter_start
-    print(f"Время фильтрации строк: {filter_time:.3f} сек")
-    
-    if not rows:
-        return 0, '', '', '', ''
-    
-    # Получение метаданных
-    metadata_start = time()
-    group_uuid = ''
-    group_name = ''
-    product_uuid = ''
-    product_href = ''
-    
-    assortment = rows[0].get('assortment', {})
-    product_folder = assortment.get('productFolder', {})
-    group_href = product_folder.get('meta', {}).get('href', '')
-    group_uuid = group_href.split('/')[-1] if group_href else ''
-    group_name = product_folder.get('name', '')
-    
-    product_meta = assortment.get('meta', {})
-    product_href = product_meta.get('uuidHref', '')
-    if product_href:
-        product_uuid = product_meta.get('href', '').split('/')[-1]
-    metadata_time = time() - metadata_start
-    print(f"Время обработки метаданных: {metadata_time:.3f} сек")
-    
-    # Замер времени сортировки
-    sort_start = time()
-    rows.sort(key=lambda x: datetime.fromisoformat(x['operation']['moment'].replace('Z', '+00:00')))
-    sort_time = time() - sort_start
-    print(f"Время сортировки операций: {sort_time:.3f} сек")
-    
-    # Замер времени расчета скорости продаж
-    calculation_start = time()
-    stock_items = []
-    current_stock = []
-    retail_demand_counter = 0
-    on_stock_time = timedelta()
-    
-    for row in rows:
-        operation_time = datetime.fromisoformat(row['operation']['moment'].replace('Z', '+00:00'))
-        quantity = row['quantity']
-        operation_type = row['operation']['meta']['type']
-        
-        if quantity > 0:
-            current_stock.append((operation_time, quantity))
-            
-        elif operation_type == 'retaildemand' and original_start <= operation_time <= end_datetime:
-            quantity_to_sell = abs(quantity)
-            
-            while quantity_to_sell > 0 and current_stock:
-                arrival_time, available_quantity = current_stock[0]
-                sold_from_batch = min(quantity_to_sell, available_quantity)
-                
-                time_on_stock = operation_time - arrival_time
-                on_stock_time += time_on_stock * sold_from_batch
-                
-                retail_demand_counter += sold_from_batch
-                quantity_to_sell -= sold_from_batch
-                
-                if sold_from_batch == available_quantity:
-                    current_stock.pop(0)
-                else:
-                    current_stock[0] = (arrival_time, available_quantity - sold_from_batch)
-                    
-        elif quantity < 0:
-            quantity_to_remove = abs(quantity)
-            while quantity_to_remove > 0 and current_stock:
-                if current_stock[0][1] <= quantity_to_remove:
-                    quantity_to_remove -= current_stock[0][1]
-                    current_stock.pop(0)
-                else:
-                    current_stock[0] = (current_stock[0][0], current_stock[0][1] - quantity_to_remove)
-                    quantity_to_remove = 0
-    
-    days_on_stock = on_stock_time.total_seconds() / (24 * 60 * 60)
-    sales_speed = retail_demand_counter / days_on_stock if days_on_stock > 0 else 0
-    
-    calculation_time = time() - calculation_start
-    print(f"Время расчета скорости продаж: {calculation_time:.3f} сек")
-    
-    total_time = time() - total_start_time
-    print(f"\nОбщее время выполнения get_sales_speed: {total_time:.3f} сек")
-    print(f"Разбивка времени выполнения:")
-    print(f"- API запрос: {api_request_time:.3f} сек ({(api_request_time/total_time*100):.1f}%)")
-    print(f"- Парсинг JSON: {json_parse_time:.3f} сек ({(json_parse_time/total_time*100):.1f}%)")
-    print(f"- Фильтрация: {filter_time:.3f} сек ({(filter_time/total_time*100):.1f}%)")
-    print(f"- Метаданные: {metadata_time:.3f} сек ({(metadata_time/total_time*100):.1f}%)")
-    print(f"- Сортировка: {sort_time:.3f} сек ({(sort_time/total_time*100):.1f}%)")
-    print(f"- Расчет: {calculation_time:.3f} сек ({(calculation_time/total_time*100):.1f}%)")
-    
-    return sales_speed, group_uuid, group_name, product_uuid, product_href
-
-def get_group_path(group_uuid, product_groups, get_uuid=False):
-    def find_group_path(groups, target_uuid, current_path=[], current_uuid_path=[]):
-        for group in groups:
-            if group['id'] == target_uuid:
-                return (current_path + [group['name']], current_uuid_path + [group['id']])
-            if group.get('children'):
-                path = find_group_path(group['children'], target_uuid, 
-                                     current_path + [group['name']], 
-                                     current_uuid_path + [group['id']])
-                if path:
-                    return path
-        return None
-
-    path = find_group_path(product_groups, group_uuid)
-    if not path:
-        return '', []  # Возвращаем пустую строку и пустой список UUID
-    
-    names_path, uuid_path = path
-    return ('/'.join(names_path), uuid_path) if not get_uuid else ('/'.join(uuid_path), uuid_path)
-
-def calculate_group_quantities(products_data):
-    """
-    Рассчитывает суммарное количество для каждой группы на основе всех товаров в ней
-    и её подгруппах.
-    """
-    group_quantities = {}  # uuid -> quantity
-
-    # Сначала собираем все товары по группам
-    for product in products_data:
-        # Для каждого уровня в пути группы
-        for i in range(len(product['uuid_path'])):
-            group_uuid = product['uuid_path'][i]
-            if group_uuid not in group_quantities:
-                group_quantities[group_uuid] = 0
-            # Добавляем количество товара к каждой группе в пути
-            group_quantities[group_uuid] += product['quantity']
-
-    return group_quantities
-
-def calculate_group_profits(products_data):
-    """
-    Рассчитывает среднюю прибыльность для каждой группы на основе всех товаров в ней
-    и её подгруппах.
-    """
-    group_profits = {}  # uuid -> (total_profit, count)
-
-    # Сначала собираем все товары по группам
-    for product in products_data:
-        # Для каждого уровня в пути группы
-        for i in range(len(product['uuid_path'])):
-            group_uuid = product['uuid_path'][i]
-            if group_uuid not in group_profits:
-                group_profits[group_uuid] = [0, 0]  # [сумма прибыли, количество товаров]
-            # Добавляем прибыль товара и увеличиваем счетчик
-            group_profits[group_uuid][0] += product['profit']
-            group_profits[group_uuid][1] += 1
-
-    # Вычисляем средние значения
-    average_profits = {}
-    for group_uuid, (total_profit, count) in group_profits.items():
-        average_profits[group_uuid] = round(total_profit / count, 2) if count > 0 else 0
-
-    return average_profits
-
-def calculate_group_sales_speed(products_data):
-    """
-    Рассчитывает среднюю скорость продаж для каждой группы на основе всех товаров в ней
-    и её подгруппах.
-    """
-    group_speeds = {}  # uuid -> (total_speed, count)
-
-    # Сначала собираем все товары по группам
-    for product in products_data:
-        # Для каждого уровня в пути группы
-        for i in range(len(product['uuid_path'])):
-            group_uuid = product['uuid_path'][i]
-            if group_uuid not in group_speeds:
-                group_speeds[group_uuid] = [0, 0]  # [сумма скоростей, количество товаров]
-            # Добавляем скорость продаж товара и увеличиваем счетчик
-            group_speeds[group_uuid][0] += product['sales_speed']
-            group_speeds[group_uuid][1] += 1
-
-    # Вычисляем средние значения
-    average_speeds = {}
-    for group_uuid, (total_speed, count) in group_speeds.items():
-        average_speeds[group_uuid] = round(total_speed / count, 2) if count > 0 else 0
-
-    return average_speeds
-
-def calculate_group_profitability(products_data):
-    """
-    Рассчитывает среднюю прибыльность группы на основе всех товаров в ней
-    и её подгруппах.
-    """
-    group_profitability = {}  # uuid -> (total_profitability, count)
-
-    # Сначала собираем все товары по группам
-    for product in products_data:
-        # Для каждого уровня в пути группы
-        for i in range(len(product['uuid_path'])):
-            group_uuid = product['uuid_path'][i]
-            if group_uuid not in group_profitability:
-                group_profitability[group_uuid] = [0, 0]  # [сумма прибыльности группы, количество товаров]
-            # Добавляем прибыльность группы (произведение прибыли на скорость) и увеличиваем счетчик
-            group_profitability[group_uuid][0] += (product['profit'] * product['sales_speed'])
-            group_profitability[group_uuid][1] += 1
-
-    # Вычисляем средние значения
-    average_profitability = {}
-    for group_uuid, (total_profitability, count) in group_profitability.items():
-        average_profitability[group_uuid] = round(total_profitability / count, 2) if count > 0 else 0
-
-    return average_profitability
-
 def create_hierarchical_sort_key(product):
     """
     Создает ключ сортировки, который обеспечивает правильное иерархическое отображение.
     Сортирует группы по возрастанию названия.
     """
     path_components = []
-    names_by_level = product['names_by_level']
+    names_by_level = product.names_by_level
     
-    for i, (uuid, name) in enumerate(zip(product['uuid_path'], names_by_level)):
+    for i, (uuid, name) in enumerate(zip(product.uuid_path, names_by_level)):
         # Создаем кортеж из уровня, имени и uuid для сортировки
         path_components.append((i, name, uuid))
     
@@ -1079,25 +879,31 @@ def truncate_filename(filename, max_length=255):
     
     return truncated_name
 
-def create_excel_report(data, store_id, start_date, end_date, planning_days, manual_stock_settings=None):
+def create_excel_report(data, store_id, start_date, end_date, planning_days, manual_stock_settings=None,
+                        form=None, context=None, sku_metrics=None, output_dir=None):
+    """
+    Формирует Excel-отчет и возвращает имя файла (None, если обработка отменена).
+    form - параметры формы отчета; по умолчанию берутся из текущего запроса.
+    context - прогресс и отмена задачи (JobContext); по умолчанию создается новый.
+    sku_metrics - готовые показатели позиций (calculate_sku_metrics); тогда data не используется.
+    output_dir - каталог для файла (по умолчанию текущий); возвращается имя файла без каталога.
+    """
+    if form is None:
+        form = request.form
+    if context is None:
+        context = JobContext()
     try:
         print("Начало создания Excel отчета")
         print(f"Полученные настройки минимальных остатков: {manual_stock_settings}")
         
-        global current_status
-        
-        wb = Workbook()
-        ws = wb.active
-        
-        # Определяем палитру цветов в начале
-        color_palette = ['F2F2F2', 'E6E6E6', 'D9D9D9', 'CCCCCC', 'BFBFBF']
+        wb = create_report_workbook(write_only=EXCEL_WRITE_ONLY)
         
         # Получаем выбранные группы из формы до начала анализа данных
         selected_groups = []
         
         # Получаем все значения из формы для отладки
         print("\nВсе значения формы:")
-        for key, value in request.form.items():
+        for key, value in form.items():
             print(f"{key}: {value}")
         
         # Собираем первую группу
@@ -1105,8 +911,8 @@ def create_excel_report(data, store_id, start_date, end_date, planning_days, man
         group1_path = []
         for i in range(1, 6):  # Максимум 5 уровней
             level_key = f'group_level_{i}'
-            if level_key in request.form:
-                value = request.form[level_key].strip()
+            if level_key in form:
+                value = form[level_key].strip()
                 if value and value != "Выберите подгруппу":
                     group1_path.append(value)
         if group1_path:
@@ -1118,8 +924,8 @@ def create_excel_report(data, store_id, start_date, end_date, planning_days, man
         group2_path = []
         for i in range(6, 11):  # Следующие 5 уровней
             level_key = f'group_level_{i}'
-            if level_key in request.form:
-                value = request.form[level_key].strip()
+            if level_key in form:
+                value = form[level_key].strip()
                 if value and value != "Выберите подгруппу":
                     group2_path.append(value)
         if group2_path:
@@ -1132,732 +938,99 @@ def create_excel_report(data, store_id, start_date, end_date, planning_days, man
         if selected_groups:
             group_name_for_file = selected_groups[-1].split('/')[-1]
         
-        product_groups = get_product_groups()
-        products_data = []
-        max_depth = 0
-        
-        # Сначала собираем все данные и определяем максимальную глубину
-        for item in data['rows']:
-            if check_if_cancelled():
+        # Скорость продаж и остальные показатели позиций не зависят от периода планирования:
+        # при повторном отчете с другими параметрами планирования они передаются готовыми
+        strategies = get_speed_strategies(form.get('speed_strategies') or SALES_SPEED_STRATEGIES)
+        if sku_metrics is None:
+            sku_metrics = calculate_sku_metrics(data, store_id, start_date, end_date, strategies, context)
+            if sku_metrics is None:
                 wb.close()
                 return None
-                
-            assortment = item.get('assortment', {})
-            assortment_meta = assortment.get('meta', {})
-            assortment_href = assortment_meta.get('href', '')
-            assortment_type = assortment_meta.get('type', '')
-            
-            # Определяем тип и ID
-            is_variant = assortment_type == 'variant' or '/variant/' in assortment_href
-            is_product = assortment_type == 'product' or '/product/' in assortment_href
-            
-            if is_variant:
-                variant_id = assortment_href.split('/variant/')[-1]
-            elif is_product:
-                variant_id = assortment_href.split('/product/')[-1]
-            else:
-                continue  # Пропускаем неподдерживаемые типы
-            
-            if variant_id and item.get('sellQuantity', 0) > 0:  # Проверяем продажи
-                print(f"Обработка позиции {assortment.get('name', '')} (sellQuantity: {item.get('sellQuantity', 0)})")
-                
-                # Используем только новый метод расчета скорости продаж
-                sales_speed, group_uuid, group_name, product_uuid, product_href, assortment_name = get_sales_speed_v2(
-                    variant_id, store_id, start_date, end_date, is_variant
-                )
-                
-                if sales_speed is not None:  # Проверяем, что скорость продаж успешно рассчитана
-                    full_path, uuid_path = get_group_path(group_uuid, product_groups)
-                    max_depth = max(max_depth, len(uuid_path))
-                    
-                    # Округляем скорость продаж до 2 знаков после запятой
-                    display_sales_speed = round(sales_speed, 2)
-                    
-                    products_data.append({
-                        'name': assortment_name,  # Используем имя из ответа API
-                        'quantity': item.get('sellQuantity', 0),
-                        'profit': round(item.get('profit', 0) / 100 / item.get('sellQuantity', 1), 2),  # Делим на количество
-                        'sales_speed': display_sales_speed,
-                        'forecast': sales_speed * planning_days,
-                        'group_uuid': group_uuid,
-                        'group_path': full_path,
-                        'uuid_path': uuid_path,
-                        'names_by_level': get_names_by_uuid(uuid_path, product_groups),
-                        'product_uuid': product_uuid,
-                        'product_href': product_href
-                    })
-                    
-                    print(f"Позиция успешно обработана, обновляем счетчик")
-                    update_processed_count()
-                    
-                    if check_if_cancelled():
-                        wb.close()
-                        return None
+
+        report_rows, max_depth = build_report_model(sku_metrics, planning_days, strategies)
 
         # Проверяем отмену перед форматированием
-        if check_if_cancelled():
+        if check_if_cancelled(context):
             wb.close()
             return None
-            
-        print(f"Максимальная глубина групп: {max_depth}")
-
-        # Рассчитываем количества и средние значения для всех групп
-        group_quantities = calculate_group_quantities(products_data)
-        group_profits = calculate_group_profits(products_data)
-        group_sales_speeds = calculate_group_sales_speed(products_data)
-        group_profitability = calculate_group_profitability(products_data)
-
-        # Сортируем данные с использованием иерархического ключа
-        products_data.sort(key=create_hierarchical_sort_key)
-
-        # Формируем заголовки с учетом реальной глубины, начиная со второго уровня
-        group_level_headers = [f'Уровень {i+2}' for i in range(max_depth-1)] if max_depth > 1 else []
-        headers = group_level_headers + [
-            'UUID',  # Изменено название столбца
-            'Наименование', 'Количество проданного', 'Средняя прибыльность товара', 'Скорость продаж', 
-            'Прибыльность группы', '30', 'Мин.остаток'
-        ]
-        
-        # Записываем заголовки
-        for col, header in enumerate(headers, start=1):
-            cell = ws.cell(row=1, column=col, value=header)
-            cell.font = Font(color="000000", bold=True, size=10)
-            # Применяем форматирование для всех заголовков
-            cell.alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-
-        # Инициализируем current_row с 3 вместо 2
-        current_row = 3
-        current_uuid_path = []
-        written_groups = set()  # Множество для отслеживания уже записанных групп
-
-        # Сначала записываем все данные для листа "Анализ1"
-        for product in products_data:
-            uuid_path = product['uuid_path']
-            names_by_level = product['names_by_level']
-            
-            # Записываем строки групп, если путь изменился
-            for i, uuid in enumerate(uuid_path):
-                group_key = f"{i}_{uuid}"  # Создаем уникальный ключ для группы с учетом уровня
-                if (i >= len(current_uuid_path) or uuid != current_uuid_path[i]) and group_key not in written_groups:
-                    if i > 0:
-                        group_cell = ws.cell(row=current_row, column=i, value=names_by_level[i])
-                        group_cell.font = Font(size=10)
-                        # Записываем количество для группы
-                        quantity_cell = ws.cell(row=current_row, column=max_depth+2, value=group_quantities.get(uuid, 0))
-                        quantity_cell.font = Font(size=10)
-                        # Записываем среднюю прибыльность для группы
-                        profit_cell = ws.cell(row=current_row, column=max_depth+3, value=group_profits.get(uuid, 0))
-                        profit_cell.font = Font(size=10)
-                        profit_cell.number_format = '0.00'
-                        # Записываем среднюю скорость продаж для группы
-                        speed_cell = ws.cell(row=current_row, column=max_depth+4, value=group_sales_speeds.get(uuid, 0))
-                        speed_cell.font = Font(size=10)
-                        speed_cell.number_format = '0.00'
-                        # Записываем среднюю прибыльность группы
-                        group_profit_cell = ws.cell(row=current_row, column=max_depth+5, value=group_profitability.get(uuid, 0))
-                        group_profit_cell.font = Font(size=10)
-                        group_profit_cell.number_format = '0.00'
-
-                        # Создаем стиль границы
-                        border = Border(
-                            # left=Side(style='thin'),
-                            # right=Side(style='thin'),
-                            # top=Side(style='thin'),
-                            # bottom=Side(style='thin')
-                        )
-                        
-                        color_index = min(i - 1, len(color_palette) - 1)
-                        fill_color = color_palette[color_index]
-                        for col in range(1, ws.max_column + 1):
-                            cell = ws.cell(row=current_row, column=col)
-                            # Сохраняем только заливку, не трогая другие параметры форматирования
-                            cell.fill = PatternFill(start_color=fill_color, 
-                                                  end_color=fill_color, 
-                                                  fill_type='solid')
-                            cell.border = border
-                        
-                        if current_row > 2:
-                            uuid_cell = ws.cell(row=current_row, column=max_depth, value=uuid)
-                            uuid_cell.font = Font(size=10)
-                            uuid_cell.alignment = Alignment(horizontal='left', shrink_to_fit=False)
-                        
-                        current_row += 1
-                        written_groups.add(group_key)
-            
-            # print(f"7777777777:\n"+str(current_row))
-            # При записи UUID товара
-            if current_row > 2:
-                uuid_cell = ws.cell(row=current_row, column=max_depth)
-                if product['product_href']:
-                    uuid_cell.value = product['product_uuid']
-                    uuid_cell.hyperlink = product['product_href']
-                    uuid_cell.font = Font(color="0000FF", underline="single", size=10)
-                    uuid_cell.alignment = Alignment(horizontal='left', shrink_to_fit=False)
-            
-            # Записываем данные продукта
-            name_cell = ws.cell(row=current_row, column=max_depth+1, value=product['name'])
-            name_cell.font = Font(size=10)
-            quantity_cell = ws.cell(row=current_row, column=max_depth+2, value=product['quantity'])
-            quantity_cell.font = Font(size=10)
-            profit_cell = ws.cell(row=current_row, column=max_depth+3, value=product['profit'])
-            profit_cell.font = Font(size=10)
-            profit_cell.number_format = '0.00'
-            speed_cell = ws.cell(row=current_row, column=max_depth+4, value=product['sales_speed'])
-            speed_cell.font = Font(size=10)
-            speed_cell.number_format = '0.00'
-            group_profit = round(product['profit'] * product['sales_speed'], 2)
-            group_profit_cell = ws.cell(row=current_row, column=max_depth+5, value=group_profit)
-            group_profit_cell.font = Font(size=10)
-            group_profit_cell.number_format = '0.00'
-            
-            current_row += 1
-            current_uuid_path = uuid_path
-
-        # Теперь, когда у нас есть все данные, добавляем формулы
-        name_col = get_column_letter(max_depth+1)      # Столбец "Наименование"
-        quantity_col = get_column_letter(max_depth+2)  # Столбец "Количество проданного"
-        profit_col = get_column_letter(max_depth+3)    # Столбец "Средняя прибыльность товара"
-        speed_col = get_column_letter(max_depth+4)     # Столбец "Скорость продаж"
-        group_profit_col = get_column_letter(max_depth+5)  # Столбец "Прибыльность группы"
-        forecast_col_letter = get_column_letter(max_depth+6)  # Столбец "30"
-        round_col_letter = get_column_letter(max_depth+7)     # Столбец "Процент"
-
-        # Устанавливаем значение 30 в первой ячейке столбца forecast
-        forecast_header = ws.cell(row=1, column=max_depth+6, value=30)
-        forecast_header.font = Font(size=10)
-
-        # Добавляем формулы в каждую строку, где есть значение в столбце "Наименование"
-        for row in range(2, current_row):
-            name_cell = ws.cell(row=row, column=max_depth+1).value
-            if name_cell:
-                # Формула для столбца "30" с абсолютной ссылкой на ячейку с числом
-                forecast_formula = f'={speed_col}{row}*{forecast_col_letter}$1'
-                forecast_cell = ws.cell(row=row, column=max_depth+6, value=forecast_formula)
-                forecast_cell.font = Font(size=10)
-                forecast_cell.number_format = '0.00'
-                
-                # Формула для столбца округления вверх
-                round_formula = f'=CEILING({forecast_col_letter}{row})'
-                round_cell = ws.cell(row=row, column=max_depth+7, value=round_formula)
-                round_cell.font = Font(size=10)
-                round_cell.number_format = '0.00'
-
-        # После записи всех данных и перед форматированием добавляем группировку
-        ws.sheet_properties.outlinePr.summaryBelow = False  # Устанавливаем кнопку группировки сверху
-
-        # Функция для определения диапазонов групп
-        def find_groups(ws, start_row, end_row, max_depth):
-            groups = []  # [(start_row, end_row, level, group_name)]
-            
-            # Проходим по каждой строке
-            for row in range(start_row, end_row + 1):
-                # Проверяем каждый уровень
-                for level in range(1, max_depth + 1):
-                    value = ws.cell(row=row, column=level).value
-                    if value is not None:
-                        # Находим конец группы (последнюю строку перед следующей группой того же или более высокого уровня)
-                        end_group_row = row
-                        for next_row in range(row + 1, end_row + 1):
-                            # Проверяем, не началась ли новая группа того же или более высокого уровня
-                            found_higher_level = False
-                            for check_level in range(1, level + 1):
-                                if ws.cell(row=next_row, column=check_level).value is not None:
-                                    found_higher_level = True
-                                    break
-                            if found_higher_level:
-                                end_group_row = next_row - 1
-                                break
-                            end_group_row = next_row
-                        
-                        groups.append((row, end_group_row, level, value))
-            
-            return groups
-
-        # Находим все группы
-        groups = find_groups(ws, 3, current_row - 1, max_depth)  # Изменяем начальную строку на 3
-
-        # Сортируем группы по уровню (от большего к меньшему)
-        # и по позиции (сверху вниз)
-        groups.sort(key=lambda x: (-x[2], x[0]))
-
-        # Применяем группировку
-        for start_row, end_row, level, group_name in groups:
-            if start_row < end_row:  # Группируем если есть что группировать
-                # Группируем все строки под группой
-                for row in range(start_row + 1, end_row + 1):
-                    current_level = ws.row_dimensions[row].outline_level
-                    ws.row_dimensions[row].outline_level = current_level + 1 if current_level is not None else 1
-                    ws.row_dimensions[row].hidden = False
-
-        # Отключаем группировку для заголовка и пустой строки
-        ws.row_dimensions[1].outline_level = 0
-        ws.row_dimensions[2].outline_level = 0  # Добавляем для пустой строки
-
-        # Форматирование
-        # ws.freeze_panes = ws['A2']  # Закрепляем только первую строку
-        ws.freeze_panes = ws['A3']  # Закрепляем вторую строку
-
-        # # Устанавливаем фиксированную ширину для столбцов уровней и наименования
-        # # Для всех столбцов уровней (от первого до UUID не включительно)
-        # for col in range(1, max_depth):
-        #     col_letter = get_column_letter(col)
-        #     ws.column_dimensions[col_letter].width = 14
-        
-        # Устанавливаем ширину для столбца "Наименование"
-        ws.column_dimensions[name_col].width = 75
-
-        # Устанавливаем выравнивание по левому краю для заголовков от столбца A до "Наименование"
-        for col in range(1, ws[name_col + '1'].column + 1):
-            header_cell = ws.cell(row=1, column=col)
-            header_cell.alignment = Alignment(horizontal='left', vertical='center', shrink_to_fit=True)
-
-        # Устанавливаем ширину и форматирование для указанных столбцов
-        fixed_width_columns = [
-            quantity_col, profit_col, speed_col, group_profit_col,
-            forecast_col_letter, round_col_letter
-        ]
-        
-        # Устанавливаем ширину столбцов и форматируем все ячейки
-        for col_letter in fixed_width_columns:
-            ws.column_dimensions[col_letter].width = 15
-            # Форматируем заголовок
-            header_cell = ws.cell(row=1, column=ws[col_letter + '1'].column)
-            header_cell.alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-            # Форматируем все ячейки в столбце
-            for cell in ws[col_letter]:
-                cell.alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-        
-        # Автоподбор ширины для остальных столбцов
-        for column in ws.columns:
-            column_letter = get_column_letter(column[0].column)
-            
-            # Пропускаем столбцы с фиксированной шириной
-            if column_letter in fixed_width_columns or column_letter == name_col:
-                continue
-                
-            # Если это столбец "UUID" (max_depth)
-            if column[0].column == max_depth:
-                ws.column_dimensions[column_letter].width = 3
-                # Применяем настройки отображения ко всем ячейкам в столбце
-                for cell in column:
-                    if cell.row == 1:  # For the header cell
-                        cell.alignment = Alignment(horizontal='left', vertical='center', shrink_to_fit=True)
-                    else:  # For other cells
-                        if isinstance(cell.hyperlink, str):  # Если есть ссылка
-                            cell.font = Font(color="0000FF", underline="single", size=10)
-                        cell.alignment = Alignment(horizontal='left', shrink_to_fit=True)
-                continue
 
-            max_length = 0
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = (max_length + 2)
-            ws.column_dimensions[column_letter].width = adjusted_width
-
-        # Устанавливаем фиксированную ширину для столбцов уровней и наименования
-        # Для всех столбцов уровней (от первого до UUID не включительно)
-        for col in range(1, max_depth):
-            col_letter = get_column_letter(col)
-            ws.column_dimensions[col_letter].width = 14
-
-        # После сбора всех данных и перед созданием заголовков
-        ws.title = "Анализ1"
+        # Оба листа записываются из общей модели строк, без чтения ячеек "Анализ1" обратно
+        ws = wb.create_sheet("Анализ1")
+        write_analysis_sheet(ws, report_rows, max_depth, [strategy.title for strategy in strategies])
         print(f"Название листа: {ws.title}")
-        
-        # Создаем лист "Анализ2" и копируем в него данные с новой логикой
-        ws2 = wb.create_sheet("Анализ2")
-        
-        # Копируем заголовки и их форматирование, пропуская столбец "Наименование"
-        target_col = 1
-        for col in range(1, ws.max_column + 1):
-            # Пропускаем столбец "Наименование"
-            if col == max_depth + 1:
-                continue
-                
-            source_cell = ws.cell(row=1, column=col)
-            target_cell = ws2.cell(row=1, column=target_col)
 
-            # Копируем значение и форматирование заголовка
-            if source_cell.value == 'Мин.остаток':
-                target_cell.value = 'Процент'
-            else:
-                target_cell.value = source_cell.value
-            
-            target_cell.font = Font(bold=True, color=Color(rgb='00000000'), size=10)  # Черный цвет
-            
-            # Устанавливаем выравнивание в зависимости от столбца
-            if col <= max_depth:  # Для столбцов до UUID включительно
-                target_cell.alignment = Alignment(horizontal='left', vertical='center', shrink_to_fit=True)
-            else:
-                target_cell.alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-            
-            # Копируем ширину столбца
-            source_letter = get_column_letter(col)
-            target_letter = get_column_letter(target_col)
-            if source_letter in ws.column_dimensions:
-                ws2.column_dimensions[target_letter].width = ws.column_dimensions[source_letter].width
-            
-            target_col += 1
-        
-        # # Добавляем автофильтр только для столбцов "Уровень №" (до UUID)
-        # if max_depth > 1:  # Если есть столбцы уровней
-        #     filter_range = f"A1:{get_column_letter(max_depth-1)}1"
-        #     ws2.auto_filter.ref = f"A1:{get_column_letter(max_depth-1)}{ws2.max_row}"
-
-        # Закрепляем первые две строки
-        ws2.freeze_panes = ws2['A3']  # Закрепляем первые две строки
-        
-        # Сбрасываем переменные для второго листа
-        target_row = 3  # Начинаем с третьей строки
-        current_uuid_path = []
-        written_groups = set()
-        
-        # Копируем данные из первого листа
-        for source_row in range(3, current_row):  # Берем данные из Анализ1 начиная с 3-й строки
-            # Проверяем, есть ли в строке данные в столбцах "Уровень №"
-            has_group_data = False
-            group_level = None
-            group_data = None
-            
-            # Находим самую глубокую группу в строке и её уровень
-            for col in range(1, max_depth):
-                cell_value = ws.cell(row=source_row, column=col).value
-                if cell_value is not None:
-                    has_group_data = True
-                    group_level = col
-                    group_data = cell_value
-            
-            # Копируем только строки с группами
-            if has_group_data:
-                # Получаем путь группы из первого листа
-                group_path = []
-                for col in range(1, group_level + 1):
-                    parent_value = None
-                    # Ищем ближайшее непустое значение выше в том же столбце
-                    for row in range(source_row, 2, -1):
-                        cell_value = ws.cell(row=row, column=col).value
-                        if cell_value is not None:
-                            parent_value = cell_value
-                            break
-                    if parent_value is not None:
-                        group_path.append(parent_value)
-                
-                # Копируем данные с учетом пути группы
-                target_col = 1
-                for col in range(1, ws.max_column + 1):
-                    # Пропускаем столбец "Наименование"
-                    if col == max_depth + 1:
-                        continue
-                    
-                    source_cell = ws.cell(row=source_row, column=col)
-                    target_cell = ws2.cell(row=target_row, column=target_col)
-                    
-                    # Если это столбец уровня группы, записываем соответствующее значение из пути
-                    if col <= max_depth and col <= len(group_path):
-                        target_cell.value = group_path[col - 1]
-                    else:
-                        target_cell.value = source_cell.value
-                    
-                    # Копируем форматирование
-                    if source_cell.fill and hasattr(source_cell.fill, 'start_color') and source_cell.fill.start_color:
-                        # Создаем стиль границы
-                        border = Border()
-                        try:
-                            fill_color = source_cell.fill.start_color.rgb or 'FFFFFF'
-                            target_cell.fill = PatternFill(
-                                start_color=fill_color,
-                                end_color=fill_color,
-                                fill_type='solid'
-                            )
-                            target_cell.border = border
-                        except:
-                            pass
-                    
-                    # Копируем шрифт
-                    try:
-                        font_color = None
-                        if source_cell.font and source_cell.font.color:
-                            if hasattr(source_cell.font.color, 'rgb'):
-                                font_color = Color(rgb=source_cell.font.color.rgb)
-                            elif isinstance(source_cell.font.color, str):
-                                font_color = Color(rgb=source_cell.font.color)
-                        
-                        target_cell.font = Font(
-                            bold=bool(source_cell.font.bold) if source_cell.font else False,
-                            color=font_color,
-                            underline=source_cell.font.underline if source_cell.font else None,
-                            size=10
-                        )
-                    except:
-                        target_cell.font = Font(bold=False, color=Color(rgb='00000000'), size=10)
-                    
-                    # Копируем выравнивание
-                    if col <= max_depth:  # Для столбцов до UUID включительно
-                        target_cell.alignment = Alignment(horizontal='left', shrink_to_fit=True)
-                    else:
-                        target_cell.alignment = Alignment(
-                            horizontal='center',
-                            vertical='center',
-                            wrap_text=True
-                        )
-                    
-                    # Копируем формат чисел
-                    if source_cell.number_format:
-                        target_cell.number_format = source_cell.number_format
-                    
-                    # Копируем формулы, если они есть, корректируя номера столбцов
-                    if isinstance(source_cell.value, str) and source_cell.value.startswith('='):
-                        try:
-                            formula = source_cell.value.replace(str(source_row), str(target_row))
-                            # Корректируем ссылки на столбцы в формулах
-                            if col > max_depth + 1:
-                                old_col = get_column_letter(col)
-                                new_col = get_column_letter(target_col)
-                                formula = formula.replace(old_col, new_col)
-                            target_cell.value = formula
-                        except:
-                            pass
-                    
-                    target_col += 1
-                
-                # Добавляем значение в столбец "Сумма процентов" с тем же форматированием
-                last_col = ws2.max_column
-                last_cell = ws2.cell(row=target_row, column=last_col)
-                
-                # Применяем то же форматирование, что и у других ячеек в строке
-                if source_cell.fill and hasattr(source_cell.fill, 'start_color') and source_cell.fill.start_color:
-                    fill_color = source_cell.fill.start_color.rgb or 'FFFFFF'
-                    last_cell.fill = PatternFill(
-                        start_color=fill_color,
-                        end_color=fill_color,
-                        fill_type='solid'
-                    )
-                    last_cell.border = border
-                
-                last_cell.alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-                last_cell.font = Font(bold=False, color=Color(rgb='00000000'), size=10)
-                
-                target_row += 1
-        
-        # После копирования всех данных добавляем автофильтр для столбцов до UUID
-        if max_depth > 1:  # Если есть столбцы уровней
-            filter_range = f"A1:{get_column_letter(max_depth-1)}1"
-            ws2.auto_filter.ref = f"A1:{get_column_letter(max_depth-1)}{target_row-1}"
-
-        # После копирования всех данных, добавляем формулу во вторую строку
-        # Находим столбцы "Количество проданного" и "Средняя прибыльность товара"
-        quantity_col = None
-        profit_col = None
-        for col in range(1, ws2.max_column + 1):
-            header = ws2.cell(row=1, column=col).value
-            if header == "Количество проданного":
-                quantity_col = get_column_letter(col)
-            elif header == "Средняя прибыльность товара":
-                profit_col = get_column_letter(col)
-        
-        # Находим столбец после "Прибыльность группы"
-        target_col = None
-        for col in range(1, ws2.max_column + 1):
-            if ws2.cell(row=1, column=col).value == "Прибыльность группы":
-                target_col = col + 1
-                break
-        
-        if target_col and quantity_col and profit_col:
-            # Добавляем формулу начиная с третьей строки до конца таблицы
-            for row in range(3, target_row):
-                formula_cell = ws2.cell(row=row, column=target_col)
-                formula_cell.value = f"=IF(SUBTOTAL(103;{quantity_col}{row})=0;0;{quantity_col}{row}*{profit_col}{row})"
-                formula_cell.font = Font(size=10)
-                formula_cell.number_format = '0.00'
-                formula_cell.alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-
-        # Добавляем формулу в столбец "Процент"
-        percent_col = None
-        for col in range(1, ws2.max_column + 1):
-            if ws2.cell(row=1, column=col).value == "Процент":
-                percent_col = col
-                break
-        
-        if percent_col:
-            # Получаем букву предыдущего столбца
-            prev_col_letter = get_column_letter(percent_col - 1)
-            # Добавляем формулу начиная с третьей строки
-            for row in range(3, target_row):
-                percent_cell = ws2.cell(row=row, column=percent_col)
-                percent_cell.value = f"=IF(SUBTOTAL(103;{quantity_col}{row})=0;0;{prev_col_letter}{row}*100/${prev_col_letter}$1)"
-                percent_cell.font = Font(size=10)
-                percent_cell.number_format = '0.00'
-                percent_cell.alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-
-        # После копирования всех данных, обновляем заголовок столбца "30" формулой суммы
-        for col in range(1, ws2.max_column + 1):
-            header_cell = ws2.cell(row=1, column=col)
-            if header_cell.value == 30:
-                col_letter = get_column_letter(col)
-                last_row = ws2.max_row
-                header_cell.value = f'=SUM({col_letter}2:{col_letter}{last_row})'
-                
-                # Добавляем новый столбец "Сумма процентов"
-                new_col = ws2.max_column + 1
-                new_col_letter = get_column_letter(new_col)
-                
-                # Добавляем заголовок и копируем форматирование из заголовка столбца "Процент"
-                sum_header_cell = ws2.cell(row=1, column=new_col, value='Сумма процентов')
-                percent_header_cell = ws2.cell(row=1, column=new_col-1)
-                
-                # Копируем форматирование заголовка
-                sum_header_cell.font = Font(bold=True, color=Color(rgb='00000000'), size=10)
-                sum_header_cell.alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-                
-                # Устанавливаем ширину столбца
-                ws2.column_dimensions[new_col_letter].width = 15
-                
-                # Добавляем формулу начиная с третьей строки
-                if percent_col:
-                    percent_col_letter = get_column_letter(percent_col)
-                    for row in range(3, target_row):
-                        sum_cell = ws2.cell(row=row, column=new_col)
-                        sum_cell.value = f"=IF(SUBTOTAL(103;{quantity_col}{row})=0;0;SUM({percent_col_letter}$3:{percent_col_letter}{row}))"
-                        sum_cell.number_format = '0.00'
-                        sum_cell.alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-                        sum_cell.font = Font(size=10)
-                        
-                        # Копируем фон и границы из соседней ячейки
-                        source_cell = ws2.cell(row=row, column=new_col-1)
-                        if source_cell.fill and hasattr(source_cell.fill, 'start_color') and source_cell.fill.start_color:
-                            fill_color = source_cell.fill.start_color.rgb or 'FFFFFF'
-                            sum_cell.fill = PatternFill(
-                                start_color=fill_color,
-                                end_color=fill_color,
-                                fill_type='solid'
-                            )
-                        if source_cell.border:
-                            sum_cell.border = copy(source_cell.border)
-                
-                break
+        ws2 = wb.create_sheet("Анализ2")
+        write_groups_sheet(ws2, report_rows, max_depth)
 
-        # Создаем лист с информацией
-        info_ws = wb.create_sheet("Инфо")  # Создаем лист "Инфо" последним в книге, убираем индекс 0
-        
         # Получаем название магазина для информационного листа
-        stores = get_stores()
-        store_name = next((store['name'] for store in stores if store['id'] == store_id), store_id)
-        
-        # Форматируем даты для отображения
-        start_date_obj = datetime.strptime(start_date, '%Y-%m-%d')
-        end_date_obj = datetime.strptime(end_date, '%Y-%m-%d')
-        start_date_formatted = start_date_obj.strftime('%d.%m.%Y')
-        end_date_formatted = end_date_obj.strftime('%d.%m.%Y')
-        
-        # Вычисляем дату за 100 дней до начала периода
-        extended_start_date = start_date_obj - timedelta(days=100)
-        extended_start_formatted = extended_start_date.strftime('%d.%m.%Y')
-        
-        # Подготавливаем данные для информационного листа
-        info_data = [
-            ["Параметры анализа", ""],
-            ["", ""],
-            ["Период анализа:", f"с {start_date_formatted} по {end_date_formatted}"],
-            ["Дата начала поиска последней продажи перед Дата начала:", extended_start_formatted],
-            ["Количество дней анализа:", f"{(end_date_obj - start_date_obj).days + 1} дней"],
-            ["", ""],
-            ["Магазин:", store_name],
-            ["", ""],
-            ["Период планирования:", f"{planning_days} дней"],
-            ["", ""],
-            ["Выбранные группы товаров:", ""],
-        ]
-
-        # print(f"333 request.form: {request.form.get('search_days')}")
-
-        product_groups = []
-        if 'final_product_groups' in request.form:
-            raw_groups = request.form.get('final_product_groups', '')
-            # Разбиваем строку с группами на отдельные ID
-            if raw_groups:
-                product_groups = [group.strip() for group in raw_groups.split(',') if group.strip()]
-            print(f"333 Обработанные группы: {product_groups}")
-        
-        # Добавляем информацию о выбранных группах
-        selected_groups = []
-        
-        # Получаем пути групп из формы
-        raw_paths = request.form.get('final_product_paths', '')
-        if raw_paths:
-            # Очищаем каждый путь от лишних пробелов, включая пробелы вокруг разделителя
-            selected_groups = []
-            second_level_names = []  # Список для хранения названий второго уровня
-            for path in raw_paths.split('||'):
-                if path.strip():
-                    # Разбиваем путь на части, очищаем каждую часть
-                    clean_path_parts = [part.strip() for part in path.strip().split('/')]
-                    selected_groups.append('/'.join(clean_path_parts))
-                    
-                    # Проверяем уровни групп
-                    if len(clean_path_parts) >= 2:  # Убеждаемся, что есть хотя бы два уровня
-                        if len(clean_path_parts) == 2 or (len(clean_path_parts) > 2 and clean_path_parts[2] == "Выберите подгруппу"):
-                            # Если это группа второго уровня или третий уровень не выбран
-                            second_level_names.append(clean_path_parts[1])
-                        elif len(clean_path_parts) > 2:
-                            # Если выбран третий уровень
-                            second_level_names.append(clean_path_parts[2])
-
-        # Формируем имя файла, используя названия второго уровня
-        group_name_for_file = "Все группы"
-        if second_level_names:
-            group_name_for_file = ','.join(second_level_names)
-            print(f"Название файла будет содержать группы: {group_name_for_file}")  # Добавляем для отладки
+        store_name = get_store_name(store_id)
         
-        # Добавляем выбранные группы в информационный лист
-        if selected_groups:
-            print("Добавляем выбранные группы в информационный лист:")
-            for group_path in selected_groups:
-                print(f"  - {group_path}")
-                info_data.append(["", group_path])
-        else:
-            print("Нет выбранных групп, добавляем 'Все группы'")
-            info_data.append(["", "Все группы"])
-        
-        # Записываем данные в лист
-        for row_idx, row_data in enumerate(info_data, 1):
-            for col_idx, value in enumerate(row_data, 1):
-                cell = info_ws.cell(row=row_idx, column=col_idx, value=value)
-                # Форматирование для заголовков
-                if row_idx == 1 or (col_idx == 1 and value):
-                    cell.font = Font(bold=True, size=10)
-                # Выравнивание
-                cell.alignment = Alignment(vertical='center')
-                if col_idx == 1:
-                    cell.alignment = Alignment(horizontal='right', vertical='center')
-                else:
-                    cell.alignment = Alignment(horizontal='left', vertical='center')
-        
-        # Устанавливаем ширину столбцов
-        info_ws.column_dimensions['A'].width = 30
-        info_ws.column_dimensions['B'].width = 60
+        # Выбранные группы для информационного листа и имени файла
+        selected_groups, group_name_for_file = get_selected_group_paths(form)
+        info_data = build_info_data(start_date, end_date, store_name, planning_days, strategies, selected_groups)
         
-        # Добавляем время создания отчета
+        # Создаем лист с информацией последним в книге и добавляем время создания отчета
+        info_ws = wb.create_sheet("Инфо")
         current_time = datetime.now().strftime('%d.%m.%Y %H:%M:%S')
-        time_row = len(info_data) + 2
-        info_ws.cell(row=time_row, column=1, value="Отчет сформирован:").font = Font(bold=True, size=10)
-        info_ws.cell(row=time_row, column=1).alignment = Alignment(horizontal='right', vertical='center')
-        info_ws.cell(row=time_row, column=2, value=current_time).font = Font(size=10)
-        info_ws.cell(row=time_row, column=2).alignment = Alignment(horizontal='left', vertical='center')
+        write_info_sheet(info_ws, info_data, current_time)
         
         # Делаем активным лист "Анализ1"
         wb.active = wb["Анализ1"]
         
         # Формируем имя файла
-        filename = f"{start_date_formatted}-{end_date_formatted} - {store_name} - {group_name_for_file}.xlsx"
+        filename = f"{format_period(start_date, end_date)} - {store_name} - {group_name_for_file}.xlsx"
         # Обрезаем имя файла, если оно слишком длинное
         filename = truncate_filename(filename)
         
+        wb.save(os.path.join(output_dir, filename) if output_dir else filename)
+        wb.close()
+        api_client.print_stats(context.api_stats)
+        return filename
+        
+    except Exception as e:
+        try:
+            wb.close()
+        except:
+            pass
+        raise e
+
+def create_multi_store_report(store_ids, metrics_by_store, start_date, end_date, planning_days, form, context):
+    """
+    Формирует одну книгу пакетного отчета: лист анализа (как "Анализ1") на каждый
+    склад с названием склада и общий лист "Инфо". Возвращает имя файла или None при отмене.
+    """
+    strategies = get_speed_strategies(form.get('speed_strategies') or SALES_SPEED_STRATEGIES)
+    wb = create_report_workbook(write_only=EXCEL_WRITE_ONLY)
+    try:
+        used_titles = {'инфо'}
+        store_names = []
+        first_title = None
+        for store_id in store_ids:
+            if check_if_cancelled(context):
+                wb.close()
+                return None
+            store_name = get_store_name(store_id)
+            store_names.append(store_name)
+            report_rows, max_depth = build_report_model(metrics_by_store[store_id], planning_days, strategies)
+            ws = wb.create_sheet(make_sheet_title(store_name, used_titles))
+            write_analysis_sheet(ws, report_rows, max_depth, [strategy.title for strategy in strategies])
+            print(f"Лист склада: {ws.title}")
+            if first_title is None:
+                first_title = ws.title
+        
+        selected_groups, group_name_for_file = get_selected_group_paths(form)
+        info_data = build_info_data(start_date, end_date, ', '.join(store_names), planning_days,
+                                    strategies, selected_groups)
+        info_ws = wb.create_sheet("Инфо")
+        write_info_sheet(info_ws, info_data, datetime.now().strftime('%d.%m.%Y %H:%M:%S'))
+        wb.active = wb[first_title]
+        
+        filename = truncate_filename(
+            f"{format_period(start_date, end_date)} - {len(store_ids)} складов - {group_name_for_file}.xlsx"
+        )
         wb.save(filename)
         wb.close()
+        api_client.print_stats(context.api_stats)
         return filename
         
     except Exception as e:
@@ -1867,11 +1040,260 @@ def create_excel_report(data, store_id, start_date, end_date, planning_days, man
             pass
         raise e
 
+def build_report_model(sku_metrics, planning_days, strategies):
+    """
+    Строит из показателей позиций строки листов отчета (build_report_rows).
+    
+    Returns:
+        tuple: (строки отчета, максимальная глубина групп)
+    """
+    group_index = get_group_index()
+    products_data = []
+    max_depth = 0
+    
+    # Собираем строки отчета в исходном порядке и определяем максимальную глубину
+    for metrics in sku_metrics:
+        full_path, uuid_path = get_group_path(metrics.group_uuid, group_index)
+        max_depth = max(max_depth, len(uuid_path))
+        
+        products_data.append(ProductRow(
+            name=metrics.name,
+            quantity=metrics.quantity,
+            profit=metrics.profit,
+            sales_speed=round(metrics.sales_speed, 2),  # Округляем скорость продаж до 2 знаков
+            forecast=metrics.sales_speed * planning_days,
+            group_uuid=metrics.group_uuid,
+            group_path=full_path,
+            uuid_path=uuid_path,
+            names_by_level=get_names_by_uuid(uuid_path, group_index),
+            product_uuid=metrics.product_uuid,
+            product_href=metrics.product_href,
+            extra_speeds=metrics.extra_speeds
+        ))
+    
+    print(f"Максимальная глубина групп: {max_depth}")
+    
+    # Рассчитываем количества и средние значения для всех групп за один проход
+    # Средние скорости групп по дополнительным алгоритмам - отдельные метрики того же прохода
+    metrics = dict(DEFAULT_METRICS)
+    extra_speed_metrics = []
+    for index, strategy in enumerate(strategies):
+        metric = f'sales_speed_{strategy.name}'
+        metrics[metric] = lambda product, index=index: product.extra_speeds[index]
+        extra_speed_metrics.append(metric)
+    group_aggregates = aggregate_groups(products_data, metrics)
+    
+    # Сортируем данные с использованием иерархического ключа
+    products_data.sort(key=create_hierarchical_sort_key)
+    
+    return build_report_rows(products_data, group_aggregates, extra_speed_metrics), max_depth
+
+def get_store_name(store_id):
+    """Название склада по справочнику (UUID, если склад не найден)"""
+    return next((store['name'] for store in get_stores() if store['id'] == store_id), store_id)
+
+def format_period(start_date, end_date):
+    """Период отчета для имени файла: 'ДД.ММ.ГГГГ-ДД.ММ.ГГГГ'"""
+    start_date_formatted = datetime.strptime(start_date, '%Y-%m-%d').strftime('%d.%m.%Y')
+    end_date_formatted = datetime.strptime(end_date, '%Y-%m-%d').strftime('%d.%m.%Y')
+    return f"{start_date_formatted}-{end_date_formatted}"
+
+def get_selected_group_paths(form):
+    """
+    Разбирает пути выбранных групп из поля final_product_paths.
+    
+    Returns:
+        tuple: (список путей групп, названия групп второго уровня для имени файла)
+    """
+    selected_groups = []
+    second_level_names = []  # Список для хранения названий второго уровня
+    
+    # Получаем пути групп из формы
+    raw_paths = form.get('final_product_paths', '')
+    if raw_paths:
+        # Очищаем каждый путь от лишних пробелов, включая пробелы вокруг разделителя
+        for path in raw_paths.split('||'):
+            if path.strip():
+                # Разбиваем путь на части, очищаем каждую часть
+                clean_path_parts = [part.strip() for part in path.strip().split('/')]
+                selected_groups.append('/'.join(clean_path_parts))
+                
+                # Проверяем уровни групп
+                if len(clean_path_parts) >= 2:  # Убеждаемся, что есть хотя бы два уровня
+                    if len(clean_path_parts) == 2 or (len(clean_path_parts) > 2 and clean_path_parts[2] == "Выберите подгруппу"):
+                        # Если это группа второго уровня или третий уровень не выбран
+                        second_level_names.append(clean_path_parts[1])
+                    elif len(clean_path_parts) > 2:
+                        # Если выбран третий уровень
+                        second_level_names.append(clean_path_parts[2])
+
+    # Формируем имя файла, используя названия второго уровня
+    group_name_for_file = "Все группы"
+    if second_level_names:
+        group_name_for_file = ','.join(second_level_names)
+        print(f"Название файла будет содержать группы: {group_name_for_file}")  # Добавляем для отладки
+    
+    return selected_groups, group_name_for_file
+
+def build_info_data(start_date, end_date, store_name, planning_days, strategies, selected_groups):
+    """Строки "параметр - значение" для листа "Инфо" """
+    # Форматируем даты для отображения
+    start_date_obj = datetime.strptime(start_date, '%Y-%m-%d')
+    end_date_obj = datetime.strptime(end_date, '%Y-%m-%d')
+    start_date_formatted = start_date_obj.strftime('%d.%m.%Y')
+    end_date_formatted = end_date_obj.strftime('%d.%m.%Y')
+    
+    # Вычисляем дату за 100 дней до начала периода
+    extended_start_date = start_date_obj - timedelta(days=LAST_SALE_LOOKBACK_DAYS)
+    extended_start_formatted = extended_start_date.strftime('%d.%m.%Y')
+    
+    # Алгоритмы дополнительных столбцов скорости продаж с началом их окна операций
+    strategies_info = []
+    if strategies:
+        start_us = datetime_to_us(start_date_obj)
+        strategies_info = [
+            ["Дополнительные алгоритмы скорости:", ', '.join(
+                f"{strategy.title} (операции с {us_to_datetime(strategy.window_start_us(start_us)).strftime('%d.%m.%Y')})"
+                for strategy in strategies
+            )],
+            ["", ""],
+        ]
+    
+    # Подготавливаем данные для информационного листа
+    info_data = [
+        ["Параметры анализа", ""],
+        ["", ""],
+        ["Период анализа:", f"с {start_date_formatted} по {end_date_formatted}"],
+        ["Дата начала поиска последней продажи перед Дата начала:", extended_start_formatted],
+        ["Количество дней анализа:", f"{(end_date_obj - start_date_obj).days + 1} дней"],
+        ["", ""],
+        ["Магазин:", store_name],
+        ["", ""],
+        ["Период планирования:", f"{planning_days} дней"],
+        ["", ""],
+        *strategies_info,
+        ["Выбранные группы товаров:", ""],
+    ]
+    
+    # Добавляем выбранные группы в информационный лист
+    if selected_groups:
+        print("Добавляем выбранные группы в информационный лист:")
+        for group_path in selected_groups:
+            print(f"  - {group_path}")
+            info_data.append(["", group_path])
+    else:
+        print("Нет выбранных групп, добавляем 'Все группы'")
+        info_data.append(["", "Все группы"])
+    
+    return info_data
+
+def calculate_sku_metrics(data, store_id, start_date, end_date, strategies, context):
+    """
+    Рассчитывает показатели позиций с продажами из отчета прибыльности: скорость
+    продаж v2 и скорости по дополнительным алгоритмам strategies.
+    
+    Результат не зависит от периода планирования, поэтому его можно запомнить
+    и построить по нему отчет с другими параметрами планирования без запросов к API.
+    
+    Returns:
+        list: Показатели позиций (SkuMetrics) в порядке строк data или None, если обработка отменена
+    """
+    # В пакетном режиме загружаем обороты всего склада один раз и дальше считаем локально
+    turnover_operations = None
+    if TURNOVER_BATCH_MODE:
+        turnover_operations = get_store_turnover_operations(store_id, start_date, end_date, context, strategies)
+        if turnover_operations is None:
+            return None
+
+    # Сначала отбираем позиции с продажами, для которых нужно рассчитать скорость
+    sales_items = []
+    for item in data['rows']:
+        if check_if_cancelled(context):
+            return None
+            
+        assortment = item.get('assortment', {})
+        assortment_meta = assortment.get('meta', {})
+        assortment_href = assortment_meta.get('href', '')
+        assortment_type = assortment_meta.get('type', '')
+        
+        # Определяем тип и ID
+        is_variant = assortment_type == 'variant' or '/variant/' in assortment_href
+        is_product = assortment_type == 'product' or '/product/' in assortment_href
+        
+        if is_variant:
+            variant_id = assortment_href.split('/variant/')[-1]
+        elif is_product:
+            variant_id = assortment_href.split('/product/')[-1]
+        else:
+            continue  # Пропускаем неподдерживаемые типы
+        
+        if variant_id and item.get('sellQuantity', 0) > 0:  # Проверяем продажи
+            sales_items.append((item, variant_id, is_variant, assortment_href))
+
+    def fetch_item_sales_operations(sales_item):
+        item, variant_id, is_variant, assortment_href = sales_item
+        print(f"Обработка позиции {item.get('assortment', {}).get('name', '')} (sellQuantity: {item.get('sellQuantity', 0)})")
+        return fetch_item_operations(variant_id, store_id, start_date, end_date, is_variant, context, strategies)
+
+    def on_item_done(index, result):
+        print(f"Позиция успешно обработана, обновляем счетчик")
+        update_processed_count(context)
+
+    if turnover_operations is not None:
+        # Операции уже загружены: скорость всех позиций считается локально за один проход
+        if check_if_cancelled(context):
+            return None
+        items_operations = [
+            turnover_operations.get(get_assortment_key(assortment_href), [])
+            for item, variant_id, is_variant, assortment_href in sales_items
+        ]
+    else:
+        items_operations = run_ordered(
+            fetch_item_sales_operations, sales_items,
+            max_workers=SALES_SPEED_WORKERS,
+            is_cancelled=context.is_cancelled,
+            on_done=on_item_done
+        )
+        if items_operations is None:
+            return None
+
+    # Дополнительные алгоритмы скорости считаются по тем же операциям, что и основная скорость v2;
+    # если им нужен более длинный период, v2 считается только по операциям своего окна
+    speed_items = [
+        (operations, sales_item[1]) for operations, sales_item in zip(items_operations, sales_items)
+    ]
+    start_us, end_us = get_period_us(start_date, end_date)
+    columns = build_operation_columns(speed_items)
+    v2_columns = columns.since(SPEED_STRATEGIES['v2'].window_start_us(start_us))
+    sales_results = calculate_sales_speeds_v2(speed_items, start_date, end_date, v2_columns)
+    extra_speeds = compute_strategy_speeds(columns, strategies, start_us, end_us)
+    if turnover_operations is not None:
+        for index, result in enumerate(sales_results):
+            on_item_done(index, result)
+
+    sku_metrics = []
+    for (item, variant_id, is_variant, assortment_href), result, item_extra_speeds in zip(
+            sales_items, sales_results, extra_speeds):
+        sales_speed, group_uuid, group_name, product_uuid, product_href, assortment_name = result
+        
+        if sales_speed is not None:  # Проверяем, что скорость продаж успешно рассчитана
+            sku_metrics.append(SkuMetrics(
+                name=assortment_name,  # Используем имя из ответа API
+                quantity=item.get('sellQuantity', 0),
+                profit=round(item.get('profit', 0) / 100 / item.get('sellQuantity', 1), 2),  # Делим на количество
+                sales_speed=sales_speed,
+                group_uuid=group_uuid,
+                product_uuid=product_uuid,
+                product_href=product_href,
+                extra_speeds=[round(speed, 2) for speed in item_extra_speeds]
+            ))
+    return sku_metrics
+
 def get_sheet_name(products_data):
     # Получаем уникальные названия второго уровня
     level2_names = set()
     for product in products_data:
-        names_by_level = product['names_by_level']
+        names_by_level = product.names_by_level
         if len(names_by_level) > 1:  # Если есть второй уровень
             level2_names.add(names_by_level[1])
     
@@ -1891,85 +1313,73 @@ def get_sheet_name(products_data):
     # Если название пустое, используем значение по умолчанию 
     return sheet_name if sheet_name else "Отчет прибыльности"
 
-def get_names_by_uuid(uuid_path, product_groups):
-    def find_name_by_uuid(groups, target_uuid):
-        for group in groups:
-            if group['id'] == target_uuid:
-                return group['name']
-            if group.get('children'):
-                name = find_name_by_uuid(group['children'], target_uuid)
-                if name:
-                    return name
-        return None
-
-    return [find_name_by_uuid(product_groups, uuid) or '' for uuid in uuid_path]
-
 @app.route('/cancel', methods=['POST'])
 def cancel_processing():
-    global processing_cancelled
-    with processing_lock:
-        processing_cancelled = True
-    return jsonify({'status': 'cancelled', 'cancelled': True}), 200  # Возвращаем 200 вместо 499
+    job_id = request.values.get('job_id')
+    if not job_id:
+        return jsonify({'error': 'Не указан job_id'}), 400
+    job = job_queue.cancel(job_id)
+    if job is None:
+        return jsonify({'error': 'Задача не найдена'}), 404
+    return jsonify({'status': 'cancelled', 'cancelled': True, 'job_id': job.id}), 200  # Возвращаем 200 вместо 499
 
 @app.route('/status-stream')
 def status_stream():
+    job = job_queue.get(request.args.get('job_id', ''))
+    if job is None:
+        return jsonify({'error': 'Задача не найдена'}), 404
+
     def generate():
-        last_processed = -1
+        # Поток просыпается только при изменении прогресса задачи или для heartbeat
+        version = None
         while True:
-            with processing_lock:
-                if current_status['total'] == 0:  # Ждем инициализации
-                    yield f"data: ...\n\n"
-                else:
-                    remaining = current_status['total'] - current_status['processed']
-                    if current_status['processed'] != last_processed:
-                        last_processed = current_status['processed']
-                        # Вычисляем среднее время запроса
-                        avg_time = sum(api_request_times) / len(api_request_times) if api_request_times else 0.9
-                        status_data = {
-                            'remaining': remaining,
-                            'processed': current_status['processed'],
-                            'total': current_status['total'],
-                            'avg_request_time': avg_time
-                        }
-                        yield f"data: {json.dumps(status_data)}\n\n"
-                    if remaining <= 0:
-                        break
-            sleep(0.1)
+            new_version = job.context.wait_for_change(version, STATUS_HEARTBEAT_INTERVAL)
+            if new_version == version:
+                yield ": heartbeat\n\n"  # Комментарий SSE не дает прокси закрыть соединение
+                continue
+            version = new_version
+
+            if job.finished:
+                # Итоговое событие: done, error или cancelled, после него поток закрывается
+                yield f"event: end\ndata: {json.dumps(get_job_status(job))}\n\n"
+                break
+
+            status_data = job.context.get_progress()
+            if status_data['total'] == 0:  # Ждем инициализации
+                yield f"data: ...\n\n"
+            else:
+                yield f"data: {json.dumps(status_data)}\n\n"
     return Response(generate(), mimetype='text/event-stream')
 
-def update_processed_count():
-    """Обновляет счетчик обработанных записей"""
-    global current_status
-    with processing_lock:
-        if current_status['total'] > 0:  # Проверяем, что счетчик инициализирован
-            current_status['processed'] += 1
-            remaining = current_status['total'] - current_status['processed']
-            # Вычисляем среднее время запроса
-            avg_time = sum(api_request_times) / len(api_request_times) if api_request_times else 0.9
-            print(f"Обновлен счетчик: обработано {current_status['processed']} из {current_status['total']}, осталось {remaining}")
-            print(f"Среднее время запроса: {avg_time:.3f} сек")
-
-def get_sales_speed_v2(variant_id, store_id, start_date, end_date, is_variant):
-    print(f"\nНачало расчета скорости продаж v2 для варианта {variant_id}")
-    total_start_time = time()
-    
-    url = f"{BASE_URL}/report/turnover/byoperations"
-    headers = {
-        'Authorization': f'Bearer {MOYSKLAD_TOKEN}',
-        'Accept': 'application/json;charset=utf-8'
-    }
-    
-    # Преобразуем даты в datetime объекты
-    date_conversion_start = time()
+def update_processed_count(context):
+    """Обновляет счетчик обработанных записей задачи"""
+    progress = context.advance()
+    if progress['total'] > 0:  # Проверяем, что счетчик инициализирован
+        print(f"Обновлен счетчик: обработано {progress['processed']} из {progress['total']}, осталось {progress['remaining']}")
+        print(f"Среднее время запроса: {progress['avg_request_time']:.3f} сек")
+
+def get_turnover_period(start_date, end_date, strategies=()):
+    """
+    Возвращает границы периода запроса оборотов для расчета скорости продаж v2:
+    начало расширяется на 100 дней назад для поиска последней продажи до периода,
+    или дальше, если операции раньше нужны дополнительным алгоритмам strategies.
+    """
     end_datetime = datetime.strptime(end_date, '%Y-%m-%d').replace(hour=23, minute=59, second=59)
     start_datetime = datetime.strptime(start_date, '%Y-%m-%d').replace(hour=0, minute=0, second=0)
+    extended_start_datetime = us_to_datetime(
+        get_window_start_us([SPEED_STRATEGIES['v2'], *strategies], datetime_to_us(start_datetime))
+    )
+    return extended_start_datetime.strftime('%Y-%m-%d %H:%M:%S'), end_datetime.strftime('%Y-%m-%d %H:%M:%S')
+
+def fetch_item_operations(variant_id, store_id, start_date, end_date, is_variant, context=None, strategies=()):
+    """
+    Загружает операции одной позиции за период расчета скорости продаж
+    (get_turnover_period). При ошибке запроса или пустом ответе возвращает [].
+    """
+    url = f"{BASE_URL}/report/turnover/byoperations"
     
-    # Создаем дату для поиска предыдущих продаж (100 дней до начала периода)
-    extended_start_datetime = start_datetime - timedelta(days=100)
-    
-    start_date_formatted = extended_start_datetime.strftime('%Y-%m-%d %H:%M:%S')
-    end_date_formatted = end_datetime.strftime('%Y-%m-%d %H:%M:%S')
-    print(f"Время на конвертацию дат: {(time() - date_conversion_start):.3f} сек")
+    # Период поиска: 100 дней (или окно алгоритмов strategies) до начала периода и до его конца
+    start_date_formatted, end_date_formatted = get_turnover_period(start_date, end_date, strategies)
     print(f"Расширенный период поиска: с {start_date_formatted} по {end_date_formatted}")
     
     params = {
@@ -1990,150 +1400,246 @@ def get_sales_speed_v2(variant_id, store_id, start_date, end_date, is_variant):
     
     print(f"Запрос для получения операций: URL={full_url}")
     
-    # Замер времени API запроса
+    # Замер времени API запроса вместе с потоковым разбором ответа;
+    # при отмене задачи запрос прерывается исключением RequestCancelled
     api_request_start = time()
     try:
-        response = requests.get(full_url, headers=headers, timeout=30)
+        response, data = api_client.get_rows(
+            full_url, Operation.from_api_row,
+            cancel_event=context.cancelled if context is not None else None,
+            stats=context.api_stats if context is not None else None
+        )
     except requests.exceptions.Timeout:
         print(f"Timeout при запросе операций для варианта {variant_id}")
-        return 0, '', '', '', '', ''  # Добавляем пустую строку для имени
+        return []
     except requests.exceptions.RequestException as e:
         print(f"Ошибка при запросе операций для варианта {variant_id}: {str(e)}")
-        return 0, '', '', '', '', ''  # Добавляем пустую строку для имени
+        return []
     
     api_request_time = time() - api_request_start
-    print(f"Время выполнения API запроса: {api_request_time:.3f} сек")
-    # Добавляем время запроса в список
-    api_request_times.append(api_request_time)
+    print(f"Время выполнения API запроса и разбора ответа: {api_request_time:.3f} сек")
+    # Добавляем время запроса в замеры задачи
+    if context is not None:
+        context.add_request_time(api_request_time)
     
     if response.status_code != 200:
         print(f"Ошибка при получении данных: {response.status_code}. Ответ сервера: {response.text}")
-        return 0, '', '', '', '', ''  # Добавляем пустую строку для имени
-
-    # Замер времени парсинга JSON
-    json_parse_start = time()
-    data = response.json()
-    json_parse_time = time() - json_parse_start
-    print(f"Время парсинга JSON: {json_parse_time:.3f} сек")
+        return []
     
     if not data or 'rows' not in data or not data['rows']:
         print(f"Получен пустой ответ для варианта {variant_id}")
-        return 0, '', '', '', '', ''  # Добавляем пустую строку для имени
-    
-    # Получаем имя из первой строки ответа
-    assortment_name = data['rows'][0]['assortment']['name']
-    print(f"Получено наименование: {assortment_name}")
-    
-    # Замер времени фильтрации строк
-    filter_start = time()
-    
-    # Получаем все продажи и конвертируем даты один раз
-    all_sales = []
-    for row in data.get('rows', []):
-        if (row['assortment']['meta']['href'].split('/')[-1] == variant_id and
-            row['operation']['meta']['type'] == 'retaildemand' and
-            row['quantity'] < 0):  # Продажи имеют отрицательное количество
-            sale_date = datetime.fromisoformat(row['operation']['moment'].replace('Z', '+00:00'))
-            all_sales.append((sale_date, row))
-    
-    # Сортируем все продажи по дате (по убыванию)
-    all_sales.sort(key=lambda x: x[0], reverse=True)
-    
-    # Находим продажи в указанном периоде
-    sales_in_period = [(date, row) for date, row in all_sales 
-                      if start_datetime <= date <= end_datetime]
-    
-    filter_time = time() - filter_start
-    print(f"Время фильтрации строк: {filter_time:.3f} сек")
-    
-    if not sales_in_period:
-        return 0, '', '', '', '', assortment_name  # Возвращаем имя даже если нет продаж
-    
-    # Получение метаданных
-    metadata_start = time()
-    group_uuid = ''
-    group_name = ''
-    product_uuid = ''
-    product_href = ''
-    
-    assortment = sales_in_period[0][1].get('assortment', {})
-    product_folder = assortment.get('productFolder', {})
-    group_href = product_folder.get('meta', {}).get('href', '')
-    group_uuid = group_href.split('/')[-1] if group_href else ''
-    group_name = product_folder.get('name', '')
-    
-    product_meta = assortment.get('meta', {})
-    product_href = product_meta.get('uuidHref', '')
-    if product_href:
-        product_uuid = product_meta.get('href', '').split('/')[-1]
-    metadata_time = time() - metadata_start
-    print(f"Время обработки метаданных: {metadata_time:.3f} сек")
-    
-    # Расчет скорости продаж
-    calculation_start = time()
+        return []
     
-    # Находим date2 - последняя продажа в периоде
-    date2 = sales_in_period[0][0]  # Берем первую из отсортированных по убыванию
+    return data['rows']
+
+def build_operation_columns(items):
+    """Раскладывает операции позиций (пары (операции, UUID позиции)) в общие столбцы"""
+    return OperationColumns.from_groups(
+        (variant_id, [row for row in rows if row.assortment_id == variant_id]) for rows, variant_id in items
+    )
+
+def get_period_us(start_date, end_date):
+    """Границы периода отчета в микросекундах: с начала start_date до конца end_date"""
+    start_us = datetime_to_us(datetime.strptime(start_date, '%Y-%m-%d'))
+    end_us = datetime_to_us(datetime.strptime(end_date, '%Y-%m-%d').replace(hour=23, minute=59, second=59))
+    return start_us, end_us
+
+def calculate_sales_speeds_v2(items, start_date, end_date, columns=None):
+    """
+    Рассчитывает скорость продаж v2 сразу для многих позиций.
     
-    # Находим date1 - последняя продажа до начала периода
-    date1 = start_datetime
+    Операции всех позиций раскладываются в столбцы (sales_speed.OperationColumns)
+    и обсчитываются одним проходом без разбора дат в циклах по позициям.
     
-    # Ищем последнюю продажу до начала периода
-    found_sale_before_period = False
-    for date, _ in all_sales:
-        if date < start_datetime:  # Ищем первую продажу, которая меньше даты начала периода
-            date1 = date
-            found_sale_before_period = True
-            break
+    Args:
+        items (list): Пары (операции позиции, UUID товара или модификации)
+        start_date (str): Дата начала периода в формате YYYY-MM-DD
+        end_date (str): Дата окончания периода в формате YYYY-MM-DD
+        columns (OperationColumns): Уже построенные по items столбцы (build_operation_columns),
+            в том числе сокращенные до окна v2 (OperationColumns.since)
     
-    if not found_sale_before_period:
-        print("Не найдено продаж за 100 дней до начала периода, используем самую раннюю дату поиска")
+    Returns:
+        list: Для каждой позиции кортеж (скорость, UUID группы, название группы,
+        UUID товара, ссылка на товар, наименование)
+    """
+    calculation_start = time()
+    start_us, end_us = get_period_us(start_date, end_date)
+    
+    if columns is None:
+        columns = build_operation_columns(items)
+    speeds = last_sale_interval_speeds(columns, start_us, end_us)
+    
+    results = []
+    for index, (sales_speed, last_sale) in enumerate(speeds):
+        span = columns.span(index)
+        if not span:
+            results.append((0, '', '', '', '', ''))
+            continue
+        
+        # Имя берем из первой операции позиции
+        assortment_name = columns.operations[span[0]].assortment_name
+        if last_sale is None:
+            results.append((0, '', '', '', '', assortment_name))  # Возвращаем имя даже если нет продаж
+            continue
+        
+        # Группа и ссылка на товар - из последней продажи в периоде
+        operation = columns.operations[last_sale]
+        product_href = operation.uuid_href
+        product_uuid = operation.assortment_id if product_href else ''
+        results.append((sales_speed, operation.group_uuid, operation.folder_name,
+                        product_uuid, product_href, assortment_name))
+    
+    print(f"Скорость продаж v2 рассчитана для {len(items)} позиций за {(time() - calculation_start):.3f} сек")
+    return results
+
+def get_store_turnover_operations(store_id, start_date, end_date, context=None, strategies=()):
+    """
+    Загружает операции report/turnover/byoperations по всему складу за период
+    расчета скорости продаж v2 и группирует их по позициям.
     
-    # Вычисляем разницу в днях
-    days = (date2 - date1).total_seconds() / (24 * 60 * 60)
+    Количество запросов зависит от числа страниц операций, а не от числа позиций.
+    Если включен локальный кэш, из API загружаются только операции, которых в нем еще нет.
     
-    # Считаем общее количество проданных единиц за период
-    total_sold = sum(abs(row['quantity']) for _, row in sales_in_period)
+    Args:
+        store_id (str): UUID склада
+        start_date (str): Дата начала периода в формате YYYY-MM-DD
+        end_date (str): Дата окончания периода в формате YYYY-MM-DD
+        strategies (list): Дополнительные алгоритмы скорости, период расширяется под их окна
     
-    print(f"date1 ({'последняя продажа до периода' if found_sale_before_period else 'дата начала периода'}): {date1}")
-    print(f"date2 (последняя продажа в периоде): {date2}")
-    print(f"Разница в днях: {days}")
-    print(f"Всего продано в периоде: {total_sold}")
+    Returns:
+        dict: Ключ позиции (см. get_assortment_key) -> список строк операций,
+              либо None, если обработка была отменена
+    """
+    start_date_formatted, end_date_formatted = get_turnover_period(start_date, end_date, strategies)
+    print(f"\nЗагрузка операций склада {store_id}: с {start_date_formatted} по {end_date_formatted}")
     
-    if days == 0:
-        # Если все продажи в один день, возвращаем общее количество проданных единиц
-        return total_sold, group_uuid, group_name, product_uuid, product_href, assortment_name
+    if turnover_cache is None:
+        rows = fetch_store_turnover_rows(store_id, start_date_formatted, end_date_formatted, context)
+        if rows is None:
+            return None
+        operations_by_assortment = {}
+        for row in rows:
+            key = get_assortment_key(row.assortment_href)
+            operations_by_assortment.setdefault(key, []).append(row)
+    else:
+        # Догружаем в кэш только недостающие участки периода
+        for range_from, range_to in turnover_cache.get_missing_ranges(store_id, start_date_formatted, end_date_formatted):
+            print(f"Догрузка операций в кэш: с {range_from} по {range_to}")
+            rows = fetch_store_turnover_rows(store_id, range_from, range_to, context)
+            if rows is None:
+                return None
+            turnover_cache.store_range(store_id, range_from, range_to, rows)
+        operations_by_assortment = turnover_cache.get_operations(store_id, start_date_formatted, end_date_formatted)
     
-    # Вычисляем среднюю скорость продаж (количество единиц в день)
-    sales_speed = total_sold / days
+    print(f"Всего позиций с операциями: {len(operations_by_assortment)}")
+    return operations_by_assortment
+
+def fetch_store_turnover_rows(store_id, moment_from, moment_to, context=None):
+    """
+    Постранично загружает из API все операции склада за период.
     
-    calculation_time = time() - calculation_start
-    print(f"Время расчета скорости продаж: {calculation_time:.3f} сек")
-    print(f"Средняя скорость продаж: {sales_speed} единиц в день")
+    Returns:
+        list: Строки отчета report/turnover/byoperations, либо None, если обработка была отменена
+    """
+    url = f"{BASE_URL}/report/turnover/byoperations"
+    limit = 1000
+    offset = 0
+    all_rows = []
     
-    total_time = time() - total_start_time
-    print(f"\nОбщее время выполнения get_sales_speed_v2: {total_time:.3f} сек")
+    if context is None:
+        context = JobContext()
     
-    return sales_speed, group_uuid, group_name, product_uuid, product_href, assortment_name
+    while True:
+        if check_if_cancelled(context):
+            return None
+        
+        params = {
+            'momentFrom': moment_from,
+            'momentTo': moment_to,
+            'limit': limit,
+            'offset': offset
+        }
+        query_string = '&'.join([f"{k}={v}" for k, v in params.items()] +
+                                [f"filter=store={BASE_URL}/entity/store/{store_id}"])
+        full_url = f"{url}?{query_string}"
+        
+        api_request_start = time()
+        try:
+            # Операции разбираются по мере загрузки и сразу сокращаются до нужных полей
+            response, data = api_client.get_rows(full_url, Operation.from_api_row, cancel_event=context.cancelled,
+                                                 stats=context.api_stats)
+        except RequestCancelled:
+            return None
+        except requests.exceptions.Timeout:
+            print("Timeout при получении операций склада")
+            raise Exception("Timeout при получении операций склада")
+        
+        api_request_time = time() - api_request_start
+        context.add_request_time(api_request_time)
+        
+        if response.status_code != 200:
+            error_message = f"Ошибка при получении операций склада: {response.status_code}. Ответ сервера: {response.text}"
+            print(error_message)
+            raise Exception(error_message)
+        
+        rows = data.get('rows', [])
+        all_rows.extend(rows)
+        print(f"Получено операций: {len(all_rows)} (страница за {api_request_time:.3f} сек)")
+        
+        if len(rows) < limit:
+            break
+        offset += limit
+    
+    return all_rows
 
-def get_bundle_components(bundle_href):
+def get_bundles_components(bundle_hrefs, context=None):
     """
-    Получает компоненты комплекта по его href.
+    Получает компоненты нескольких комплектов. Составы берутся из кэша, а
+    отсутствующие в нем загружаются параллельно и сохраняются в кэш.
+    
+    Args:
+        bundle_hrefs (list): Ссылки на комплекты (могут повторяться)
+        context (JobContext): Задача отчета для проверки отмены
+    
+    Returns:
+        dict: Ссылка на комплект -> список компонентов, либо None, если обработка была отменена
+    """
+    if context is None:
+        context = JobContext()
+    
+    bundle_hrefs = list(dict.fromkeys(bundle_hrefs))
+    components_by_bundle = bundle_components_cache.get_many(bundle_hrefs)
+    missing_hrefs = [href for href in bundle_hrefs if href not in components_by_bundle]
+    if not missing_hrefs:
+        return components_by_bundle
+    
+    print(f"Загрузка состава комплектов: {len(missing_hrefs)} из {len(bundle_hrefs)}")
+    results = run_ordered(
+        lambda href: get_bundle_components(href, context), missing_hrefs,
+        is_cancelled=context.is_cancelled
+    )
+    if results is None:
+        return None
+    components_by_bundle.update(zip(missing_hrefs, results))
+    return components_by_bundle
+
+def get_bundle_components(bundle_href, context=None):
+    """
+    Получает компоненты комплекта по его href. Успешно полученный состав
+    сохраняется в bundle_components_cache.
     
     Args:
         bundle_href (str): Ссылка на комплект
+        context (JobContext): Задача отчета; при ее отмене запрос прерывается исключением RequestCancelled
     
     Returns:
         list: Список компонентов комплекта (только товары и модификации)
     """
     components_url = f"{bundle_href}/components"
-    headers = {
-        'Authorization': f'Bearer {MOYSKLAD_TOKEN}',
-        'Accept': 'application/json;charset=utf-8'
-    }
     
     try:
-        response = requests.get(components_url, headers=headers, timeout=30)
+        response = api_client.get(components_url, cancel_event=context.cancelled if context is not None else None,
+                                  stats=context.api_stats if context is not None else None)
         if response.status_code != 200:
             print(f"Ошибка при получении компонентов комплекта: {response.status_code}")
             return []
@@ -2148,13 +1654,18 @@ def get_bundle_components(bundle_href):
             assortment_type = component.get('assortment', {}).get('meta', {}).get('type', '')
             if assortment_type in ['variant', 'product']:
                 valid_components.append(component)
-                
+        
+        bundle_components_cache.set(bundle_href, valid_components)
         return valid_components
         
+    except RequestCancelled:
+        raise
     except Exception as e:
         print(f"Ошибка при получении компонентов комплекта: {str(e)}")
         return []
 
 if __name__ == '__main__':
     print("Starting Flask iframe app...")
+    stores_cache.warm()
+    product_groups_cache.warm()
     app.run(debug=True, port=5001)  # Используем другой порт, чтобы не конфликтовать с основным приложением 
\ No newline at end of file
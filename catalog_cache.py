@@ -0,0 +1,124 @@
+"""
+Кэш справочников МойСклад (группы товаров, склады) с временем жизни.
+
+Значение загружается один раз на процесс. После истечения TTL вызывающий код
+сразу получает прежнее значение, а обновление выполняется в фоновом потоке
+(stale-while-revalidate), поэтому страницы и отчеты не ждут загрузки справочников.
+
+Для данных, которые запрашиваются по отдельным сущностям (например, состав
+комплекта по его href), используется KeyedCache: каждое значение хранится
+под своим ключом и устаревает независимо от остальных. Для крупных значений
+(рассчитанные показатели отчета) число записей ограничивается max_entries.
+"""
+import threading
+from time import monotonic
+
+
+class CatalogCache:
+    """Кэш одного справочника, загружаемого функцией loader"""
+
+    def __init__(self, name, loader, ttl):
+        self.name = name
+        self.loader = loader
+        self.ttl = ttl
+        self.value = None
+        self.loaded = False
+        self.expires_at = 0.0
+        self.refreshing = False
+        self.lock = threading.Lock()
+
+    def get(self):
+        """
+        Возвращает значение справочника. Блокирует вызов только при первой загрузке;
+        устаревшее значение возвращается сразу с запуском фонового обновления.
+        """
+        with self.lock:
+            if not self.loaded:
+                # Первая загрузка выполняется под блокировкой, чтобы не дублировать запросы
+                self._store(self.loader())
+                return self.value
+
+            if monotonic() >= self.expires_at and not self.refreshing:
+                self._start_refresh()
+            return self.value
+
+    def warm(self):
+        """Запускает первую загрузку в фоне, чтобы первый запрос страницы не ждал ее"""
+        threading.Thread(target=self.get, name=f'warm-{self.name}', daemon=True).start()
+
+    def invalidate(self):
+        """Помечает значение устаревшим и сразу запускает его обновление в фоне"""
+        with self.lock:
+            self.expires_at = 0.0
+            if self.loaded and not self.refreshing:
+                self._start_refresh()
+
+    def _store(self, value):
+        self.value = value
+        self.loaded = True
+        self.expires_at = monotonic() + self.ttl
+
+    def _start_refresh(self):
+        self.refreshing = True
+        threading.Thread(target=self._refresh, name=f'refresh-{self.name}', daemon=True).start()
+
+    def _refresh(self):
+        try:
+            value = self.loader()
+        except Exception as e:
+            # Оставляем прежнее значение, повторим попытку при следующем обращении
+            print(f"Ошибка при обновлении справочника {self.name}: {str(e)}")
+            with self.lock:
+                self.refreshing = False
+            return
+
+        with self.lock:
+            self._store(value)
+            self.refreshing = False
+        print(f"Справочник {self.name} обновлен")
+
+
+class KeyedCache:
+    """Кэш значений по ключу с временем жизни; загрузку отсутствующих значений выполняет вызывающий код"""
+
+    def __init__(self, name, ttl, max_entries=None):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries  # None - без ограничения
+        self.entries = {}  # Ключ -> (значение, момент устаревания), в порядке записи
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Возвращает значение по ключу или None, если его нет в кэше или оно устарело"""
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """Возвращает словарь ключ -> значение для ключей, которые есть в кэше и не устарели"""
+        now = monotonic()
+        result = {}
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is None:
+                    continue
+                if now >= entry[1]:
+                    del self.entries[key]
+                else:
+                    result[key] = entry[0]
+        return result
+
+    def set(self, key, value):
+        now = monotonic()
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, now + self.ttl)
+            if self.max_entries is not None and len(self.entries) > self.max_entries:
+                # Сначала удаляем устаревшие записи, затем самые давние
+                for stale_key in [k for k, entry in self.entries.items() if now >= entry[1]]:
+                    del self.entries[stale_key]
+                while len(self.entries) > self.max_entries:
+                    del self.entries[next(iter(self.entries))]
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
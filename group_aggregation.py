@@ -0,0 +1,106 @@
+"""
+Агрегация показателей товаров по группам за один проход.
+
+Каждый товар учитывается во всех группах своего uuid_path. Для всех метрик
+сразу накапливаются количество товаров, суммы и взвешенные суммы, из которых
+затем получаются итоги, средние и средневзвешенные значения. Новая метрика
+добавляется в словарь метрик и не требует отдельного прохода по товарам.
+"""
+
+# Метрика: имя -> функция, возвращающая значение для товара
+DEFAULT_METRICS = {
+    'quantity': lambda product: product.quantity,
+    'profit': lambda product: product.profit,
+    'sales_speed': lambda product: product.sales_speed,
+    # Прибыльность группы: произведение прибыли на скорость продаж
+    'profitability': lambda product: product.profit * product.sales_speed,
+}
+
+# Пары (метрика, вес) для средневзвешенных значений
+DEFAULT_WEIGHTED = (
+    ('sales_speed', 'quantity'),
+)
+
+
+class GroupAggregates:
+    """Накопленные по группам суммы с методами получения итоговых показателей"""
+
+    def __init__(self, metric_names, weighted_pairs, stats):
+        self.metric_positions = {name: i for i, name in enumerate(metric_names)}
+        self.weighted_positions = {pair: i for i, pair in enumerate(weighted_pairs)}
+        # uuid группы -> [количество товаров, суммы метрик, взвешенные суммы, суммы весов]
+        self.stats = stats
+
+    def groups(self):
+        return self.stats.keys()
+
+    def count(self):
+        """Количество товаров в каждой группе (включая подгруппы)"""
+        return {group_uuid: entry[0] for group_uuid, entry in self.stats.items()}
+
+    def total(self, metric):
+        """Сумма метрики по каждой группе"""
+        position = self.metric_positions[metric]
+        return {group_uuid: entry[1][position] for group_uuid, entry in self.stats.items()}
+
+    def mean(self, metric, digits=2):
+        """Среднее значение метрики по товарам группы, округленное до digits знаков"""
+        position = self.metric_positions[metric]
+        return {
+            group_uuid: round(entry[1][position] / entry[0], digits) if entry[0] > 0 else 0
+            for group_uuid, entry in self.stats.items()
+        }
+
+    def weighted_mean(self, metric, weight, digits=2):
+        """Средневзвешенное значение метрики, например скорость продаж, взвешенная по количеству"""
+        position = self.weighted_positions[(metric, weight)]
+        return {
+            group_uuid: round(entry[2][position] / entry[3][position], digits) if entry[3][position] else 0
+            for group_uuid, entry in self.stats.items()
+        }
+
+
+def aggregate_groups(products_data, metrics=None, weighted=None):
+    """
+    Рассчитывает показатели всех групп за один проход по товарам.
+
+    Args:
+        products_data (list): Товары (ProductRow) с атрибутом uuid_path и полями, нужными метрикам
+        metrics (dict): Имя метрики -> функция значения (по умолчанию DEFAULT_METRICS)
+        weighted (tuple): Пары (метрика, вес) для средневзвешенных (по умолчанию DEFAULT_WEIGHTED)
+
+    Returns:
+        GroupAggregates: Накопленные показатели по UUID групп
+    """
+    metrics = metrics if metrics is not None else DEFAULT_METRICS
+    weighted = weighted if weighted is not None else DEFAULT_WEIGHTED
+
+    metric_names = list(metrics)
+    getters = [metrics[name] for name in metric_names]
+    weighted_pairs = list(weighted)
+    weighted_positions = [
+        (metric_names.index(metric), metric_names.index(weight)) for metric, weight in weighted_pairs
+    ]
+
+    metrics_count = len(getters)
+    weighted_count = len(weighted_pairs)
+    stats = {}
+
+    for product in products_data:
+        values = [getter(product) for getter in getters]
+        weighted_values = [values[m] * values[w] for m, w in weighted_positions]
+        weights = [values[w] for _, w in weighted_positions]
+
+        for group_uuid in product.uuid_path:
+            entry = stats.get(group_uuid)
+            if entry is None:
+                entry = stats[group_uuid] = [0, [0] * metrics_count, [0] * weighted_count, [0] * weighted_count]
+            entry[0] += 1
+            sums = entry[1]
+            for i in range(metrics_count):
+                sums[i] += values[i]
+            for i in range(weighted_count):
+                entry[2][i] += weighted_values[i]
+                entry[3][i] += weights[i]
+
+    return GroupAggregates(metric_names, weighted_pairs, stats)
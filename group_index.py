@@ -0,0 +1,90 @@
+"""
+Плоский индекс иерархии групп товаров.
+
+Дерево групп из build_group_hierarchy обходится один раз, и для каждой группы
+заранее вычисляются путь из названий, путь из UUID и глубина. Поиск пути группы
+товара после этого выполняется за O(1) вместо обхода всего дерева. Так же
+заранее, одним проходом по индексу, наследуются значения, заданные для групп
+(например, ручные минимальные остатки): inherit_max_values.
+"""
+
+
+class GroupEntry:
+    """Группа в индексе: узел дерева и заранее вычисленные пути от корня"""
+
+    __slots__ = ('node', 'name', 'parent', 'name_path', 'uuid_path', 'depth')
+
+    def __init__(self, node, name, parent, name_path, uuid_path):
+        self.node = node
+        self.name = name
+        self.parent = parent  # UUID родителя или None
+        self.name_path = name_path  # Кортеж названий от корня до группы
+        self.uuid_path = uuid_path  # Кортеж UUID от корня до группы
+        self.depth = len(uuid_path)  # 1 для корневых групп
+
+
+def build_group_index(root_groups):
+    """
+    Строит индекс групп по дереву из build_group_hierarchy.
+
+    Args:
+        root_groups (list): Корневые группы с вложенными 'children'
+
+    Returns:
+        dict: UUID группы -> GroupEntry
+    """
+    index = {}
+    # Обходим дерево в порядке сортировки, чтобы при повторе UUID побеждала первая найденная группа
+    stack = [(group, (), (), None) for group in reversed(root_groups)]
+    while stack:
+        group, parent_names, parent_uuids, parent_id = stack.pop()
+        name_path = parent_names + (group['name'],)
+        uuid_path = parent_uuids + (group['id'],)
+        if group['id'] not in index:
+            index[group['id']] = GroupEntry(group, group['name'], parent_id, name_path, uuid_path)
+        for child in reversed(group.get('children', [])):
+            stack.append((child, name_path, uuid_path, group['id']))
+    return index
+
+
+def get_group_path(group_uuid, group_index, get_uuid=False):
+    """
+    Возвращает путь группы в виде строки через '/' и список UUID от корня.
+
+    Если группа не найдена, возвращает ('', []).
+    """
+    entry = group_index.get(group_uuid)
+    if not entry:
+        return '', []  # Возвращаем пустую строку и пустой список UUID
+
+    uuid_path = list(entry.uuid_path)
+    return ('/'.join(entry.name_path), uuid_path) if not get_uuid else ('/'.join(uuid_path), uuid_path)
+
+
+def get_names_by_uuid(uuid_path, group_index):
+    """Возвращает названия групп для списка UUID (пустая строка для неизвестных)"""
+    return [group_index[uuid].name if uuid in group_index else '' for uuid in uuid_path]
+
+
+def inherit_max_values(values, group_index):
+    """
+    Распространяет значения, заданные для групп, на все их подгруппы.
+
+    Для каждой группы индекса берется наибольшее из значений, заданных для нее
+    и ее предков, поэтому товар получает значение одним поиском по UUID своей группы.
+
+    Args:
+        values (dict): UUID группы -> значение
+        group_index (dict): Индекс групп из build_group_index
+
+    Returns:
+        dict: UUID группы -> наибольшее значение по пути от корня (только группы, для которых оно есть)
+    """
+    if not values:
+        return {}
+    inherited = {}
+    for group_uuid, entry in group_index.items():
+        path_values = [values[uuid] for uuid in entry.uuid_path if uuid in values]
+        if path_values:
+            inherited[group_uuid] = max(path_values)
+    return inherited
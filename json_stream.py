@@ -0,0 +1,147 @@
+"""
+Потоковый разбор JSON-ответов API МойСклад.
+
+Ответы отчетов содержат до 1000 строк с глубоко вложенными объектами
+(assortment, operation, productFolder), из которых отчетам нужны несколько
+полей. read_json_rows получает тело ответа частями по мере загрузки из сети
+(см. MoySkladClient.get_rows) и разбирает строки массива "rows" по одной:
+каждая строка сразу сокращается функцией project, поэтому полный словарь
+страницы в памяти не собирается, а разбор идет параллельно с загрузкой.
+
+Разбор построен на json.JSONDecoder.raw_decode из стандартной библиотеки:
+в буфере хранится только еще не разобранная часть ответа.
+"""
+import codecs
+import json
+import re
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+_NON_WHITESPACE = re.compile(r'[^ \t\n\r]')
+
+
+class _IncompleteData(Exception):
+    """В буфере не хватает данных для разбора очередного значения"""
+
+
+class _StreamReader:
+    """Буфер текста ответа с догрузкой частей по требованию"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.exhausted = False
+
+    def read_more(self):
+        """Добавляет в буфер следующую часть ответа; отброшенное начало буфера освобождается"""
+        if self.exhausted:
+            raise json.JSONDecodeError('Неожиданный конец ответа', self.buffer, len(self.buffer))
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.exhausted = True
+            text = self.decoder.decode(b'', final=True)
+        else:
+            text = self.decoder.decode(chunk)
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+
+    def peek(self):
+        """Возвращает следующий непробельный символ, не сдвигая позицию"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            self.read_more()
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise json.JSONDecodeError(f'Ожидался символ {char!r}', self.buffer, self.pos)
+        self.pos += 1
+
+    def value(self):
+        """Разбирает очередное JSON-значение целиком"""
+        self.peek()
+        while True:
+            try:
+                return self._decode()
+            except _IncompleteData:
+                self.read_more()
+
+    def _decode(self):
+        try:
+            value, end = _decoder.raw_decode(self.buffer, self.pos)
+        except json.JSONDecodeError:
+            if self.exhausted:
+                raise
+            raise _IncompleteData()
+        # Число в конце буфера может быть обрезано ("12" из "123"), поэтому значение
+        # принимается, только если за ним в буфере уже есть следующий символ
+        if not self.exhausted and not _NON_WHITESPACE.search(self.buffer, end):
+            raise _IncompleteData()
+        self.pos = end
+        return value
+
+
+def read_json_rows(chunks, project=None):
+    """
+    Разбирает JSON-объект вида {..., "rows": [...]} по мере поступления частей.
+
+    Args:
+        chunks (iterable): Части тела ответа (bytes) в кодировке UTF-8
+        project (callable): Сокращает одну строку rows до нужных полей (по умолчанию строка не меняется)
+
+    Returns:
+        dict: Поля верхнего уровня ответа, в 'rows' - список сокращенных строк
+    """
+    reader = _StreamReader(iter(chunks))
+    document = {}
+    reader.expect('{')
+    if reader.peek() == '}':
+        return document
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        if key == 'rows' and reader.peek() == '[':
+            document[key] = _read_rows(reader, project)
+        else:
+            document[key] = reader.value()
+        if reader.peek() == '}':
+            return document
+        reader.expect(',')
+
+
+def _read_rows(reader, project):
+    reader.expect('[')
+    rows = []
+    if reader.peek() == ']':
+        reader.pos += 1
+        return rows
+    while True:
+        row = reader.value()
+        rows.append(project(row) if project is not None else row)
+        if reader.peek() == ']':
+            reader.pos += 1
+            return rows
+        reader.expect(',')
+
+
+def select_fields(value, fields):
+    """
+    Оставляет в словаре только перечисленные поля.
+
+    Args:
+        value (dict): Исходный словарь
+        fields (dict): Имя поля -> None (взять значение целиком) или вложенное
+            описание полей для словаря-значения. Отсутствующие поля пропускаются.
+    """
+    result = {}
+    for key, nested in fields.items():
+        if key in value:
+            if nested is None or not isinstance(value[key], dict):
+                result[key] = value[key]
+            else:
+                result[key] = select_fields(value[key], nested)
+    return result
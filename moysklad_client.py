@@ -0,0 +1,488 @@
+"""
+HTTP-клиент API МойСклад, общий для app.py и appiframe.py.
+
+Держит одну сессию с пулом соединений (keep-alive), запрашивает ответы в gzip,
+повторяет запросы при 429/5xx с учетом заголовков МойСклад, ограничивает темп
+запросов и ведет счетчики времени выполнения по каждому эндпоинту.
+
+Счетчики клиента общие для процесса. Задача отчета передает в запросы свой
+RequestStats (параметр stats), поэтому одновременные задачи не сбрасывают и не
+смешивают статистику друг друга.
+
+Запрос можно связать с событием отмены (cancel_event): ожидание лимита, паузы
+перед повторами и сам запрос прерываются не позже чем через
+CANCEL_CHECK_INTERVAL секунд после отмены исключением RequestCancelled.
+
+Большие ответы со строками (отчеты) можно разбирать потоково через get_rows:
+строки разбираются по мере загрузки и сразу сокращаются до нужных полей.
+"""
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from time import monotonic, sleep, time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from json_stream import read_json_rows
+
+BASE_URL = 'https://api.moysklad.ru/api/remap/1.2'
+
+# Статусы, при которых запрос имеет смысл повторить
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Сетевые ошибки, при которых запрос имеет смысл повторить: обрыв соединения,
+# таймаут, оборванный или поврежденный ответ
+RETRY_EXCEPTIONS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.ContentDecodingError
+)
+
+# Ограничения API МойСклад на один токен
+RATE_LIMIT_REQUESTS = 45  # запросов
+RATE_LIMIT_PERIOD = 3.0  # за столько секунд
+MAX_CONCURRENT_REQUESTS = 5  # параллельных запросов
+
+# Размер части ответа при потоковом разборе, байт
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Как часто (в секундах) проверять отмену во время ожидания
+CANCEL_CHECK_INTERVAL = 0.2
+
+UUID_PATTERN = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+
+class RequestCancelled(Exception):
+    """Запрос прерван, так как обработка была отменена"""
+
+
+def get_endpoint_name(url, base_url=BASE_URL):
+    """
+    Возвращает имя эндпоинта для статистики: путь без базового адреса,
+    параметров запроса и UUID сущностей.
+
+    Например, .../entity/bundle/<uuid>/components -> entity/bundle/{id}/components
+    """
+    path = url.split('?')[0]
+    if path.startswith(base_url):
+        path = path[len(base_url):]
+    return UUID_PATTERN.sub('{id}', path).strip('/')
+
+
+def get_retry_delay(response, attempt, backoff):
+    """
+    Вычисляет паузу перед повтором запроса в секундах.
+
+    МойСклад передает время до снятия ограничения в миллисекундах в заголовке
+    X-Lognex-Retry-After, стандартный Retry-After задается в секундах.
+    Если заголовков нет, используется экспоненциальная задержка.
+    """
+    retry_after_ms = response.headers.get('X-Lognex-Retry-After')
+    if retry_after_ms:
+        try:
+            return max(float(retry_after_ms) / 1000, 0)
+        except ValueError:
+            pass
+
+    retry_after = response.headers.get('Retry-After')
+    if retry_after:
+        try:
+            return max(float(retry_after), 0)
+        except ValueError:
+            pass
+
+    return backoff * (2 ** (attempt - 1))
+
+
+class RequestStats:
+    """Счетчики запросов по эндпоинтам и ожидания лимита запросов"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}  # Эндпоинт -> количество запросов, ошибок, повторов и время
+        self.requests = 0
+        self.throttled_requests = 0
+        self.throttled_time = 0.0
+
+    def record(self, endpoint, elapsed, error=False, retry=False):
+        with self.lock:
+            stat = self.endpoints.setdefault(endpoint, {
+                'count': 0, 'errors': 0, 'retries': 0, 'total_time': 0.0, 'max_time': 0.0
+            })
+            stat['count'] += 1
+            stat['total_time'] += elapsed
+            stat['max_time'] = max(stat['max_time'], elapsed)
+            if error:
+                stat['errors'] += 1
+            if retry:
+                stat['retries'] += 1
+
+    def record_wait(self, waited):
+        """Учитывает ожидание ограничителя темпа перед запросом"""
+        with self.lock:
+            self.requests += 1
+            if waited > 0.001:
+                self.throttled_requests += 1
+                self.throttled_time += waited
+
+    def get(self):
+        """Возвращает копию счетчиков со средним временем запроса по каждому эндпоинту"""
+        with self.lock:
+            result = {}
+            for endpoint, stat in self.endpoints.items():
+                result[endpoint] = dict(stat)
+                result[endpoint]['avg_time'] = stat['total_time'] / stat['count'] if stat['count'] else 0
+            return result
+
+    def get_throttling(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'throttled_requests': self.throttled_requests,
+                'throttled_time': self.throttled_time
+            }
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+            self.requests = 0
+            self.throttled_requests = 0
+            self.throttled_time = 0.0
+
+
+class RateLimiter:
+    """
+    Ограничитель темпа запросов по алгоритму token bucket.
+
+    Ведро вмещает RATE_LIMIT_REQUESTS запросов и пополняется равномерно за
+    RATE_LIMIT_PERIOD секунд. Ответы сервера уточняют состояние: заголовок
+    X-RateLimit-Remaining уменьшает запас, а при исчерпании лимита все потоки
+    ждут X-Lognex-Reset миллисекунд. Дополнительно ограничивается число
+    одновременных запросов.
+    """
+
+    def __init__(self, limit=RATE_LIMIT_REQUESTS, period=RATE_LIMIT_PERIOD, max_concurrent=MAX_CONCURRENT_REQUESTS):
+        self.capacity = float(limit)
+        self.rate = limit / period
+        self.tokens = float(limit)
+        self.updated = monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+        self.semaphore = threading.BoundedSemaphore(max_concurrent)
+
+        # Метрики ожидания
+        self.requests = 0
+        self.throttled_requests = 0
+        self.throttled_time = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, cancel_event=None):
+        """
+        Блокирует поток, пока запрос нельзя отправить. После запроса нужно вызвать release().
+        Если установлено событие cancel_event, ожидание прерывается исключением RequestCancelled.
+        Возвращает время ожидания в секундах.
+        """
+        wait_start = monotonic()
+        if cancel_event is None:
+            self.semaphore.acquire()
+        else:
+            while not self.semaphore.acquire(timeout=CANCEL_CHECK_INTERVAL):
+                if cancel_event.is_set():
+                    raise RequestCancelled()
+
+        while True:
+            with self.lock:
+                now = monotonic()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    waited = now - wait_start
+                    self.requests += 1
+                    if waited > 0.001:
+                        self.throttled_requests += 1
+                        self.throttled_time += waited
+                    return waited
+                delay = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            if cancel_event is None:
+                sleep(delay)
+            elif cancel_event.wait(delay):
+                self.semaphore.release()
+                raise RequestCancelled()
+
+    def release(self):
+        self.semaphore.release()
+
+    def block_for(self, seconds):
+        """Приостанавливает все запросы на указанное время"""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, monotonic() + seconds)
+
+    def update(self, headers):
+        """Уточняет запас запросов по заголовкам ответа МойСклад"""
+        try:
+            remaining = int(headers['X-RateLimit-Remaining'])
+        except (KeyError, ValueError):
+            return
+
+        with self.lock:
+            self._refill(monotonic())
+            self.tokens = min(self.tokens, float(remaining))
+
+        if remaining <= 0:
+            try:
+                reset_ms = float(headers.get('X-Lognex-Reset', 0))
+            except ValueError:
+                reset_ms = 0
+            if reset_ms > 0:
+                self.block_for(reset_ms / 1000)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'throttled_requests': self.throttled_requests,
+                'throttled_time': self.throttled_time,
+                'tokens': self.tokens
+            }
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests = 0
+            self.throttled_requests = 0
+            self.throttled_time = 0.0
+
+
+# Лимиты МойСклад действуют на токен, поэтому ограничитель общий для всех клиентов с одним токеном
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(token):
+    with rate_limiters_lock:
+        if token not in rate_limiters:
+            rate_limiters[token] = RateLimiter()
+        return rate_limiters[token]
+
+
+class MoySkladClient:
+    """Клиент API МойСклад с общим пулом соединений и повторами запросов"""
+
+    def __init__(self, token, base_url=BASE_URL, timeout=30, max_retries=3, backoff=1.0, pool_size=10, rate_limiter=None):
+        self.base_url = base_url
+        self.rate_limiter = rate_limiter or get_rate_limiter(token)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Authorization': f'Bearer {token}',
+            'Accept': 'application/json;charset=utf-8',
+            'Accept-Encoding': 'gzip'
+        })
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        # Потоки для запросов, которые можно прервать по событию отмены
+        self.request_executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='moysklad-request')
+
+        # Счетчики по эндпоинтам за все время работы процесса
+        self.stats = RequestStats()
+
+    def get(self, url, params=None, timeout=None, cancel_event=None, stats=None):
+        """
+        Выполняет GET-запрос с повторами при 429/5xx и сетевых ошибках.
+
+        Args:
+            url (str): Полный URL запроса (может уже содержать строку параметров)
+            params (dict): Дополнительные параметры запроса
+            timeout (float): Таймаут запроса в секундах (по умолчанию self.timeout)
+            cancel_event (threading.Event): Событие отмены; после его установки запрос
+                прерывается исключением RequestCancelled
+            stats (RequestStats): Счетчики задачи, в которые запрос учитывается
+                вместе с общими счетчиками клиента
+
+        Returns:
+            requests.Response: Ответ сервера. Если повторы исчерпаны, возвращается
+            последний ответ, и проверка статуса остается на вызывающей стороне.
+        """
+        return self._request(url, params, timeout, cancel_event, stats)
+
+    def _request(self, url, params, timeout, cancel_event, stats, stream=False):
+        """
+        Общая часть get и get_rows (аргументы те же, что у get).
+
+        При stream=True тело ответа не загружается сразу, а место в ограничителе
+        остается занятым после возврата ответа: его освобождает вызывающая сторона,
+        дочитав тело. Время запроса в статистике - до получения заголовков.
+        """
+        endpoint = get_endpoint_name(url, self.base_url)
+        attempt = 0
+
+        while True:
+            if cancel_event is not None and cancel_event.is_set():
+                raise RequestCancelled()
+            waited = self.rate_limiter.acquire(cancel_event)
+            for request_stats in (self.stats, stats):
+                if request_stats is not None:
+                    request_stats.record_wait(waited)
+            request_start = time()
+            try:
+                # Место в ограничителе освобождается при любом исходе запроса, иначе
+                # после нескольких необработанных ошибок все запросы процесса зависли бы
+                try:
+                    response = self._send(url, params, timeout or self.timeout, cancel_event, stream)
+                except RequestCancelled:
+                    # Отмененный запрос еще выполняется в request_executor: место освободит
+                    # _discard_response, когда запрос действительно завершится
+                    raise
+                except BaseException:
+                    self.rate_limiter.release()
+                    raise
+            except RETRY_EXCEPTIONS as e:
+                self._record(stats, endpoint, time() - request_start, error=True, retry=attempt < self.max_retries)
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                delay = self.backoff * (2 ** (attempt - 1))
+                print(f"Сетевая ошибка при запросе {endpoint}: {str(e)}. Повтор {attempt} через {delay:.1f} сек")
+                self._sleep(delay, cancel_event)
+                continue
+
+            self.rate_limiter.update(response.headers)
+
+            retry = response.status_code in RETRY_STATUSES and attempt < self.max_retries
+            self._record(stats, endpoint, time() - request_start, error=response.status_code != 200, retry=retry)
+            if not retry:
+                if not stream:
+                    self.rate_limiter.release()
+                return response
+
+            attempt += 1
+            delay = get_retry_delay(response, attempt, self.backoff)
+            print(f"Ответ {response.status_code} для {endpoint}. Повтор {attempt} через {delay:.1f} сек")
+            response.close()
+            self.rate_limiter.release()
+            if response.status_code == 429:
+                # Превышен лимит токена: приостанавливаем все потоки, а не только текущий
+                self.rate_limiter.block_for(delay)
+            else:
+                self._sleep(delay, cancel_event)
+
+    def get_rows(self, url, project=None, params=None, timeout=None, cancel_event=None, stats=None):
+        """
+        Выполняет GET-запрос и потоково разбирает ответ вида {..., "rows": [...]}.
+
+        Тело ответа не загружается целиком: строки разбираются по мере получения
+        и сокращаются функцией project. Обрыв соединения во время загрузки тела
+        повторяется так же, как сетевые ошибки в get.
+
+        Args:
+            url (str): Полный URL запроса
+            project (callable): Сокращает одну строку rows до нужных полей
+            params (dict): Дополнительные параметры запроса
+            timeout (float): Таймаут запроса в секундах (по умолчанию self.timeout)
+            cancel_event (threading.Event): Событие отмены; проверяется и между частями ответа
+            stats (RequestStats): Счетчики задачи (см. get)
+
+        Returns:
+            tuple: (requests.Response, dict) - ответ и разобранные поля верхнего уровня
+            со строками в 'rows'. Если статус ответа не 200, вместо словаря возвращается
+            None, а тело ответа доступно в response.text.
+        """
+        endpoint = get_endpoint_name(url, self.base_url)
+        attempt = 0
+
+        while True:
+            response = self._request(url, params, timeout, cancel_event, stats, stream=True)
+            # Тело ответа загружается по мере разбора, поэтому место в ограничителе
+            # занято до конца чтения, а не только до получения заголовков
+            try:
+                if response.status_code != 200:
+                    return response, None
+                try:
+                    return response, read_json_rows(self._iter_chunks(response, cancel_event), project)
+                except RETRY_EXCEPTIONS as e:
+                    if attempt >= self.max_retries:
+                        raise
+                    error = e
+                finally:
+                    response.close()
+            finally:
+                self.rate_limiter.release()
+
+            attempt += 1
+            delay = self.backoff * (2 ** (attempt - 1))
+            print(f"Обрыв загрузки ответа {endpoint}: {str(error)}. Повтор {attempt} через {delay:.1f} сек")
+            self._sleep(delay, cancel_event)
+
+    @staticmethod
+    def _iter_chunks(response, cancel_event):
+        for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+            if cancel_event is not None and cancel_event.is_set():
+                raise RequestCancelled()
+            yield chunk
+
+    def _send(self, url, params, timeout, cancel_event, stream=False):
+        """
+        Отправляет запрос. Без события отмены запрос выполняется в текущем потоке.
+
+        С событием отмены запрос выполняется в потоке request_executor, а текущий
+        поток ждет ответ, проверяя отмену. Прервать чтение из сокета requests не
+        позволяет, поэтому после отмены ответ отбрасывается: когда запрос завершится,
+        соединение закрывается и освобождается место в ограничителе.
+        """
+        if cancel_event is None:
+            return self.session.get(url, params=params, timeout=timeout, stream=stream)
+
+        future = self.request_executor.submit(self.session.get, url, params=params, timeout=timeout, stream=stream)
+        while True:
+            try:
+                return future.result(timeout=CANCEL_CHECK_INTERVAL)
+            except FutureTimeoutError:
+                if cancel_event.is_set():
+                    future.add_done_callback(self._discard_response)
+                    raise RequestCancelled()
+
+    def _discard_response(self, future):
+        self.rate_limiter.release()
+        if not future.cancelled() and future.exception() is None:
+            future.result().close()
+
+    @staticmethod
+    def _sleep(seconds, cancel_event):
+        if cancel_event is None:
+            sleep(seconds)
+        elif cancel_event.wait(seconds):
+            raise RequestCancelled()
+
+    def _record(self, stats, endpoint, elapsed, error=False, retry=False):
+        self.stats.record(endpoint, elapsed, error, retry)
+        if stats is not None:
+            stats.record(endpoint, elapsed, error, retry)
+
+    def get_stats(self):
+        """Возвращает копию общих счетчиков со средним временем запроса по каждому эндпоинту"""
+        return self.stats.get()
+
+    def reset_stats(self):
+        self.stats.reset()
+        self.rate_limiter.reset_stats()
+
+    def print_stats(self, stats=None):
+        """Выводит в консоль сводку по эндпоинтам: счетчики задачи stats или общие счетчики клиента"""
+        if stats is None:
+            stats = self.stats
+        print("\nСтатистика запросов к API:")
+        for endpoint, stat in sorted(stats.get().items()):
+            print(f"- {endpoint}: {stat['count']} запр., ошибок {stat['errors']}, повторов {stat['retries']}, "
+                  f"всего {stat['total_time']:.3f} сек, среднее {stat['avg_time']:.3f} сек, макс {stat['max_time']:.3f} сек")
+        limiter_stats = stats.get_throttling()
+        print(f"- Ожидание лимита запросов: {limiter_stats['throttled_requests']} из {limiter_stats['requests']} запр., "
+              f"всего {limiter_stats['throttled_time']:.3f} сек")
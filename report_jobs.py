@@ -0,0 +1,206 @@
+"""
+Очередь фоновых задач формирования отчетов.
+
+/process только ставит задачу в очередь и сразу возвращает ее идентификатор,
+а сам отчет строится в пуле потоков с ограниченным числом одновременно
+выполняемых задач. Состояние задачи запрашивается по идентификатору;
+завершенные задачи хранятся ограниченное время и затем удаляются.
+
+Прогресс, флаг отмены, замеры времени и счетчики запросов к API хранятся в JobContext задачи,
+поэтому одновременные отчеты разных пользователей не влияют друг на друга.
+Каждое изменение прогресса увеличивает версию контекста и будит ожидающих
+подписчиков (wait_for_change), так что поток статуса не опрашивает задачу.
+"""
+import threading
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+from moysklad_client import RequestStats
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_ERROR = 'error'
+JOB_CANCELLED = 'cancelled'
+
+FINISHED_STATUSES = (JOB_DONE, JOB_ERROR, JOB_CANCELLED)
+
+# Оценка времени запроса к API до первых замеров, сек
+DEFAULT_REQUEST_TIME = 0.9
+
+
+class JobContext:
+    """Состояние выполнения одного отчета: прогресс, отмена и время запросов к API"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.version = 0  # Увеличивается при каждом изменении, о котором нужно сообщить подписчикам
+        self.cancelled = threading.Event()
+        self.finished = False
+        self.total = 0
+        self.processed = 0
+        self.request_count = 0
+        self.request_time_total = 0.0
+        self.api_stats = RequestStats()  # Счетчики запросов задачи (передаются в запросы MoySkladClient)
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled.set()
+            self._notify()
+
+    def is_cancelled(self):
+        return self.cancelled.is_set()
+
+    def start_progress(self, total):
+        """Задает количество позиций для обработки и сбрасывает счетчик"""
+        with self.lock:
+            self.total = total
+            self.processed = 0
+            self._notify()
+
+    def advance(self):
+        """Увеличивает счетчик обработанных позиций и возвращает текущий прогресс"""
+        with self.lock:
+            if self.total > 0:  # Счетчик инициализирован
+                self.processed += 1
+                self._notify()
+        return self.get_progress()
+
+    def finish(self):
+        """Отмечает завершение задачи (успешное, с ошибкой или отменой)"""
+        with self.lock:
+            self.finished = True
+            self._notify()
+
+    def wait_for_change(self, version, timeout):
+        """
+        Ждет изменения контекста после версии version не дольше timeout секунд.
+        Возвращает текущую версию; если она равна version, изменений не было.
+        """
+        with self.lock:
+            self.changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def add_request_time(self, seconds):
+        """Добавляет замер времени запроса к API"""
+        with self.lock:
+            self.request_count += 1
+            self.request_time_total += seconds
+
+    def get_progress(self):
+        with self.lock:
+            avg_request_time = (
+                self.request_time_total / self.request_count if self.request_count else DEFAULT_REQUEST_TIME
+            )
+            return {
+                'remaining': self.total - self.processed,
+                'processed': self.processed,
+                'total': self.total,
+                'avg_request_time': avg_request_time,
+                'cancelled': self.cancelled.is_set()
+            }
+
+    def _notify(self):
+        # Вызывается под self.lock
+        self.version += 1
+        self.changed.notify_all()
+
+
+class ReportJob:
+    """Задача формирования отчета с параметрами запроса, состоянием выполнения и результатом"""
+
+    def __init__(self, params):
+        self.id = uuid.uuid4().hex
+        self.params = params
+        self.context = JobContext()
+        self.status = JOB_QUEUED
+        self.result = None  # Имя файла отчета
+        self.error = None
+        self.created_at = time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATUSES
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'progress': self.context.get_progress()
+        }
+
+
+class JobQueue:
+    """Пул потоков, выполняющий задачи функцией runner(job)"""
+
+    def __init__(self, runner, max_workers=1, ttl=3600):
+        """
+        Args:
+            runner (callable): Выполняет задачу и возвращает результат; None означает,
+                что задача отменена, исключение - что она завершилась ошибкой
+            max_workers (int): Количество одновременно выполняемых задач
+            ttl (int): Сколько секунд хранить завершенные задачи
+        """
+        self.runner = runner
+        self.ttl = ttl
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='report-job')
+
+    def submit(self, params, runner=None):
+        """
+        Ставит задачу в очередь и возвращает ее. runner заменяет функцию очереди
+        для этой задачи (например, пакетный отчет по нескольким складам).
+        """
+        job = ReportJob(params)
+        with self.lock:
+            self._purge_finished()
+            self.jobs[job.id] = job
+        self.executor.submit(self._run, job, runner or self.runner)
+        return job
+
+    def get(self, job_id):
+        """Возвращает задачу по идентификатору или None"""
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """Отменяет задачу (в очереди или выполняющуюся); возвращает ее или None"""
+        job = self.get(job_id)
+        if job is not None:
+            job.context.cancel()
+        return job
+
+    def _run(self, job, runner):
+        job.started_at = time()
+        job.status = JOB_RUNNING
+        try:
+            result = runner(job)
+        except Exception as e:
+            print(f"Ошибка при выполнении задачи {job.id}: {str(e)}")
+            print(traceback.format_exc())
+            job.error = str(e)
+            job.finished_at = time()
+            job.status = JOB_ERROR
+            job.context.finish()
+            return
+
+        job.result = result
+        job.finished_at = time()
+        job.status = JOB_DONE if result is not None else JOB_CANCELLED
+        job.context.finish()
+
+    def _purge_finished(self):
+        expired_before = time() - self.ttl
+        for job_id in [job_id for job_id, job in self.jobs.items()
+                       if job.finished and job.finished_at < expired_before]:
+            del self.jobs[job_id]
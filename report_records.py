@@ -0,0 +1,140 @@
+"""
+Компактные записи строк отчетов МойСклад.
+
+Из строк report/turnover/byoperations и report/profit/byvariant отчеты читают
+лишь несколько полей. Операции сразу при разборе ответа превращаются в записи
+Operation, а товары отчета хранятся в записях ProductRow: у классов задан
+__slots__, поэтому запись не держит словарь атрибутов, занимает меньше памяти,
+а горячие циклы расчета обращаются к атрибутам вместо поиска по ключам.
+Показатели товара, не зависящие от параметров планирования, хранятся в SkuMetrics:
+их можно запомнить и заново построить из них строки отчета с другим периодом
+планирования.
+
+Строки прибыльности остаются словарями с исходной вложенностью, но сокращаются
+до нужных полей (project_profit_row): к ним добавляются строки компонентов
+комплектов, которые собираются по той же схеме.
+"""
+from json_stream import select_fields
+
+# Строка report/profit/byvariant: позиция, количество продаж и прибыль
+PROFIT_ROW_FIELDS = {
+    'assortment': {
+        'name': None,
+        'meta': {'href': None, 'type': None, 'uuidHref': None},
+        'productFolder': {'name': None, 'meta': {'href': None}}
+    },
+    'sellQuantity': None,
+    'profit': None
+}
+
+
+def project_profit_row(row):
+    return select_fields(row, PROFIT_ROW_FIELDS)
+
+
+class Operation:
+    """Операция с позицией из report/turnover/byoperations"""
+
+    __slots__ = (
+        'assortment_href', 'assortment_name', 'uuid_href', 'folder_href', 'folder_name',
+        'moment', 'operation_type', 'quantity'
+    )
+
+    def __init__(self, assortment_href, assortment_name, uuid_href, folder_href, folder_name,
+                 moment, operation_type, quantity):
+        self.assortment_href = assortment_href
+        self.assortment_name = assortment_name
+        self.uuid_href = uuid_href  # Ссылка на карточку товара в интерфейсе МойСклад
+        self.folder_href = folder_href
+        self.folder_name = folder_name
+        self.moment = moment
+        self.operation_type = operation_type
+        self.quantity = quantity
+
+    @classmethod
+    def from_api_row(cls, row):
+        """Создает запись из строки ответа API"""
+        assortment = row.get('assortment', {})
+        assortment_meta = assortment.get('meta', {})
+        product_folder = assortment.get('productFolder', {})
+        operation = row.get('operation', {})
+        return cls(
+            assortment_meta.get('href', ''),
+            assortment.get('name', ''),
+            assortment_meta.get('uuidHref', ''),
+            product_folder.get('meta', {}).get('href', ''),
+            product_folder.get('name', ''),
+            operation.get('moment', ''),
+            operation.get('meta', {}).get('type', ''),
+            row.get('quantity', 0)
+        )
+
+    @classmethod
+    def from_payload(cls, payload):
+        """
+        Создает запись из сохраненного в кэше значения: списка полей (to_payload)
+        или строки API, сохраненной прежними версиями кэша.
+        """
+        if isinstance(payload, dict):
+            return cls.from_api_row(payload)
+        return cls(*payload)
+
+    def to_payload(self):
+        """Поля записи списком в порядке __slots__ для сохранения в JSON"""
+        return [getattr(self, name) for name in self.__slots__]
+
+    @property
+    def assortment_id(self):
+        """UUID товара или модификации"""
+        return self.assortment_href.split('/')[-1]
+
+    @property
+    def group_uuid(self):
+        return self.folder_href.split('/')[-1] if self.folder_href else ''
+
+
+class ProductRow:
+    """Товар отчета с рассчитанными показателями и положением в иерархии групп"""
+
+    __slots__ = (
+        'name', 'quantity', 'profit', 'sales_speed', 'forecast', 'group_uuid', 'group_path',
+        'uuid_path', 'names_by_level', 'product_uuid', 'product_href', 'extra_speeds'
+    )
+
+    def __init__(self, name, quantity, profit, sales_speed, forecast, group_uuid, group_path,
+                 uuid_path, names_by_level, product_uuid, product_href, extra_speeds=()):
+        self.name = name
+        self.quantity = quantity
+        self.profit = profit
+        self.sales_speed = sales_speed
+        self.forecast = forecast
+        self.group_uuid = group_uuid
+        self.group_path = group_path  # Путь из названий групп через '/'
+        self.uuid_path = uuid_path  # UUID групп от корня
+        self.names_by_level = names_by_level  # Названия групп uuid_path
+        self.product_uuid = product_uuid
+        self.product_href = product_href
+        self.extra_speeds = extra_speeds  # Скорости по дополнительным алгоритмам (sales_speed.SPEED_STRATEGIES)
+
+
+class SkuMetrics:
+    """
+    Рассчитанные показатели товара за период, не зависящие от периода планирования
+    и положения группы в текущем справочнике групп.
+    """
+
+    __slots__ = (
+        'name', 'quantity', 'profit', 'sales_speed', 'group_uuid', 'product_uuid', 'product_href',
+        'extra_speeds'
+    )
+
+    def __init__(self, name, quantity, profit, sales_speed, group_uuid, product_uuid, product_href,
+                 extra_speeds=()):
+        self.name = name
+        self.quantity = quantity
+        self.profit = profit
+        self.sales_speed = sales_speed  # Скорость без округления, из нее считается прогноз
+        self.group_uuid = group_uuid
+        self.product_uuid = product_uuid
+        self.product_href = product_href
+        self.extra_speeds = extra_speeds
@@ -0,0 +1,327 @@
+"""
+Запись листов отчета "Анализ1" и "Анализ2" из общей модели строк.
+
+Отсортированные товары один раз раскладываются в список строк отчета
+(build_report_rows): перед товарами новой группы стоят строки ее групп с
+итоговыми показателями. Каждый лист затем записывается за один линейный
+проход по этому списку: "Анализ1" содержит группы и товары, "Анализ2" -
+только группы с полным путем. Ячейки не перечитываются и не копируются
+между листами, а ячейкам назначаются именованные стили из report_styles.
+
+Строки добавляются через ws.append целиком, а ширины столбцов, закрепление и
+уровни группировки известны до записи строки, поэтому те же функции работают
+и с книгой в режиме write_only (create_report_workbook(write_only=True)):
+строки сразу уходят в файл, и память не растет с числом строк.
+"""
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils import get_column_letter
+
+import report_styles
+from report_styles import group_style, product_style, register_report_styles
+from sheet_outline import OutlineTracker
+
+# Значение по умолчанию в заголовке столбца прогноза "Анализ1"
+FORECAST_DAYS = 30
+
+LEVEL_WIDTH = 14
+UUID_WIDTH = 3
+NAME_WIDTH = 75
+VALUE_WIDTH = 15
+
+SHEET_TITLE_MAX_LENGTH = 31
+SHEET_TITLE_FORBIDDEN = '[]:*?/\\'
+
+
+def create_report_workbook(write_only=False):
+    """
+    Создает пустую книгу отчета без листов.
+
+    В режиме write_only строки записываются в файл по мере добавления: листы
+    нужно заполнять по одному, а ячейки после записи недоступны.
+    """
+    wb = Workbook(write_only=write_only)
+    if not write_only:
+        wb.remove(wb.active)
+    return wb
+
+
+def build_report_rows(products_data, group_aggregates, extra_speed_metrics=()):
+    """
+    Раскладывает отсортированные товары в строки отчета.
+
+    Перед товаром выводятся строки всех групп его пути (кроме корневой), которые
+    отличаются от пути предыдущего товара и еще не были выведены.
+
+    Args:
+        products_data (list): Товары (ProductRow), отсортированные по create_hierarchical_sort_key
+        group_aggregates (GroupAggregates): Показатели групп из aggregate_groups
+        extra_speed_metrics (list): Метрики group_aggregates со средними скоростями
+            групп по дополнительным алгоритмам, в порядке product.extra_speeds
+
+    Returns:
+        list: Строки отчета - словари с 'type' ('group' или 'product'), 'uuid',
+            'quantity', 'profit', 'sales_speed', 'profitability', 'extra_speeds' и полями типа:
+            для групп 'level' и 'path' (названия от второго уровня до группы),
+            для товаров 'name' и 'href'
+    """
+    group_quantities = group_aggregates.total('quantity')
+    group_profits = group_aggregates.mean('profit')
+    group_sales_speeds = group_aggregates.mean('sales_speed')
+    group_profitability = group_aggregates.mean('profitability')
+    group_extra_speeds = [group_aggregates.mean(metric) for metric in extra_speed_metrics]
+
+    rows = []
+    current_uuid_path = []
+    written_groups = set()  # (уровень, UUID) уже выведенных групп
+    for product in products_data:
+        uuid_path = product.uuid_path
+        names_by_level = product.names_by_level
+
+        for i, uuid in enumerate(uuid_path):
+            group_key = (i, uuid)
+            if i > 0 and (i >= len(current_uuid_path) or uuid != current_uuid_path[i]) \
+                    and group_key not in written_groups:
+                rows.append({
+                    'type': 'group',
+                    'level': i,
+                    'uuid': uuid,
+                    'path': names_by_level[1:i + 1],
+                    'quantity': group_quantities.get(uuid, 0),
+                    'profit': group_profits.get(uuid, 0),
+                    'sales_speed': group_sales_speeds.get(uuid, 0),
+                    'profitability': group_profitability.get(uuid, 0),
+                    'extra_speeds': [speeds.get(uuid, 0) for speeds in group_extra_speeds]
+                })
+                written_groups.add(group_key)
+
+        rows.append({
+            'type': 'product',
+            'uuid': product.product_uuid,
+            'href': product.product_href,
+            'name': product.name,
+            'quantity': product.quantity,
+            'profit': product.profit,
+            'sales_speed': product.sales_speed,
+            'profitability': round(product.profit * product.sales_speed, 2),
+            'extra_speeds': product.extra_speeds
+        })
+        current_uuid_path = uuid_path
+
+    return rows
+
+
+def write_analysis_sheet(ws, report_rows, max_depth, extra_speed_titles=()):
+    """
+    Записывает лист "Анализ1": группы и товары с формулами прогноза и группировкой строк.
+
+    Столбцы: уровни групп (начиная со второго), UUID, наименование, количество,
+    прибыльность, скорость продаж, прибыльность группы, прогноз, мин. остаток и
+    скорости по дополнительным алгоритмам (заголовки extra_speed_titles).
+    """
+    max_depth = max(max_depth, 1)  # Столбец UUID нужен и для товаров без групп
+    uuid_col = max_depth
+    uuid_col_letter = get_column_letter(uuid_col)
+    name_col = max_depth + 1
+    speed_col_letter = get_column_letter(max_depth + 4)
+    forecast_col = max_depth + 6
+    forecast_col_letter = get_column_letter(forecast_col)
+
+    register_report_styles(ws.parent)
+
+    # Все, что пишется в начало листа, задаем до первой строки
+    ws.sheet_properties.outlinePr.summaryBelow = False  # Кнопка группировки сверху
+    ws.freeze_panes = 'A3'
+    _set_widths(ws, [LEVEL_WIDTH] * (max_depth - 1) + [UUID_WIDTH, NAME_WIDTH] +
+                [VALUE_WIDTH] * (6 + len(extra_speed_titles)))
+
+    headers = [f'Уровень {i+2}' for i in range(max_depth - 1)] + [
+        'UUID', 'Наименование', 'Количество проданного', 'Средняя прибыльность товара',
+        'Скорость продаж', 'Прибыльность группы', FORECAST_DAYS, 'Мин.остаток'
+    ] + list(extra_speed_titles)
+    ws.append([
+        _cell(ws, header, _header_style(col, name_col, forecast_col))
+        for col, header in enumerate(headers, start=1)
+    ])
+    ws.append([])  # Вторая строка остается пустой, данные начинаются с третьей
+
+    outline = OutlineTracker(store_levels=False)  # Уровни применяем сразу при записи строки
+    for row, report_row in enumerate(report_rows, start=3):
+        if report_row['type'] == 'group':
+            level = report_row['level']
+            text_style = group_style(level)
+            cells = [_cell(ws, style=text_style) for _ in range(name_col)]
+            cells[level - 1].value = report_row['path'][-1]
+            cells[uuid_col - 1] = _cell(ws, report_row['uuid'], group_style(level, 'left'))
+            cells += _value_cells(ws, report_row, lambda kind: group_style(level, kind))
+            cells += [_cell(ws, style=group_style(level, 'value')) for _ in range(2)]
+            cells += [_cell(ws, speed, group_style(level, 'number')) for speed in report_row['extra_speeds']]
+            outline_level = outline.add_group_row(row, level)
+        else:
+            cells = [None] * (uuid_col - 1)
+            if report_row['href']:
+                uuid_cell = _cell(ws, report_row['uuid'], report_styles.UUID_LINK)
+                uuid_cell.hyperlink = report_row['href']
+                # Адрес ячейки задаем явно: при создании ячейки для append он еще неизвестен
+                uuid_cell.hyperlink.ref = f'{uuid_col_letter}{row}'
+            else:
+                uuid_cell = _cell(ws, style=product_style('left'))
+            cells.append(uuid_cell)
+            cells.append(_cell(ws, report_row['name'], product_style()))
+            cells += _value_cells(ws, report_row, product_style)
+            if report_row['name']:
+                # Прогноз с абсолютной ссылкой на число дней в заголовке и округление вверх
+                cells += [
+                    _cell(ws, f'={speed_col_letter}{row}*{forecast_col_letter}$1', product_style('number')),
+                    _cell(ws, f'=CEILING({forecast_col_letter}{row})', product_style('number'))
+                ]
+            else:
+                cells += [_cell(ws, style=product_style('value')) for _ in range(2)]
+            cells += [_cell(ws, speed, product_style('number')) for speed in report_row['extra_speeds']]
+            outline_level = outline.add_row(row, has_uuid=bool(report_row['href']))
+
+        _append_row(ws, row, cells, outline_level)
+
+
+def write_groups_sheet(ws, report_rows, max_depth):
+    """
+    Записывает лист "Анализ2": только строки групп с полным путем по уровням,
+    без наименований товаров, с формулами прогноза, процента и накопленного процента.
+    """
+    max_depth = max(max_depth, 1)
+    quantity_col_letter = get_column_letter(max_depth + 1)
+    profit_col_letter = get_column_letter(max_depth + 2)
+    forecast_col_letter = get_column_letter(max_depth + 5)
+    percent_col_letter = get_column_letter(max_depth + 6)
+
+    group_rows = [report_row for report_row in report_rows if report_row['type'] == 'group']
+    last_row = len(group_rows) + 2
+
+    register_report_styles(ws.parent)
+
+    ws.freeze_panes = 'A3'
+    if max_depth > 1:  # Автофильтр по столбцам уровней
+        ws.auto_filter.ref = f"A1:{get_column_letter(max_depth-1)}{last_row}"
+    _set_widths(ws, [LEVEL_WIDTH] * (max_depth - 1) + [UUID_WIDTH] + [VALUE_WIDTH] * 7)
+
+    headers = [f'Уровень {i+2}' for i in range(max_depth - 1)] + [
+        'UUID', 'Количество проданного', 'Средняя прибыльность товара', 'Скорость продаж',
+        'Прибыльность группы', f'=SUM({forecast_col_letter}2:{forecast_col_letter}{last_row})',
+        'Процент', 'Сумма процентов'
+    ]
+    ws.append([
+        _cell(ws, header, report_styles.HEADER_LEFT if col <= max_depth else report_styles.HEADER)
+        for col, header in enumerate(headers, start=1)
+    ])
+    ws.append([])
+
+    for row, report_row in enumerate(group_rows, start=3):
+        path = report_row['path']
+        level = report_row['level']
+        left_style = group_style(level, 'left')
+        number_style = group_style(level, 'number')
+
+        cells = [
+            _cell(ws, path[col - 1] if col <= len(path) else None, left_style)
+            for col in range(1, max_depth)
+        ]
+        cells.append(_cell(ws, report_row['uuid'], left_style))
+        cells += _value_cells(ws, report_row, lambda kind: group_style(level, kind))
+        formulas = [
+            f"=IF(SUBTOTAL(103;{quantity_col_letter}{row})=0;0;"
+            f"{quantity_col_letter}{row}*{profit_col_letter}{row})",
+            f"=IF(SUBTOTAL(103;{quantity_col_letter}{row})=0;0;"
+            f"{forecast_col_letter}{row}*100/${forecast_col_letter}$1)",
+            f"=IF(SUBTOTAL(103;{quantity_col_letter}{row})=0;0;"
+            f"SUM({percent_col_letter}$3:{percent_col_letter}{row}))"
+        ]
+        cells += [_cell(ws, formula, number_style) for formula in formulas]
+        ws.append(cells)
+
+
+def write_info_sheet(ws, info_data, created_at):
+    """
+    Записывает лист "Инфо": пары "параметр - значение" и время формирования отчета.
+
+    Args:
+        ws: Лист книги
+        info_data (list): Строки [подпись, значение]
+        created_at (str): Время формирования отчета
+    """
+    register_report_styles(ws.parent)
+    _set_widths(ws, [30, 60])
+
+    for row_data in info_data:
+        ws.append([
+            _cell(ws, value, report_styles.INFO_LABEL if col_idx == 1 else report_styles.INFO_VALUE)
+            for col_idx, value in enumerate(row_data, 1)
+        ])
+
+    ws.append([])
+    ws.append([
+        _cell(ws, "Отчет сформирован:", report_styles.INFO_LABEL),
+        _cell(ws, created_at, report_styles.INFO_VALUE)
+    ])
+
+
+def make_sheet_title(name, used_titles):
+    """
+    Название листа из произвольной строки (например, названия склада): без символов,
+    запрещенных в Excel, не длиннее 31 символа и не совпадающее с used_titles.
+    Выбранное название добавляется в used_titles.
+    """
+    title = ''.join('_' if char in SHEET_TITLE_FORBIDDEN else char for char in name).strip() or 'Лист'
+    title = title[:SHEET_TITLE_MAX_LENGTH]
+    candidate = title
+    number = 2
+    while candidate.lower() in used_titles:
+        suffix = f' ({number})'
+        candidate = title[:SHEET_TITLE_MAX_LENGTH - len(suffix)] + suffix
+        number += 1
+    used_titles.add(candidate.lower())
+    return candidate
+
+
+def _cell(ws, value=None, style=None):
+    """Создает ячейку для ws.append с именованным стилем"""
+    cell = WriteOnlyCell(ws, value)
+    if style is not None:
+        cell.style = style
+    return cell
+
+
+def _header_style(col, name_col, forecast_col):
+    if col == forecast_col:
+        return report_styles.HEADER_PARAMETER
+    return report_styles.HEADER_LEFT if col <= name_col else report_styles.HEADER
+
+
+def _value_cells(ws, report_row, style_for):
+    """
+    Ячейки количества, прибыльности, скорости продаж и прибыльности группы строки.
+    style_for возвращает имя стиля по виду ячейки ('value' или 'number').
+    """
+    return [
+        _cell(ws, report_row['quantity'], style_for('value')),
+        _cell(ws, report_row['profit'], style_for('number')),
+        _cell(ws, report_row['sales_speed'], style_for('number')),
+        _cell(ws, report_row['profitability'], style_for('number'))
+    ]
+
+
+def _set_widths(ws, widths):
+    """Задает ширины столбцов начиная с A; в режиме write_only это нужно сделать до записи строк"""
+    for col, width in enumerate(widths, start=1):
+        ws.column_dimensions[get_column_letter(col)].width = width
+
+
+def _append_row(ws, row, cells, outline_level):
+    """
+    Добавляет строку с уровнем группировки. Уровень задается до записи, так как
+    в режиме write_only строка сразу уходит в файл; после этого он больше не нужен.
+    """
+    if outline_level:
+        ws.row_dimensions[row].outline_level = outline_level
+    ws.append(cells)
+    if outline_level and ws.parent.write_only:
+        del ws.row_dimensions[row]
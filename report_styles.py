@@ -0,0 +1,78 @@
+"""
+Именованные стили ячеек отчета.
+
+Все сочетания шрифта, заливки, выравнивания и формата чисел, которые встречаются
+на листах отчета, один раз регистрируются в книге как NamedStyle. Ячейкам
+назначается только имя стиля: это не создает новых объектов стилей на каждую
+ячейку, а в файле каждая ячейка ссылается на общий стиль.
+"""
+from openpyxl.styles import NamedStyle, Font, PatternFill, Alignment, Border
+
+# Палитра заливки строк групп по уровням (глубже последнего уровня используется последний цвет)
+COLOR_PALETTE = ['F2F2F2', 'E6E6E6', 'D9D9D9', 'CCCCCC', 'BFBFBF']
+
+NUMBER_FORMAT = '0.00'
+
+FONT = Font(size=10)
+HEADER_FONT = Font(color="000000", bold=True, size=10)
+LINK_FONT = Font(color="0000FF", underline="single", size=10)
+CENTER_WRAP = Alignment(horizontal='center', vertical='center', wrap_text=True)
+LEFT_SHRINK = Alignment(horizontal='left', shrink_to_fit=True)
+
+# Имена стилей
+HEADER = 'report_header'  # Заголовок столбца значений
+HEADER_LEFT = 'report_header_left'  # Заголовок столбцов уровней, UUID и наименования
+HEADER_PARAMETER = 'report_header_parameter'  # Изменяемое число в заголовке (дни прогноза)
+UUID_LINK = 'report_uuid_link'  # UUID товара со ссылкой на карточку
+INFO_LABEL = 'report_info_label'
+INFO_VALUE = 'report_info_value'
+
+# Виды ячеек строк групп и товаров: параметры выравнивания и формата чисел
+CELL_KINDS = {
+    'text': {},  # Названия
+    'left': {'alignment': LEFT_SHRINK},  # Уровни и UUID
+    'value': {'alignment': CENTER_WRAP},  # Количество и пустые ячейки столбцов значений
+    'number': {'alignment': CENTER_WRAP, 'number_format': NUMBER_FORMAT},  # Дробные показатели
+}
+
+
+def group_style(level, kind='text'):
+    """Имя стиля ячейки строки группы уровня level (1 - верхний уровень столбцов)"""
+    return f'report_group_{min(level, len(COLOR_PALETTE))}_{kind}'
+
+
+def product_style(kind='text'):
+    """Имя стиля ячейки строки товара"""
+    return f'report_product_{kind}'
+
+
+def register_report_styles(wb):
+    """Регистрирует стили отчета в книге; повторный вызов для той же книги ничего не делает"""
+    if HEADER in wb.named_styles:
+        return
+    for style in _build_styles():
+        wb.add_named_style(style)
+
+
+def _build_styles():
+    # Стили привязываются к книге при регистрации, поэтому для каждой книги создаются заново
+    styles = [
+        NamedStyle(name=HEADER, font=HEADER_FONT, alignment=CENTER_WRAP),
+        NamedStyle(name=HEADER_LEFT, font=HEADER_FONT,
+                   alignment=Alignment(horizontal='left', vertical='center', shrink_to_fit=True)),
+        NamedStyle(name=HEADER_PARAMETER, font=FONT, alignment=CENTER_WRAP),
+        NamedStyle(name=UUID_LINK, font=LINK_FONT, alignment=LEFT_SHRINK),
+        NamedStyle(name=INFO_LABEL, font=Font(bold=True, size=10),
+                   alignment=Alignment(horizontal='right', vertical='center')),
+        NamedStyle(name=INFO_VALUE, alignment=Alignment(horizontal='left', vertical='center')),
+    ]
+
+    for kind, params in CELL_KINDS.items():
+        styles.append(NamedStyle(name=product_style(kind), font=FONT, **params))
+
+    for level, color in enumerate(COLOR_PALETTE, start=1):
+        fill = PatternFill(start_color=color, end_color=color, fill_type='solid')
+        for kind, params in CELL_KINDS.items():
+            styles.append(NamedStyle(name=group_style(level, kind), font=FONT, fill=fill, border=Border(), **params))
+
+    return styles
@@ -0,0 +1,375 @@
+"""
+Расчет скорости продаж по столбцам операций сразу для многих позиций.
+
+Операции всех позиций один раз раскладываются в столбцы (OperationColumns):
+момент в микросекундах от 1970-01-01, количество и код типа операции, а
+операции каждой позиции занимают непрерывный участок столбцов. Момент
+разбирается один раз при построении столбцов, дальше расчеты работают с целыми
+числами без datetime и timedelta, а очередь партий FIFO - с deque.
+
+NumPy не входит в зависимости проекта, поэтому столбцы хранятся в array из
+стандартной библиотеки, а расчет идет одним линейным проходом по участку каждой
+позиции. Результаты совпадают с прежними расчетами по строкам операций.
+
+Алгоритмы зарегистрированы в SPEED_STRATEGIES (register_speed_strategy): отчет
+загружает операции один раз и может вывести скорость сразу несколькими
+алгоритмами, а новый алгоритм добавляется без новых запросов к API. Каждый
+алгоритм задает, с какого момента ему нужны операции (SpeedStrategy.window_start_us):
+отчет загружает самый широкий из нужных периодов, а алгоритм считает только по
+операциям своего окна.
+"""
+from array import array
+from collections import deque
+from datetime import datetime, timedelta
+
+# Коды типов операций в столбце op_types
+OTHER_OPERATION = 0
+RETAIL_DEMAND = 1
+OPERATION_TYPE_CODES = {'retaildemand': RETAIL_DEMAND}
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+MICROSECONDS_PER_DAY = 24 * 60 * 60 * 10**6
+
+# Окна операций алгоритмов, как в их прежних отдельных расчетах
+LAST_SALE_LOOKBACK_DAYS = 100  # v2: поиск последней продажи до периода
+FIFO_LOOKBACK_DAYS = 300  # FIFO: партии, пришедшие до периода (search_days формы)
+ON_STOCK_HISTORY_START = datetime(2024, 1, 1)  # По наличию: остаток считается с этой даты
+
+
+def datetime_to_us(value):
+    """Переводит datetime без часового пояса в микросекунды от 1970-01-01"""
+    return (value - EPOCH) // MICROSECOND
+
+
+def us_to_datetime(microseconds):
+    """Переводит микросекунды от 1970-01-01 в datetime без часового пояса"""
+    return EPOCH + microseconds * MICROSECOND
+
+
+def moment_to_us(moment):
+    """Переводит момент операции МойСклад ('2024-03-01 12:00:00.000') в микросекунды от 1970-01-01"""
+    return datetime_to_us(datetime.fromisoformat(moment.replace('Z', '+00:00')))
+
+
+def _us_to_days(microseconds):
+    # Тот же порядок деления, что и в timedelta.total_seconds() / (24 * 60 * 60)
+    return microseconds / 10**6 / (24 * 60 * 60)
+
+
+def _scale_us(microseconds, factor):
+    """
+    Умножает интервал в микросекундах на количество с округлением до микросекунды
+    (половина - к четному), как timedelta * float. Без округления остатки партий
+    вида 1e-17 после вычитания дробных количеств давали бы ненулевое время хранения.
+    """
+    if factor == int(factor):
+        return microseconds * int(factor)
+    numerator, denominator = factor.as_integer_ratio()
+    quotient, remainder = divmod(microseconds * numerator, denominator)
+    remainder *= 2
+    if remainder > denominator or (remainder == denominator and quotient % 2 == 1):
+        quotient += 1
+    return quotient
+
+
+class OperationColumns:
+    """Операции нескольких позиций в столбцах; операции позиции i - участок span(i)"""
+
+    __slots__ = ('keys', 'offsets', 'moments', 'quantities', 'op_types', 'operations')
+
+    def __init__(self):
+        self.keys = []  # Ключ позиции по номеру
+        self.offsets = array('q', [0])  # Начало участка позиции i - offsets[i], конец - offsets[i + 1]
+        self.moments = array('q')  # Момент операции, мкс
+        self.quantities = array('d')
+        self.op_types = array('b')
+        self.operations = []  # Исходные записи Operation для метаданных позиции
+
+    @classmethod
+    def from_groups(cls, groups):
+        """
+        Строит столбцы из пар (ключ позиции, список Operation).
+        Порядок операций внутри позиции сохраняется.
+        """
+        columns = cls()
+        for key, operations in groups:
+            columns.keys.append(key)
+            for operation in operations:
+                columns.moments.append(moment_to_us(operation.moment))
+                columns.quantities.append(operation.quantity)
+                columns.op_types.append(OPERATION_TYPE_CODES.get(operation.operation_type, OTHER_OPERATION))
+                columns.operations.append(operation)
+            columns.offsets.append(len(columns.moments))
+        return columns
+
+    def __len__(self):
+        return len(self.keys)
+
+    def span(self, index):
+        """Номера операций позиции index в столбцах"""
+        return range(self.offsets[index], self.offsets[index + 1])
+
+    def sorted_span(self, index):
+        """Номера операций позиции по возрастанию момента (при равенстве - в исходном порядке)"""
+        return sorted(self.span(index), key=self.moments.__getitem__)
+
+    def since(self, start_us):
+        """Столбцы с теми же позициями, но только с операциями не раньше start_us"""
+        if not self.moments or min(self.moments) >= start_us:
+            return self
+        columns = OperationColumns()
+        columns.keys = self.keys
+        for index in range(len(self)):
+            for i in self.span(index):
+                if self.moments[i] >= start_us:
+                    columns.moments.append(self.moments[i])
+                    columns.quantities.append(self.quantities[i])
+                    columns.op_types.append(self.op_types[i])
+                    columns.operations.append(self.operations[i])
+            columns.offsets.append(len(columns.moments))
+        return columns
+
+
+def last_sale_interval_speeds(columns, start_us, end_us):
+    """
+    Скорость продаж v2: проданное в периоде количество, деленное на число дней
+    между последней продажей в периоде и последней продажей до него (или началом
+    периода, если продаж до него не было). Если обе даты совпадают, скорость
+    равна проданному количеству.
+
+    Args:
+        columns (OperationColumns): Операции позиций
+        start_us (int): Начало периода, мкс
+        end_us (int): Конец периода (включительно), мкс
+
+    Returns:
+        list: Для каждой позиции (скорость, номер последней продажи в периоде)
+            или (0, None), если продаж в периоде не было
+    """
+    moments = columns.moments
+    quantities = columns.quantities
+    op_types = columns.op_types
+    operations = columns.operations
+    results = []
+
+    for index in range(len(columns)):
+        last_sale = None
+        last_sale_us = 0
+        previous_sale_us = None
+        sales_in_period = []
+        for i in columns.span(index):
+            if op_types[i] != RETAIL_DEMAND or quantities[i] >= 0:  # Продажи имеют отрицательное количество
+                continue
+            moment = moments[i]
+            if moment < start_us:
+                if previous_sale_us is None or moment > previous_sale_us:
+                    previous_sale_us = moment
+            elif moment <= end_us:
+                sales_in_period.append(i)
+                # При равных моментах берем первую операцию, как устойчивая сортировка по убыванию
+                if last_sale is None or moment > last_sale_us:
+                    last_sale = i
+                    last_sale_us = moment
+
+        if last_sale is None:
+            results.append((0, None))
+            continue
+
+        # Суммируем исходные количества (int или float из JSON) от последней продажи к первой:
+        # sum() складывает их так же, как прежний расчет, и результат совпадает до последнего знака
+        sales_in_period.sort(key=moments.__getitem__, reverse=True)
+        total_sold = sum(abs(operations[i].quantity) for i in sales_in_period)
+        days = _us_to_days(last_sale_us - (previous_sale_us if previous_sale_us is not None else start_us))
+        results.append((total_sold / days if days != 0 else total_sold, last_sale))
+
+    return results
+
+
+def on_stock_speeds(columns, end_us, digits=2):
+    """
+    Скорость продаж v1: розничные продажи, деленные на число дней, когда товар
+    был в наличии (остаток считается по операциям от первой до end_us).
+
+    Returns:
+        list: Скорость каждой позиции, округленная до digits знаков
+    """
+    moments = columns.moments
+    quantities = columns.quantities
+    op_types = columns.op_types
+    results = []
+
+    for index in range(len(columns)):
+        retail_demand_counter = 0
+        current_stock = 0
+        last_operation_us = None
+        on_stock_us = 0
+        for i in columns.sorted_span(index):
+            moment = moments[i]
+            quantity = quantities[i]
+            if last_operation_us is not None and current_stock > 0:
+                on_stock_us += moment - last_operation_us
+
+            if quantity > 0:  # Приход товара
+                current_stock += quantity
+            else:  # Уход товара
+                quantity = abs(quantity)
+                current_stock = max(0, current_stock - quantity)
+                if op_types[i] == RETAIL_DEMAND:
+                    retail_demand_counter += quantity
+
+            last_operation_us = moment
+
+        # Учитываем время от последней операции до конца периода
+        if last_operation_us is not None and current_stock > 0:
+            on_stock_us += end_us - last_operation_us
+
+        days_on_stock = _us_to_days(on_stock_us)
+        results.append(round(retail_demand_counter / days_on_stock, digits) if days_on_stock > 0 else 0)
+
+    return results
+
+
+def fifo_shelf_time_speeds(columns, start_us, end_us):
+    """
+    Скорость продаж по времени хранения партий (FIFO): каждая проданная в
+    периоде единица списывается с самой старой партии, и ее время на складе
+    суммируется. Скорость - число проданных единиц на день хранения.
+
+    Returns:
+        list: Скорость каждой позиции
+    """
+    moments = columns.moments
+    quantities = columns.quantities
+    op_types = columns.op_types
+    results = []
+
+    for index in range(len(columns)):
+        batches = deque()  # [момент прихода, остаток партии]
+        retail_demand_counter = 0
+        on_stock_us = 0
+        for i in columns.sorted_span(index):
+            moment = moments[i]
+            quantity = quantities[i]
+
+            if quantity > 0:
+                batches.append([moment, quantity])
+
+            elif op_types[i] == RETAIL_DEMAND and start_us <= moment <= end_us:
+                quantity_to_sell = abs(quantity)
+                while quantity_to_sell > 0 and batches:
+                    batch = batches[0]
+                    sold_from_batch = min(quantity_to_sell, batch[1])
+                    on_stock_us += _scale_us(moment - batch[0], sold_from_batch)
+                    retail_demand_counter += sold_from_batch
+                    quantity_to_sell -= sold_from_batch
+                    if sold_from_batch == batch[1]:
+                        batches.popleft()
+                    else:
+                        batch[1] -= sold_from_batch
+
+            elif quantity < 0:
+                quantity_to_remove = abs(quantity)
+                while quantity_to_remove > 0 and batches:
+                    batch = batches[0]
+                    if batch[1] <= quantity_to_remove:
+                        quantity_to_remove -= batch[1]
+                        batches.popleft()
+                    else:
+                        batch[1] -= quantity_to_remove
+                        quantity_to_remove = 0
+
+        days_on_stock = _us_to_days(on_stock_us)
+        results.append(retail_demand_counter / days_on_stock if days_on_stock > 0 else 0)
+
+    return results
+
+
+class SpeedStrategy:
+    """Зарегистрированный алгоритм скорости продаж"""
+
+    __slots__ = ('name', 'title', 'compute', 'lookback_days', 'history_start')
+
+    def __init__(self, name, title, compute, lookback_days=0, history_start=None):
+        self.name = name
+        self.title = title  # Заголовок столбца отчета
+        self.compute = compute  # (columns, start_us, end_us) -> скорость каждой позиции
+        self.lookback_days = lookback_days  # Сколько дней операций до начала периода нужно алгоритму
+        self.history_start = history_start  # Или с какой даты (datetime) нужны операции
+
+    def window_start_us(self, start_us):
+        """Начало операций, нужных алгоритму для периода с началом start_us, мкс"""
+        if self.history_start is not None:
+            return datetime_to_us(self.history_start)
+        return start_us - self.lookback_days * MICROSECONDS_PER_DAY
+
+
+# Алгоритмы скорости продаж по имени. Все считают по одним и тем же столбцам
+# операций, поэтому новый алгоритм не добавляет запросов к API.
+SPEED_STRATEGIES = {}
+
+
+def register_speed_strategy(name, title, lookback_days=0, history_start=None):
+    """
+    Декоратор: регистрирует функцию (columns, start_us, end_us) -> список скоростей.
+    lookback_days или history_start задают окно операций алгоритма (см. SpeedStrategy).
+    """
+    def register(compute):
+        SPEED_STRATEGIES[name] = SpeedStrategy(name, title, compute, lookback_days, history_start)
+        return compute
+    return register
+
+
+@register_speed_strategy('v2', 'Скорость v2 (от прошлой продажи)', lookback_days=LAST_SALE_LOOKBACK_DAYS)
+def _last_sale_interval_strategy(columns, start_us, end_us):
+    return [speed for speed, _ in last_sale_interval_speeds(columns, start_us, end_us)]
+
+
+@register_speed_strategy('on_stock', 'Скорость по наличию', history_start=ON_STOCK_HISTORY_START)
+def _on_stock_strategy(columns, start_us, end_us):
+    # Остаток считается по всем операциям столбцов, начало периода не используется
+    return on_stock_speeds(columns, end_us)
+
+
+@register_speed_strategy('fifo', 'Скорость FIFO', lookback_days=FIFO_LOOKBACK_DAYS)
+def _fifo_strategy(columns, start_us, end_us):
+    return fifo_shelf_time_speeds(columns, start_us, end_us)
+
+
+def get_speed_strategies(names):
+    """
+    Возвращает алгоритмы по списку имен или строке имен через запятую.
+
+    Raises:
+        ValueError: Если алгоритм с таким именем не зарегистрирован
+    """
+    if isinstance(names, str):
+        names = [name.strip() for name in names.split(',') if name.strip()]
+    unknown = [name for name in names if name not in SPEED_STRATEGIES]
+    if unknown:
+        raise ValueError(
+            f"Неизвестный алгоритм скорости продаж: {', '.join(unknown)}. "
+            f"Доступны: {', '.join(SPEED_STRATEGIES)}"
+        )
+    return [SPEED_STRATEGIES[name] for name in names]
+
+
+def get_window_start_us(strategies, start_us):
+    """Начало операций, которых хватит всем алгоритмам strategies, мкс"""
+    return min((strategy.window_start_us(start_us) for strategy in strategies), default=start_us)
+
+
+def compute_strategy_speeds(columns, strategies, start_us, end_us):
+    """
+    Считает скорость каждой позиции всеми переданными алгоритмами. Столбцы должны
+    содержать операции с get_window_start_us(strategies, start_us); каждый алгоритм
+    считает только по операциям своего окна.
+
+    Returns:
+        list: Для каждой позиции список скоростей в порядке strategies
+    """
+    by_strategy = [
+        strategy.compute(columns.since(strategy.window_start_us(start_us)), start_us, end_us)
+        for strategy in strategies
+    ]
+    return [[speeds[index] for speeds in by_strategy] for index in range(len(columns))]
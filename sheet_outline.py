@@ -0,0 +1,61 @@
+"""
+Группировка строк отчета (outline) за один проход.
+
+Уровни группировки вычисляются по мере записи строк: строка-заголовок группы
+уровня N закрывает все открытые группы уровня N и глубже и открывает новую,
+а каждая строка получает уровень, равный числу охватывающих ее групп.
+
+Уровни совпадают с прежним поиском групп по ячейкам листа, включая его
+особенность: столбец UUID тоже считался уровнем группировки, поэтому строка
+без UUID (товар без ссылки) вложена в ближайшую строку выше с UUID и получает
+на один уровень больше соседних товаров.
+Перечитывать ячейки листа для поиска границ групп не нужно, а уровень строки
+известен до ее записи, что позволяет использовать трекер и для листов в режиме
+write_only.
+"""
+
+
+class OutlineTracker:
+    """Собирает уровни группировки строк листа во время их записи"""
+
+    def __init__(self, store_levels=True):
+        self.open_levels = []  # Стек уровней открытых групп
+        self.uuid_row_seen = False  # Была ли уже строка с UUID
+        self.row_levels = {}  # Номер строки -> уровень группировки
+        # При потоковой записи уровни применяются сразу и хранить их для apply не нужно
+        self.store_levels = store_levels
+
+    def add_group_row(self, row, level):
+        """
+        Регистрирует строку-заголовок группы уровня level (1 - верхний уровень столбцов).
+        Возвращает уровень группировки строки (0 - вне групп).
+        """
+        while self.open_levels and self.open_levels[-1] >= level:
+            self.open_levels.pop()
+        row_level = self._set_level(row, len(self.open_levels))
+        self.open_levels.append(level)
+        self.uuid_row_seen = True
+        return row_level
+
+    def add_row(self, row, has_uuid=True):
+        """
+        Регистрирует обычную строку внутри текущих открытых групп и возвращает ее уровень.
+        Строка без UUID (has_uuid=False) после строки с UUID получает на уровень больше.
+        """
+        level = len(self.open_levels)
+        if has_uuid:
+            self.uuid_row_seen = True
+        elif self.uuid_row_seen:
+            level += 1
+        return self._set_level(row, level)
+
+    def _set_level(self, row, level):
+        if level and self.store_levels:
+            self.row_levels[row] = level
+        return level
+
+    def apply(self, ws):
+        """Применяет уровни группировки к листу openpyxl"""
+        for row, level in self.row_levels.items():
+            ws.row_dimensions[row].outline_level = level
+            ws.row_dimensions[row].hidden = False
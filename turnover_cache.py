@@ -0,0 +1,225 @@
+"""
+Локальный кэш операций report/turnover/byoperations в SQLite.
+
+Операции хранятся по ключу склад + позиция + момент операции. Для каждого
+склада запоминается непрерывный загруженный диапазон дат, поэтому повторный
+отчет за близкий период догружает из API только недостающие края диапазона,
+а остальное читает с диска.
+
+Документы в уже загруженном диапазоне могут измениться: их правят, снимают с
+проведения, удаляют или проводят задним числом. Поэтому последние refresh_days
+дней загруженного диапазона перечитываются при каждом отчете, а весь кэш склада
+перезагружается, если с его первой загрузки прошло больше max_age секунд.
+Так же ограничен и размер файла: диапазон склада растет не дольше max_age, а
+хранятся операции не более max_stores складов, недавно использованных.
+
+Операции хранятся как записи Operation: в payload сохраняется список их полей.
+
+Моменты операций МойСклад передает по московскому времени, поэтому и границу
+загруженного диапазона "до текущего момента" кэш считает по московскому
+времени, а не по часам сервера, с небольшим запасом на запаздывание данных API.
+"""
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+from report_records import Operation
+
+MOMENT_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Часовой пояс моментов API МойСклад (Москва, UTC+3 без перехода на летнее время)
+API_TIMEZONE = timezone(timedelta(hours=3), 'MSK')
+
+# Последние минуты до текущего момента не считаются загруженными: операции,
+# проведенные только что, могут появиться в отчете API с задержкой
+SYNC_SAFETY_MARGIN = timedelta(minutes=5)
+
+
+def get_api_now():
+    """Текущий момент по времени API МойСклад, без часового пояса"""
+    return datetime.now(API_TIMEZONE).replace(tzinfo=None)
+
+
+def normalize_moment(moment):
+    """Приводит момент операции МойСклад ('2024-03-01 12:00:00.000') к виду 'YYYY-MM-DD HH:MM:SS'"""
+    return moment.replace('T', ' ')[:19]
+
+
+def get_assortment_key(assortment_href):
+    """Ключ позиции для группировки операций: href без параметров запроса"""
+    return assortment_href.split('?')[0]
+
+
+class TurnoverCache:
+    """Хранилище операций по складам с отслеживанием загруженного диапазона"""
+
+    def __init__(self, path, refresh_days=14, max_age=7 * 24 * 3600, max_stores=50):
+        self.path = path
+        self.refresh_days = refresh_days  # Сколько последних дней загруженного диапазона перечитывать
+        self.max_age = max_age  # Через сколько секунд после первой загрузки кэш склада устаревает
+        self.max_stores = max_stores  # Сколько складов хранить (None - без ограничения)
+        self.lock = threading.Lock()
+        with self.lock, self._connect() as conn:
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS operations (
+                    store_id TEXT NOT NULL,
+                    assortment_href TEXT NOT NULL,
+                    moment TEXT NOT NULL,
+                    operation_type TEXT,
+                    quantity REAL,
+                    payload TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS operations_store_moment
+                    ON operations (store_id, moment);
+                CREATE INDEX IF NOT EXISTS operations_store_assortment_moment
+                    ON operations (store_id, assortment_href, moment);
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    store_id TEXT PRIMARY KEY,
+                    synced_from TEXT NOT NULL,
+                    synced_to TEXT NOT NULL,
+                    updated_at TEXT NOT NULL
+                );
+            ''')
+            # Файлы прежних версий создавались без времени первой загрузки склада;
+            # такие склады считаются устаревшими и будут загружены заново
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(sync_state)')]
+            if 'loaded_at' not in columns:
+                conn.execute('ALTER TABLE sync_state ADD COLUMN loaded_at TEXT')
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:  # Фиксирует транзакцию или откатывает ее при ошибке
+                yield conn
+        finally:
+            conn.close()
+
+    def get_synced_range(self, store_id):
+        """Возвращает (synced_from, synced_to) для склада или None, если данных нет"""
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT synced_from, synced_to FROM sync_state WHERE store_id = ?', (store_id,)
+            ).fetchone()
+        return tuple(row) if row else None
+
+    def get_missing_ranges(self, store_id, moment_from, moment_to):
+        """
+        Возвращает диапазоны, которые нужно загрузить из API, чтобы кэш покрывал
+        [moment_from, moment_to]. Диапазоны примыкают к уже загруженному, чтобы
+        он оставался непрерывным. Последние refresh_days дней загруженного
+        диапазона загружаются повторно, так как документы в них могли измениться,
+        а устаревший кэш склада (max_age) удаляется и загружается целиком.
+        """
+        with self._connect() as conn:
+            synced = conn.execute(
+                'SELECT synced_from, synced_to, loaded_at FROM sync_state WHERE store_id = ?', (store_id,)
+            ).fetchone()
+        if not synced:
+            return [(moment_from, moment_to)]
+
+        synced_from, synced_to, loaded_at = synced
+        expired_before = (get_api_now() - timedelta(seconds=self.max_age)).strftime(MOMENT_FORMAT)
+        if loaded_at is None or loaded_at < expired_before:
+            print(f"Кэш операций склада {store_id} устарел, загружаем заново")
+            self.clear(store_id)
+            return [(moment_from, moment_to)]
+
+        refresh_from = max(synced_from, (
+            datetime.strptime(synced_to, MOMENT_FORMAT) - timedelta(days=self.refresh_days)
+        ).strftime(MOMENT_FORMAT))
+        ranges = []
+        if moment_from < synced_from:
+            ranges.append((moment_from, synced_from))
+        if moment_to > refresh_from:
+            ranges.append((max(moment_from, refresh_from), moment_to))
+        return ranges
+
+    def store_range(self, store_id, moment_from, moment_to, rows):
+        """
+        Заменяет операции склада в диапазоне [moment_from, moment_to] на rows
+        (записи Operation) и расширяет загруженный диапазон склада.
+        """
+        api_now = get_api_now()
+        now = api_now.strftime(MOMENT_FORMAT)
+        # Операций из будущего еще нет, поэтому синхронизированным считаем диапазон до текущего
+        # момента по времени API за вычетом запаса; остальное догрузится следующим отчетом
+        synced_to = max(moment_from, min(moment_to, (api_now - SYNC_SAFETY_MARGIN).strftime(MOMENT_FORMAT)))
+
+        records = []
+        for operation in rows:
+            records.append((
+                store_id,
+                get_assortment_key(operation.assortment_href),
+                normalize_moment(operation.moment),
+                operation.operation_type,
+                operation.quantity,
+                json.dumps(operation.to_payload(), ensure_ascii=False)
+            ))
+
+        with self.lock, self._connect() as conn:
+            conn.execute(
+                'DELETE FROM operations WHERE store_id = ? AND moment BETWEEN ? AND ?',
+                (store_id, moment_from, moment_to)
+            )
+            conn.executemany(
+                'INSERT INTO operations (store_id, assortment_href, moment, operation_type, quantity, payload) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                records
+            )
+
+            synced = conn.execute(
+                'SELECT synced_from, synced_to, loaded_at FROM sync_state WHERE store_id = ?', (store_id,)
+            ).fetchone()
+            if synced:
+                new_from = min(synced[0], moment_from)
+                new_to = max(synced[1], synced_to)
+                loaded_at = synced[2] or now
+            else:
+                new_from, new_to, loaded_at = moment_from, synced_to, now
+            conn.execute(
+                'INSERT OR REPLACE INTO sync_state (store_id, synced_from, synced_to, updated_at, loaded_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (store_id, new_from, new_to, now, loaded_at)
+            )
+
+            if self.max_stores:
+                # Удаляем операции складов, которые давно не использовались
+                evicted = [row[0] for row in conn.execute(
+                    'SELECT store_id FROM sync_state ORDER BY updated_at DESC LIMIT -1 OFFSET ?', (self.max_stores,)
+                )]
+                for evicted_store_id in evicted:
+                    conn.execute('DELETE FROM operations WHERE store_id = ?', (evicted_store_id,))
+                    conn.execute('DELETE FROM sync_state WHERE store_id = ?', (evicted_store_id,))
+
+    def get_operations(self, store_id, moment_from, moment_to):
+        """
+        Возвращает операции склада за период, сгруппированные по позициям.
+
+        Returns:
+            dict: Ключ позиции (см. get_assortment_key) -> список операций (Operation) по возрастанию момента
+        """
+        operations_by_assortment = {}
+        with self._connect() as conn:
+            cursor = conn.execute(
+                'SELECT assortment_href, payload FROM operations '
+                'WHERE store_id = ? AND moment BETWEEN ? AND ? ORDER BY moment',
+                (store_id, moment_from, moment_to)
+            )
+            for assortment_href, payload in cursor:
+                operations_by_assortment.setdefault(assortment_href, []).append(
+                    Operation.from_payload(json.loads(payload))
+                )
+        return operations_by_assortment
+
+    def clear(self, store_id=None):
+        """Удаляет операции одного склада или весь кэш"""
+        with self.lock, self._connect() as conn:
+            if store_id:
+                conn.execute('DELETE FROM operations WHERE store_id = ?', (store_id,))
+                conn.execute('DELETE FROM sync_state WHERE store_id = ?', (store_id,))
+            else:
+                conn.execute('DELETE FROM operations')
+                conn.execute('DELETE FROM sync_state')
@@ -0,0 +1,56 @@
+"""
+Пул потоков для параллельного выполнения запросов к API МойСклад.
+
+Используется в app.py и appiframe.py для расчета скорости продаж по многим
+позициям одновременно.
+"""
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# МойСклад допускает не более 5 параллельных запросов от одного пользователя
+MAX_PARALLEL_REQUESTS = 5
+
+# Как часто (в секундах) проверять отмену, пока задачи выполняются
+CANCEL_CHECK_INTERVAL = 0.2
+
+
+def run_ordered(func, items, max_workers=MAX_PARALLEL_REQUESTS, is_cancelled=None, on_done=None):
+    """
+    Выполняет func для каждого элемента items в пуле потоков.
+
+    Args:
+        func (callable): Функция, вызываемая для одного элемента
+        items (list): Элементы для обработки
+        max_workers (int): Количество потоков (не больше MAX_PARALLEL_REQUESTS)
+        is_cancelled (callable): Возвращает True, если обработку нужно прервать
+        on_done (callable): Вызывается в вызывающем потоке после завершения каждой задачи
+            с аргументами (индекс элемента, результат)
+
+    Returns:
+        list: Результаты в порядке items, либо None, если обработка была отменена
+    """
+    items = list(items)
+    max_workers = max(1, min(max_workers, MAX_PARALLEL_REQUESTS))
+    results = [None] * len(items)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        pending = {executor.submit(func, item): index for index, item in enumerate(items)}
+
+        while pending:
+            done, _ = wait(pending, timeout=CANCEL_CHECK_INTERVAL, return_when=FIRST_COMPLETED)
+            # Отмену проверяем после ожидания: задачи, прерванные отменой, завершаются
+            # исключением, и его не нужно передавать вызывающему коду
+            if is_cancelled and is_cancelled():
+                executor.shutdown(wait=False, cancel_futures=True)
+                return None
+
+            for future in done:
+                index = pending.pop(future)
+                # Исключение из задачи прерывает всю обработку
+                results[index] = future.result()
+                if on_done:
+                    on_done(index, results[index])
+
+        return results
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)